@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+ALG Custom Install Module - Process Runner
+Shared by the ALG modules for every process they start, on the live
+system or in the target, and for reading their configuration. This file
+is part of the ALG project and is meant to be installed where the Python
+calamares embeds can import it, e.g. its site-packages directory.
+
+Every call takes an argument list (never a shell string), has a deadline,
+and is counted and timed. Read-only probes of the live system whose output
+cannot change during the install (gsettings get, xfconf-query reads) are
+run once: Calamares keeps one Python interpreter for the whole session,
+so the cache below is shared by every module and every job.
+"""
+
+import time
+import threading
+import subprocess
+from dataclasses import dataclass
+import libcalamares
+
+# Seconds a call may run when the caller gives no deadline
+DEFAULT_TIMEOUT = 60
+
+# Deadline of the quick read-only probes
+PROBE_TIMEOUT = 10
+
+# Exit codes Calamares reports for target commands that did not run to
+# completion; host commands use the same ones
+FAILED_TO_START = -2
+TIMED_OUT = -4
+
+@dataclass(frozen=True, slots=True)
+class RunResult:
+    """What a command did. stdout and stderr are empty for target commands."""
+    command: tuple
+    returncode: int
+    stdout: str
+    stderr: str
+    seconds: float
+    cached: bool = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+_lock = threading.Lock()
+_calls = []
+_probe_cache = {}
+
+def get_config(key, default=None):
+    """Return a value from the running module's configuration, or default."""
+    configuration = libcalamares.job.configuration or {}
+    return configuration.get(key, default)
+
+def _check_command(command):
+    """Rejects shell strings, the runner only takes argument lists."""
+    if isinstance(command, str) or not command or not all(isinstance(arg, str) for arg in command):
+        raise TypeError(f"command must be a list of arguments, got {command!r}")
+    return tuple(command)
+
+def _record(where, command, returncode, seconds, cached=False):
+    with _lock:
+        _calls.append({
+            "where": where,
+            "command": list(command),
+            "exit": returncode,
+            "seconds": round(seconds, 3),
+            "cached": cached,
+        })
+    if returncode == TIMED_OUT:
+        libcalamares.utils.warning(f"{command[0]} timed out")
+
+def run(command, timeout=DEFAULT_TIMEOUT, stdin=None):
+    """
+    Runs a command on the live system.
+    Returns a RunResult; a command that cannot be started or misses its
+    deadline gets FAILED_TO_START or TIMED_OUT instead of raising.
+    """
+    command = _check_command(command)
+    start = time.monotonic()
+    try:
+        process = subprocess.run(command, input=stdin, capture_output=True, text=True, timeout=timeout)
+        returncode, stdout, stderr = process.returncode, process.stdout, process.stderr
+    except subprocess.TimeoutExpired as e:
+        returncode, stdout, stderr = TIMED_OUT, "", str(e)
+    except OSError as e:
+        returncode, stdout, stderr = FAILED_TO_START, "", str(e)
+        libcalamares.utils.debug(f"Failed to start {command[0]}: {e}")
+    seconds = time.monotonic() - start
+    _record("host", command, returncode, seconds)
+    return RunResult(command, returncode, stdout, stderr, round(seconds, 3))
+
+def probe(command, timeout=PROBE_TIMEOUT):
+    """
+    Runs a read-only, idempotent command on the live system once per
+    session and returns its RunResult; later calls get the cached result.
+    Calls that time out are not cached.
+    """
+    command = _check_command(command)
+    with _lock:
+        cached = _probe_cache.get(command)
+    if cached is not None:
+        _record("host", command, cached.returncode, 0.0, cached=True)
+        return RunResult(cached.command, cached.returncode, cached.stdout, cached.stderr, 0.0, cached=True)
+
+    result = run(command, timeout)
+    if result.returncode != TIMED_OUT:
+        with _lock:
+            _probe_cache[command] = result
+    return result
+
+def run_target(command, timeout=DEFAULT_TIMEOUT):
+    """Runs a command in the target system. Returns a RunResult."""
+    command = _check_command(command)
+    start = time.monotonic()
+    returncode = libcalamares.utils.target_env_call(list(command), "", timeout)
+    seconds = time.monotonic() - start
+    _record("target", command, returncode, seconds)
+    return RunResult(command, returncode, "", "", round(seconds, 3))
+
+def stream_target(command, callback, timeout=DEFAULT_TIMEOUT):
+    """
+    Runs a command in the target system, passing each line of its output
+    to callback as it is printed. Returns a RunResult.
+    """
+    command = _check_command(command)
+    start = time.monotonic()
+    try:
+        returncode = libcalamares.utils.target_env_process_output(list(command), callback, "", timeout) or 0
+    except subprocess.CalledProcessError as e:
+        returncode = e.returncode
+    seconds = time.monotonic() - start
+    _record("target", command, returncode, seconds)
+    return RunResult(command, returncode, "", "", round(seconds, 3))
+
+def summary():
+    """
+    Returns the processes started so far:
+    {"spawns", "cached", "timeouts", "seconds", "programs": {name: {"spawns", "seconds"}}}.
+    """
+    with _lock:
+        calls = list(_calls)
+
+    programs = {}
+    for call in calls:
+        if call["cached"]:
+            continue
+        program = programs.setdefault(call["command"][0], {"spawns": 0, "seconds": 0.0})
+        program["spawns"] += 1
+        program["seconds"] = round(program["seconds"] + call["seconds"], 3)
+
+    return {
+        "spawns": sum(program["spawns"] for program in programs.values()),
+        "cached": sum(1 for call in calls if call["cached"]),
+        "timeouts": sum(1 for call in calls if call["exit"] == TIMED_OUT),
+        "seconds": round(sum(program["seconds"] for program in programs.values()), 3),
+        "programs": programs,
+    }
+
+def publish(module):
+    """Writes the session's process summary to globalstorage and the log."""
+    stats = summary()
+    libcalamares.globalstorage.insert("process_stats", stats)
+    libcalamares.utils.debug(f"{module}: {stats['spawns']} processes in {stats['seconds']}s"
+                             f" ({stats['cached']} cached probes, {stats['timeouts']} timeouts)")
+
+def reset():
+    """Forgets the recorded calls and cached probes."""
+    with _lock:
+        _calls.clear()
+        _probe_cache.clear()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+ALG Custom Install Module - Edition Chooser
+Build step that validates editions.yaml and compiles it into the lookup
+read by edition_chooser at install time. Run it while building the ISO:
+
+    python3 compile_editions.py editions.yaml editions.json
+
+The output maps "<edition>/<desktop>" to the merged plan for that pair:
+    {"version": 1, "plans": {"themed/kde": {"install": [...],
+     "remove": [...], "theme": {"light": {...}, "dark": {...}}}, ...}}
+"""
+
+import re
+import sys
+import json
+
+VERSION = 1
+EDITIONS = ("pure", "themed")
+DESKTOPS = ("kde", "gnome", "xfce")
+ENTRY_KEYS = {"install", "remove", "theme"}
+THEME_VARIANTS = ("light", "dark")
+THEME_KEYS = {"ini", "dconf", "xfconf"}
+
+# pacman's rules for package names
+_PACKAGE_RE = re.compile(r"^[a-z0-9@_+][a-z0-9@._+-]*$")
+
+def _check_entry(where, entry, errors):
+    """Validates one all/desktop entry, appending problems to errors."""
+    if not isinstance(entry, dict):
+        errors.append(f"{where}: expected a mapping")
+        return
+    for key in sorted(set(entry) - ENTRY_KEYS):
+        errors.append(f"{where}: unknown key '{key}'")
+    for key in ("install", "remove"):
+        packages = entry.get(key, [])
+        if not isinstance(packages, list):
+            errors.append(f"{where}.{key}: expected a list")
+            continue
+        for pkg in packages:
+            if not isinstance(pkg, str) or not _PACKAGE_RE.match(pkg):
+                errors.append(f"{where}.{key}: invalid package name {pkg!r}")
+    theme = entry.get("theme", {})
+    if not isinstance(theme, dict):
+        errors.append(f"{where}.theme: expected a mapping")
+        return
+    for variant, settings in theme.items():
+        if variant not in THEME_VARIANTS:
+            errors.append(f"{where}.theme: unknown variant '{variant}'")
+        elif not isinstance(settings, dict) or not set(settings) <= THEME_KEYS:
+            errors.append(f"{where}.theme.{variant}: expected a mapping of {sorted(THEME_KEYS)}")
+
+def merge_settings(base, extra):
+    """
+    Deep-merges two theme settings mappings. edition_chooser merges the
+    manifest's settings over its built-in themes with this same function.
+    """
+    merged = dict(base)
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_settings(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def _unique(*lists):
+    """Concatenates lists, keeping the first occurrence of each item."""
+    result = []
+    for items in lists:
+        for item in items:
+            if item not in result:
+                result.append(item)
+    return result
+
+def compile_manifest(manifest):
+    """
+    Validates a parsed manifest and merges each edition's *all* entry into
+    its desktop entries.
+    Returns (compiled lookup, list of errors).
+    """
+    errors = []
+    editions = manifest.get("editions") if isinstance(manifest, dict) else None
+    if not isinstance(editions, dict):
+        return None, ["manifest: expected an 'editions' mapping"]
+
+    for edition in sorted(set(editions) - set(EDITIONS)):
+        errors.append(f"editions: unknown edition '{edition}'")
+
+    plans = {}
+    for edition in EDITIONS:
+        entries = editions.get(edition)
+        if not isinstance(entries, dict):
+            errors.append(f"editions.{edition}: missing")
+            continue
+        for desktop in sorted(set(entries) - set(DESKTOPS) - {"all"}):
+            errors.append(f"editions.{edition}: unknown desktop '{desktop}'")
+        common = entries.get("all") or {}
+        common_errors = len(errors)
+        _check_entry(f"editions.{edition}.all", common, errors)
+        if len(errors) > common_errors:
+            continue
+
+        for desktop in DESKTOPS:
+            if desktop not in entries:
+                errors.append(f"editions.{edition}.{desktop}: missing")
+                continue
+            entry = entries[desktop] or {}
+            entry_errors = len(errors)
+            _check_entry(f"editions.{edition}.{desktop}", entry, errors)
+            if len(errors) > entry_errors:
+                continue
+
+            install = _unique(common.get("install", []), entry.get("install", []))
+            remove = _unique(common.get("remove", []), entry.get("remove", []))
+            for pkg in sorted(set(install) & set(remove)):
+                errors.append(f"editions.{edition}.{desktop}: '{pkg}' is both installed and removed")
+            plans[f"{edition}/{desktop}"] = {
+                "install": install,
+                "remove": remove,
+                "theme": {
+                    variant: merge_settings(common.get("theme", {}).get(variant, {}),
+                                             entry.get("theme", {}).get(variant, {}))
+                    for variant in THEME_VARIANTS
+                },
+            }
+
+    if errors:
+        return None, errors
+    return {"version": VERSION, "plans": plans}, []
+
+def main(argv):
+    # Only the build needs PyYAML, edition_chooser imports this file at install time
+    import yaml
+
+    if len(argv) != 3:
+        print(f"usage: {argv[0]} <editions.yaml> <output json>", file=sys.stderr)
+        return 1
+
+    with open(argv[1], "r", encoding="utf-8") as f:
+        compiled, errors = compile_manifest(yaml.safe_load(f))
+    if errors:
+        for error in errors:
+            print(f"{argv[1]}: {error}", file=sys.stderr)
+        return 1
+
+    with open(argv[2], "w", encoding="utf-8") as f:
+        json.dump(compiled, f, separators=(",", ":"), sort_keys=True)
+
+    print(f"{len(compiled['plans'])} edition plans")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
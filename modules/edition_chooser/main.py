@@ -6,18 +6,60 @@ This file is part of the ALG project and is
 meant to be shipped with calamares.
 """
 
+import io
 import os
-import subprocess
+import sys
+import json
+import struct
+import configparser
+from dataclasses import dataclass, asdict
+from typing import Optional
+from xml.etree import ElementTree
 import libcalamares
+import alg_runner
+
+try:
+    from .compile_editions import merge_settings
+except ImportError:
+    # Calamares runs main.py as a plain script, outside any package
+    sys.path.insert(0, libcalamares.job.working_path)
+    from compile_editions import merge_settings
 
 #NOTE: This module uses packagechooser as it's frontend. It also receives GS values from it.
 
 # #TODO:
-# 1) Based on packagechooser GS value, pass items to add/remove in packages_remover
+# 1) Based on packagechooser GS value, pass items to add/remove in packages_remover - done
 # 2) Set env variables (desktop_version())- done
 # 3) Check config files based on chosen edition (get_edition_version()) - done
 # 4) Set configs (set_system_theme()) - done
 
+# Keyfile holding the edition's defaults in the target's dconf db.d directory
+DCONF_KEYFILE = "00-alg-edition"
+
+EDITIONS = ("pure", "themed")
+
+# Edition plans compiled from editions.yaml by compile_editions.py at ISO build time
+EDITIONS_INDEX = "editions.json"
+EDITIONS_INDEX_VERSION = 1
+
+# GS key the packagechooser frontend stores the chosen edition id in
+PACKAGECHOOSER_KEY = "packagechooser_packagechooser"
+
+# What a run does: "packages" queues the edition's packages before
+# packages_remover, "theme" themes the target once they are installed
+STEPS = ("packages", "theme")
+
+# Regular accounts in the target, whose homes users already filled from /etc/skel
+TARGET_PASSWD = "etc/passwd"
+UID_MIN = 1000
+UID_MAX = 60000
+
+@dataclass(frozen=True, slots=True)
+class DetectionContext:
+    """What edition_chooser detected about the live system, computed once per run."""
+    desktop: Optional[str]
+    edition: str
+
 def desktop_version():
     """
     Determines the current desktop environment.
@@ -34,12 +76,13 @@ def desktop_version():
         return None
 
 
-def get_edition_version():
+def get_edition_version(desktop=None):
     """
     Determines if the system edition is 'pure' or 'themed'.
     Returns the edition type based on the current theme configuration.
     """
-    desktop = desktop_version()
+    if desktop is None:
+        desktop = desktop_version()
     
     try:
         if desktop == "kde":
@@ -58,6 +101,29 @@ def get_edition_version():
         libcalamares.utils.warning(f"Error determining edition version: {e}")
         return "pure"  # Default to pure edition on error
 
+def _read_kde_theme(config_file):
+    """
+    Streams a kdeglobals file for the theme it sets.
+    Stops at [KDE] LookAndFeelPackage; falls back to [General] ColorScheme.
+    Returns the value, or None if the file sets neither.
+    """
+    group = None
+    color_scheme = None
+    with open(config_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("[") and line.endswith("]"):
+                group = line[1:-1]
+                continue
+            key, sep, value = line.partition("=")
+            if not sep:
+                continue
+            if group == "KDE" and key.strip() == "LookAndFeelPackage":
+                return value.strip()
+            if group == "General" and key.strip() == "ColorScheme":
+                color_scheme = value.strip()
+    return color_scheme
+
 def _get_kde_edition():
     """Helper function to determine KDE edition type."""
     try:
@@ -70,12 +136,11 @@ def _get_kde_edition():
         
         for config_file in config_files:
             if os.path.exists(config_file):
-                with open(config_file, 'r') as f:
-                    content = f.read()
-                    if "org.kde.breeze" in content:
-                        return "pure"
-                    elif "Qogir" in content:
-                        return "themed"
+                theme = _read_kde_theme(config_file) or ""
+                if "Qogir" in theme:
+                    return "themed"
+                elif "breeze" in theme.lower():
+                    return "pure"
         
         return "pure"  # Default if no specific theme is found
     except Exception as e:
@@ -84,130 +149,530 @@ def _get_kde_edition():
 
 def _get_gnome_edition():
     """Helper function to determine GNOME edition type."""
-    try:
-        # Check shell theme
-        result = subprocess.run(
-            ["gsettings", "get", "org.gnome.shell.extensions.user-theme", "name"],
-            capture_output=True, text=True
-        )
-        
-        if "Orchis" in result.stdout:
-            return "themed"
-        return "pure"
-    except Exception as e:
-        libcalamares.utils.warning(f"Error checking GNOME theme: {e}")
+    # Check shell theme, read once per install
+    result = alg_runner.probe(["gsettings", "get", "org.gnome.shell.extensions.user-theme", "name"])
+    if not result.ok:
+        libcalamares.utils.warning(f"Error checking GNOME theme: {result.stderr.strip() or result.returncode}")
         return "pure"
 
+    if "Orchis" in result.stdout:
+        return "themed"
+    return "pure"
+
 def _get_xfce_edition():
     """Helper function to determine XFCE edition type."""
-    try:
-        result = subprocess.run(
-            ["xfconf-query", "-c", "xsettings", "-p", "/Net/ThemeName"],
-            capture_output=True, text=True
-        )
-        
-        if "Qogir" in result.stdout:
-            return "themed"
-        return "pure"
-    except Exception as e:
-        libcalamares.utils.warning(f"Error checking XFCE theme: {e}")
+    result = alg_runner.probe(["xfconf-query", "-c", "xsettings", "-p", "/Net/ThemeName"])
+    if not result.ok:
+        libcalamares.utils.warning(f"Error checking XFCE theme: {result.stderr.strip() or result.returncode}")
         return "pure"
 
-def set_system_theme():
+    if "Qogir" in result.stdout:
+        return "themed"
+    return "pure"
+
+def get_theme_settings(desktop, edition, dark=False, overrides=None):
+    """
+    Returns the settings that make up an edition's theme on a desktop, as
+    {"ini": {file: {group: {key: value}}}, "dconf": {key: value},
+    "xfconf": {channel: {property: value}}}.
+    Settings from the edition manifest in overrides are merged on top.
+    """
+    settings = {"ini": {}, "dconf": {}, "xfconf": {}}
+    if desktop == "kde":
+        if edition == "pure":
+            look_and_feel = "org.kde.breezedark.desktop" if dark else "org.kde.breeze.desktop"
+            color_scheme = "BreezeDark" if dark else "BreezeLight"
+            decoration = {"library": "org.kde.breeze", "theme": "Breeze"}
+        else:
+            look_and_feel = None
+            color_scheme = "Qogirdark" if dark else "Qogirlight"
+            decoration = {"library": "org.kde.kwin.aurorae",
+                          "theme": f"__aurorae__svg__Qogir-{'dark' if dark else 'light'}-circle"}
+        kdeglobals = {"General": {"ColorScheme": color_scheme}}
+        if look_and_feel:
+            kdeglobals["KDE"] = {"LookAndFeelPackage": look_and_feel}
+        settings["ini"] = {
+            "kdeglobals": kdeglobals,
+            "kwinrc": {"org.kde.kdecoration2": decoration},
+        }
+        settings["color_scheme"] = color_scheme
+    elif desktop == "gnome":
+        settings["dconf"]["/org/gnome/desktop/interface/color-scheme"] = "prefer-dark" if dark else "prefer-light"
+        if edition != "pure":
+            settings["dconf"]["/org/gnome/shell/extensions/user-theme/name"] = (
+                "Orchis-Red-Dark" if dark else "Orchis-Light")
+    elif desktop == "xfce":
+        if edition == "pure":
+            style = "Adwaita-dark" if dark else "Adwaita"
+        else:
+            style = "Qogir-Dark" if dark else "Qogir-Light"
+        settings["xfconf"] = {
+            "xsettings": {"/Net/ThemeName": style},
+            "xfwm4": {"/general/theme": style},
+        }
+    if overrides:
+        settings = merge_settings(settings, overrides)
+    return settings
+
+def _makedirs(path, owner=None):
+    """Creates a directory and its missing parents, owned by owner."""
+    if os.path.isdir(path):
+        return
+    _makedirs(os.path.dirname(path), owner)
+    os.makedirs(path, exist_ok=True)
+    if owner is not None:
+        os.chown(path, *owner)
+
+def _write_file(path, data, owner=None):
+    """Atomically writes data to path, creating parents and setting the owner."""
+    _makedirs(os.path.dirname(path), owner)
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with open(path + ".new", mode) as f:
+        f.write(data)
+    if owner is not None:
+        os.chown(path + ".new", *owner)
+    os.replace(path + ".new", path)
+
+def _new_kde_config():
+    """A ConfigParser that reads and writes KDE's INI dialect unchanged."""
+    config = configparser.ConfigParser(interpolation=None, strict=False,
+                                       delimiters=("=",), comment_prefixes=("#",))
+    config.optionxform = str
+    return config
+
+def read_color_scheme(path):
     """
-    Sets the system theme based on the chosen edition and desktop environment.
-    Uses appropriate tools for each desktop environment.
+    Reads the colour groups of a KDE .colors file, the way
+    plasma-apply-colorscheme merges them into kdeglobals.
     """
+    config = _new_kde_config()
+    if not config.read(path):
+        return {}
+    return {group: dict(config[group]) for group in config.sections()
+            if group.startswith("Colors:") or group in ("WM", "ColorEffects:Disabled", "ColorEffects:Inactive")}
+
+def write_ini_settings(path, groups, owner=None):
+    """Merges {group: {key: value}} into a KDE style INI file."""
+    config = _new_kde_config()
+    config.read(path)
+    for group, values in groups.items():
+        if not config.has_section(group):
+            config.add_section(group)
+        for key, value in values.items():
+            config[group][key] = str(value)
+
+    output = io.StringIO()
+    config.write(output, space_around_delimiters=False)
+    _write_file(path, output.getvalue(), owner)
+
+# GVariant serialisation, just enough for dconf databases
+
+def _gvariant_offsets(body, ends):
+    """Appends the framing offsets of a variable-size GVariant container."""
+    for size, fmt in ((1, "B"), (2, "H"), (4, "I"), (8, "Q")):
+        if len(body) + size * len(ends) <= (1 << (8 * size)) - 1:
+            break
+    return body + struct.pack(f"<{len(ends)}{fmt}", *ends)
+
+def serialize_gvariant(value):
+    """
+    Serialises a Python value as a GVariant.
+    Returns (data, type string).
+    """
+    if isinstance(value, bool):
+        return (b"\x01" if value else b"\x00"), "b"
+    if isinstance(value, int):
+        return struct.pack("<i", value), "i"
+    if isinstance(value, float):
+        return struct.pack("<d", value), "d"
+    if isinstance(value, str):
+        return value.encode() + b"\0", "s"
+    if isinstance(value, (list, tuple)) and all(isinstance(item, str) for item in value):
+        body = b""
+        ends = []
+        for item in value:
+            body += item.encode() + b"\0"
+            ends.append(len(body))
+        return _gvariant_offsets(body, ends), "as"
+    raise TypeError(f"Cannot store {value!r} in dconf")
+
+def serialize_gvariant_variant(value):
+    """Serialises a value boxed in a GVariant "v", as GVDB stores values."""
+    if isinstance(value, bytes):
+        return value  # already boxed, e.g. read back from an existing database
+    data, type_string = serialize_gvariant(value)
+    return data + b"\0" + type_string.encode()
+
+def format_gvariant(value):
+    """Formats a value in GVariant text form, as dconf keyfiles expect."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(format_gvariant(item) for item in value) + "]"
+    raise TypeError(f"Cannot store {value!r} in dconf")
+
+# GVDB, the on-disk format of dconf databases
+
+_GVDB_HEADER = struct.Struct("<8sII II")
+_GVDB_HASH_HEADER = struct.Struct("<II")
+_GVDB_ITEM = struct.Struct("<IIIHcx II")
+
+def _gvdb_hash(key):
+    """The djb hash GVDB buckets keys with, over signed chars."""
+    hash_value = 5381
+    for byte in key.encode():
+        hash_value = (hash_value * 33 + (byte - 256 if byte > 127 else byte)) & 0xFFFFFFFF
+    return hash_value
+
+def _dconf_parent(key):
+    """The directory a dconf key or directory lives in, None for the root."""
+    if key == "/":
+        return None
+    return key[:key.rstrip("/").rindex("/") + 1]
+
+def build_gvdb(entries):
+    """
+    Compiles {dconf key: value} into a GVDB file, laid out the way dconf
+    itself writes databases: every directory is an item listing its children.
+    Returns the file contents.
+    """
+    items = {}
+    for key in entries:
+        child = key
+        while child is not None and child not in items:
+            items[child] = _dconf_parent(child)
+            child = items[child]
+
+    n_items = len(items)
+    buckets = [[] for _ in range(n_items)]
+    for key in items:
+        buckets[_gvdb_hash(key) % n_items].append(key)
+    ordered = [key for bucket in buckets for key in bucket]
+    index = {key: position for position, key in enumerate(ordered)}
+    children = {key: [] for key in ordered}
+    for key, parent in items.items():
+        if parent is not None:
+            children[parent].append(index[key])
+
+    data = bytearray(_GVDB_HEADER.size)
+
+    def allocate(alignment, chunk):
+        data.extend(b"\0" * (-len(data) % alignment))
+        start = len(data)
+        data.extend(chunk)
+        return start, len(data)
+
+    table_size = _GVDB_HASH_HEADER.size + 4 * n_items + _GVDB_ITEM.size * n_items
+    table_start, table_end = allocate(4, bytes(table_size))
+    starts = []
+    total = 0
+    for bucket in buckets:
+        starts.append(total)
+        total += len(bucket)
+    _GVDB_HASH_HEADER.pack_into(data, table_start, 0, n_items)
+    struct.pack_into(f"<{n_items}I", data, table_start + _GVDB_HASH_HEADER.size, *starts)
+
+    items_start = table_start + _GVDB_HASH_HEADER.size + 4 * n_items
+    for position, key in enumerate(ordered):
+        parent = items[key]
+        basename = key[len(parent):] if parent is not None else key
+        key_start, key_end = allocate(1, basename.encode())
+        if key in entries:
+            item_type = b"v"
+            value_start, value_end = allocate(8, serialize_gvariant_variant(entries[key]))
+        else:
+            item_type = b"L"
+            value_start, value_end = allocate(4, struct.pack(f"<{len(children[key])}I", *children[key]))
+        _GVDB_ITEM.pack_into(data, items_start + position * _GVDB_ITEM.size,
+                             _gvdb_hash(key), 0xFFFFFFFF if parent is None else index[parent],
+                             key_start, key_end - key_start, item_type, value_start, value_end)
+
+    _GVDB_HEADER.pack_into(data, 0, b"GVariant", 0, 0, table_start, table_end)
+    return bytes(data)
+
+def read_gvdb(data):
+    """
+    Reads the values of a GVDB file written by dconf or build_gvdb().
+    Returns {dconf key: boxed GVariant bytes}, {} for anything unreadable.
+    """
+    try:
+        signature, _, _, table_start, table_end = _GVDB_HEADER.unpack_from(data, 0)
+        if signature != b"GVariant":
+            return {}
+        n_bloom_words, n_buckets = _GVDB_HASH_HEADER.unpack_from(data, table_start)
+        items_start = table_start + _GVDB_HASH_HEADER.size + 4 * ((n_bloom_words & 0x7FFFFFF) + n_buckets)
+        raw_items = [_GVDB_ITEM.unpack_from(data, offset)
+                     for offset in range(items_start, table_end - _GVDB_ITEM.size + 1, _GVDB_ITEM.size)]
+    except struct.error:
+        return {}
+
+    names = {}
+
+    def full_name(position):
+        if position not in names:
+            _, parent, key_start, key_size, _, _, _ = raw_items[position]
+            prefix = full_name(parent) if parent != 0xFFFFFFFF else ""
+            names[position] = prefix + data[key_start:key_start + key_size].decode()
+        return names[position]
+
+    values = {}
+    try:
+        for position, (_, _, _, _, item_type, value_start, value_end) in enumerate(raw_items):
+            if item_type == b"v":
+                values[full_name(position)] = bytes(data[value_start:value_end])
+    except (IndexError, UnicodeDecodeError, RecursionError):
+        return {}
+    return values
+
+def write_dconf_db(path, values, owner=None):
+    """Merges {dconf key: value} into a compiled dconf database."""
+    try:
+        with open(path, "rb") as f:
+            entries = read_gvdb(f.read())
+    except OSError:
+        entries = {}
+    entries.update(values)
+    _write_file(path, build_gvdb(entries), owner)
+
+def write_xfconf_channel(path, channel, properties, owner=None):
+    """Merges {"/property/path": value} into an xfconf channel XML file."""
+    try:
+        root = ElementTree.parse(path).getroot()
+    except (OSError, ElementTree.ParseError):
+        root = ElementTree.Element("channel", name=channel, version="1.0")
+
+    for property_path, value in properties.items():
+        element = root
+        for name in property_path.strip("/").split("/"):
+            child = next((prop for prop in element.findall("property") if prop.get("name") == name), None)
+            if child is None:
+                child = ElementTree.SubElement(element, "property", name=name, type="empty")
+            element = child
+        if isinstance(value, bool):
+            element.set("type", "bool")
+            element.set("value", "true" if value else "false")
+        elif isinstance(value, int):
+            element.set("type", "int")
+            element.set("value", str(value))
+        else:
+            element.set("type", "string")
+            element.set("value", str(value))
+
+    ElementTree.indent(root, space="  ")
+    xml = '<?xml version="1.0" encoding="UTF-8"?>\n\n' + ElementTree.tostring(root, encoding="unicode") + "\n"
+    _write_file(path, xml, owner)
+
+def write_dconf_keyfile(path, values):
+    """Writes {dconf key: value} as a keyfile for a dconf db.d directory."""
+    groups = {}
+    for key, value in values.items():
+        directory, _, name = key.rpartition("/")
+        groups.setdefault(directory.strip("/"), {})[name] = format_gvariant(value)
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    config.read_dict(groups)
+    output = io.StringIO()
+    config.write(output, space_around_delimiters=False)
+    _write_file(path, output.getvalue())
+
+def write_dconf_system_db(root, values, name="local"):
+    """
+    Installs {dconf key: value} as system-wide defaults in the target: the
+    keyfile source, so a later dconf update keeps them, the compiled
+    database, and a user profile that reads it.
+    """
+    write_dconf_keyfile(os.path.join(root, "etc/dconf/db", f"{name}.d", DCONF_KEYFILE), values)
+    write_dconf_db(os.path.join(root, "etc/dconf/db", name), values)
+
+    profile_path = os.path.join(root, "etc/dconf/profile/user")
+    try:
+        with open(profile_path, "r") as f:
+            profile = f.read().splitlines()
+    except OSError:
+        profile = ["user-db:user"]
+    if f"system-db:{name}" not in (line.strip() for line in profile):
+        profile.append(f"system-db:{name}")
+        _write_file(profile_path, "\n".join(profile) + "\n")
+
+def write_theme(home, settings, color_schemes_dir="/usr/share/color-schemes", user_dconf=True):
+    """
+    Writes theme settings straight into the config files under a home
+    directory, in one batch. Needs no session bus and spawns no process.
+    """
+    try:
+        stat = os.stat(home)
+        owner = (stat.st_uid, stat.st_gid)
+    except OSError:
+        owner = None
+    config_dir = os.path.join(home, ".config")
+
+    for filename, groups in settings["ini"].items():
+        if filename == "kdeglobals" and settings.get("color_scheme"):
+            colors = read_color_scheme(os.path.join(color_schemes_dir, f"{settings['color_scheme']}.colors"))
+            groups = {**colors, **groups}
+        write_ini_settings(os.path.join(config_dir, filename), groups, owner)
+    if settings["dconf"] and user_dconf:
+        write_dconf_db(os.path.join(config_dir, "dconf", "user"), settings["dconf"], owner)
+    for channel, properties in settings["xfconf"].items():
+        write_xfconf_channel(os.path.join(config_dir, "xfce4", "xfconf", "xfce-perchannel-xml", f"{channel}.xml"),
+                             channel, properties, owner)
+
+def get_target_homes(root):
+    """Returns the home directories of the regular accounts in the target."""
+    homes = []
+    try:
+        with open(os.path.join(root, TARGET_PASSWD), "r") as f:
+            entries = [line.split(":") for line in f.read().splitlines()]
+    except OSError:
+        return homes
+    for entry in entries:
+        if len(entry) < 6 or not entry[2].isdigit() or not UID_MIN <= int(entry[2]) < UID_MAX:
+            continue
+        home = os.path.join(root, entry[5].lstrip("/"))
+        if entry[5].startswith("/") and os.path.isdir(home):
+            homes.append(home)
+    return homes
+
+def write_target_theme(root, settings):
+    """
+    Writes an edition's theme into the installed system: KDE and XFCE files
+    go to /etc/skel, for new users, and to the homes of the accounts already
+    created; GNOME settings to a dconf system database, which covers both.
+    """
+    color_schemes_dir = os.path.join(root, "usr/share/color-schemes")
+    for home in [os.path.join(root, "etc/skel")] + get_target_homes(root):
+        write_theme(home, settings, color_schemes_dir=color_schemes_dir, user_dconf=False)
+    if settings["dconf"]:
+        write_dconf_system_db(root, settings["dconf"])
+
+def get_chosen_edition():
+    """Returns the edition picked in packagechooser, or None."""
+    chosen = libcalamares.globalstorage.value(PACKAGECHOOSER_KEY)
+    return chosen if chosen in EDITIONS else None
+
+def load_edition_plan(desktop, edition, path=None):
+    """
+    Looks up the compiled plan for an edition on a desktop.
+    Returns {"install", "remove", "theme"}, or None without a usable index.
+    """
+    if path is None:
+        path = os.path.join(libcalamares.job.working_path, EDITIONS_INDEX)
+
+    try:
+        with open(path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        libcalamares.utils.warning(f"Failed to load edition plans: {e}")
+        return None
+
+    if index.get("version") != EDITIONS_INDEX_VERSION:
+        libcalamares.utils.warning(f"Unsupported edition plan version: {index.get('version')}")
+        return None
+    return index.get("plans", {}).get(f"{edition}/{desktop}")
+
+def queue_edition_packages(plan):
+    """Hands the plan's packages to packages_remover through the pacman queue."""
+    queue = list(libcalamares.globalstorage.value("pacman_queue") or [])
+    for action in ("install", "remove"):
+        if plan.get(action):
+            queue.append({"action": action, "packages": plan[action], "source": "edition_chooser"})
+    libcalamares.globalstorage.insert("pacman_queue", queue)
+
+def get_detection_context():
+    """
+    Detects the desktop and edition once. The edition picked in
+    packagechooser wins over the one detected from the live theme. The
+    result is kept in globalstorage, so later calls in the same install
+    reuse it.
+    Returns a DetectionContext.
+    """
+    cached = libcalamares.globalstorage.value("edition_detection")
+    if isinstance(cached, dict):
+        try:
+            return DetectionContext(**cached)
+        except TypeError:
+            pass
+
     desktop = desktop_version()
-    edition = get_edition_version()
+    edition = get_chosen_edition()
+    if edition is None:
+        edition = get_edition_version(desktop) if desktop else "pure"
+    context = DetectionContext(desktop=desktop, edition=edition)
+    if desktop:
+        libcalamares.globalstorage.insert("edition_detection", asdict(context))
+    return context
+
+def set_system_theme(context=None, plan=None):
+    """
+    Sets the theme of the installed system based on the chosen edition and
+    desktop environment, plus the theme settings of its edition plan.
+    """
+    if context is None:
+        context = get_detection_context()
+    desktop = context.desktop
+    edition = context.edition
     theme_config = libcalamares.globalstorage.value("theme_config")
+    root = libcalamares.globalstorage.value("rootMountPoint")
     
     if not theme_config:
         libcalamares.utils.warning("No theme configuration found in global storage")
         return
     
-    try:
-        if desktop == "kde":
-            _set_kde_theme(edition, theme_config)
-        elif desktop == "gnome":
-            _set_gnome_theme(edition, theme_config)
-        elif desktop == "xfce":
-            _set_xfce_theme(edition, theme_config)
-        else:
-            libcalamares.utils.warning(f"Unsupported desktop environment: {desktop}")
-    except Exception as e:
-        libcalamares.utils.warning(f"Error setting system theme: {e}")
+    if not root:
+        libcalamares.utils.warning("No install path specified, not setting the theme")
+        return
 
-def _set_kde_theme(edition, theme_config):
-    """Helper function to set KDE theme."""
-    try:
-        if edition == "pure":
-            theme = "org.kde.breeze.desktop"
-            if theme_config.get("dark", False):
-                theme = "org.kde.breezedark.desktop"
-            subprocess.run(["lookandfeeltool", "--apply", theme], check=True)
-        else:
-            style = "Qogirlight"
-            window_decoration = "__aurorae__svg__Qogir-light-circle"
-            if theme_config.get("dark", False):
-                style = "Qogirdark"
-                window_decoration = "__aurorae__svg__Qogir-dark-circle"
-            
-            home = os.getenv("HOME")
-            cmd = f"plasma-apply-colorscheme {style} && kwriteconfig6 --file {home}/.config/kwinrc --group org.kde.kdecoration2 --key theme {window_decoration} && qdbus6 org.kde.KWin /KWin reconfigure"
-            subprocess.run(["sh", "-c", cmd], check=True)
-    except subprocess.CalledProcessError as e:
-        libcalamares.utils.warning(f"Error setting KDE theme: {e}")
-
-def _set_gnome_theme(edition, theme_config):
-    """Helper function to set GNOME theme."""
-    try:
-        if edition == "pure":
-            style = "prefer-dark" if theme_config.get("dark", False) else "prefer-light"
-            subprocess.run(["gsettings", "set", "org.gnome.desktop.interface", "color-scheme", style], check=True)
-        else:
-            style = "prefer-dark" if theme_config.get("dark", False) else "prefer-light"
-            shell = "Orchis-Red-Dark" if theme_config.get("dark", False) else "Orchis-Light"
-            cmd = f"gsettings set org.gnome.desktop.interface color-scheme {style} && gsettings set org.gnome.shell.extensions.user-theme name {shell}"
-            subprocess.run(["sh", "-c", cmd], check=True)
-    except subprocess.CalledProcessError as e:
-        libcalamares.utils.warning(f"Error setting GNOME theme: {e}")
-
-def _set_xfce_theme(edition, theme_config):
-    """Helper function to set XFCE theme."""
+    if desktop not in ("kde", "gnome", "xfce"):
+        libcalamares.utils.warning(f"Unsupported desktop environment: {desktop}")
+        return
+
+    dark = theme_config.get("dark", False)
+    overrides = (plan or {}).get("theme", {}).get("dark" if dark else "light")
     try:
-        if edition == "pure":
-            style = "Adwaita-dark" if theme_config.get("dark", False) else "Adwaita"
-        else:
-            style = "Qogir-Dark" if theme_config.get("dark", False) else "Qogir-Light"
-        
-        cmd = f"xfconf-query -c xsettings -p /Net/ThemeName -s {style} && xfconf-query -c xfwm4 -p /general/theme -s {style}"
-        subprocess.run(["sh", "-c", cmd], check=True)
-    except subprocess.CalledProcessError as e:
-        libcalamares.utils.warning(f"Error setting XFCE theme: {e}")
+        write_target_theme(root, get_theme_settings(desktop, edition, dark, overrides))
+    except (OSError, TypeError, ValueError, configparser.Error) as e:
+        libcalamares.utils.warning(f"Error setting system theme: {e}")
 
 def run():
     """
     Main entry point for the edition chooser module.
-    Sets up the system according to the chosen edition.
+    Sets up the system according to the chosen edition, in two steps: the
+    "packages" instance queues the edition's packages for packages_remover,
+    the "theme" instance runs after it and themes the installed system.
     """
-    # Get current desktop environment
-    desktop = desktop_version()
+    step = alg_runner.get_config("step", "packages")
+    if step not in STEPS:
+        return f"Unknown edition_chooser step: {step}", False
+
+    # Detect desktop environment and edition once for the whole run
+    context = get_detection_context()
+    desktop = context.desktop
     if not desktop:
         return "Failed to determine desktop environment", False
 
-    # Get edition type
-    edition = get_edition_version()
+    edition = context.edition
     libcalamares.utils.debug(f"Detected desktop: {desktop}, edition: {edition}")
 
     # Store values in global storage for other modules
     libcalamares.globalstorage.insert("desktop_environment", desktop)
     libcalamares.globalstorage.insert("edition_type", edition)
 
-    # Set system theme
-    try:
-        set_system_theme()
-    except Exception as e:
-        return f"Failed to set system theme: {e}", False
+    plan = load_edition_plan(desktop, edition)
+    if step == "packages":
+        # Queue the edition's packages for packages_remover's transactions
+        if plan is not None:
+            queue_edition_packages(plan)
+    else:
+        # Theme the system now that the edition's theme packages are installed
+        try:
+            set_system_theme(context, plan)
+        except Exception as e:
+            return f"Failed to set system theme: {e}", False
 
+    alg_runner.publish("edition_chooser")
     return None
\ No newline at end of file
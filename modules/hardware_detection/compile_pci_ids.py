@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+ALG Custom Install Module - Hardware Detection
+Build step that compiles pci.ids into the sorted binary index read by
+hardware_detection at install time. Run it while building the ISO:
+
+    python3 compile_pci_ids.py /usr/share/hwdata/pci.ids pci-ids.idx
+
+Layout (little endian):
+    header      "ALGPCI01", vendor count, device count, subsystem count,
+                offset of the string table (uint32 each)
+    vendors     (uint32 vendor, uint32 name offset), sorted
+    devices     (uint32 vendor << 16 | device, uint32 name offset), sorted
+    subsystems  (uint64 vendor << 48 | device << 32 | subvendor << 16 | subdevice,
+                uint32 name offset), sorted
+    strings     NUL-terminated UTF-8 names
+"""
+
+import struct
+import sys
+
+MAGIC = b"ALGPCI01"
+HEADER = struct.Struct("<8s4I")
+VENDOR_RECORD = struct.Struct("<II")
+DEVICE_RECORD = struct.Struct("<II")
+SUBSYSTEM_RECORD = struct.Struct("<QI")
+
+def parse_pci_ids(lines):
+    """
+    Parses pci.ids text into three dicts keyed by the packed ids:
+    vendors, devices and subsystems, each mapping to the name.
+    """
+    vendors, devices, subsystems = {}, {}, {}
+    vendor = device = None
+
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        # The device class list follows the vendors, we do not need it
+        if line.startswith("C "):
+            break
+
+        if line.startswith("\t\t"):
+            ids, _, name = line.strip().partition("  ")
+            subvendor, subdevice = ids.split()
+            if vendor is not None and device is not None:
+                key = (vendor << 48) | (device << 32) | (int(subvendor, 16) << 16) | int(subdevice, 16)
+                subsystems[key] = name.strip()
+        elif line.startswith("\t"):
+            ids, _, name = line.strip().partition("  ")
+            device = int(ids, 16)
+            devices[(vendor << 16) | device] = name.strip()
+        else:
+            ids, _, name = line.strip().partition("  ")
+            vendor = int(ids, 16)
+            device = None
+            vendors[vendor] = name.strip()
+
+    return vendors, devices, subsystems
+
+def build_index(vendors, devices, subsystems):
+    """Serializes the parsed tables into the binary index format."""
+    strings = bytearray()
+    offsets = {}
+
+    def string_offset(name):
+        if name not in offsets:
+            offsets[name] = len(strings)
+            strings.extend(name.encode("utf-8") + b"\0")
+        return offsets[name]
+
+    tables = bytearray()
+    for table, record in ((vendors, VENDOR_RECORD), (devices, DEVICE_RECORD), (subsystems, SUBSYSTEM_RECORD)):
+        for key in sorted(table):
+            tables.extend(record.pack(key, string_offset(table[key])))
+
+    header = HEADER.pack(MAGIC, len(vendors), len(devices), len(subsystems), HEADER.size + len(tables))
+    return header + bytes(tables) + bytes(strings)
+
+def main(argv):
+    if len(argv) != 3:
+        print(f"usage: {argv[0]} <pci.ids> <output index>", file=sys.stderr)
+        return 1
+
+    with open(argv[1], "r", encoding="utf-8", errors="replace") as f:
+        vendors, devices, subsystems = parse_pci_ids(f)
+
+    with open(argv[2], "wb") as f:
+        f.write(build_index(vendors, devices, subsystems))
+
+    print(f"{len(vendors)} vendors, {len(devices)} devices, {len(subsystems)} subsystems")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
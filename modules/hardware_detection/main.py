@@ -6,114 +6,659 @@ This file is part of the ALG project and is
 meant to be shipped with calamares.
 """
 
-import subprocess
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+import functools
+from dataclasses import dataclass, asdict
+from typing import Optional
 import libcalamares
+import alg_runner
 
-def get_nvidia_gpu_info():
+PCI_DEVICES_PATH = "/sys/bus/pci/devices"
+
+BLOCK_DEVICES_PATH = "/sys/block"
+
+# Hybrid CPUs expose one PMU per core type under /sys/devices
+CPU_DEVICES_PATH = "/sys/devices"
+
+CPUINFO_PATH = "/proc/cpuinfo"
+
+CMDLINE_PATH = "/proc/cmdline"
+
+MEMINFO_PATH = "/proc/meminfo"
+
+EFI_FIRMWARE_PATH = "/sys/firmware/efi"
+
+# /proc/cpuinfo flags each x86-64 microarchitecture level adds, as defined
+# by the x86-64 psABI. The kernel names SSE3 "pni" and LZCNT "abm".
+X86_64_LEVEL_FLAGS = [
+    (2, {"cx16", "lahf_lm", "popcnt", "pni", "sse4_1", "sse4_2", "ssse3"}),
+    (3, {"avx", "avx2", "bmi1", "bmi2", "f16c", "fma", "abm", "movbe", "xsave"}),
+    (4, {"avx512f", "avx512bw", "avx512cd", "avx512dq", "avx512vl"}),
+]
+
+# Seconds each hardware probe may take before its fallback value is used
+PROBE_TIMEOUT = 5.0
+
+NVIDIA_VENDOR_ID = "10de"
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+# Snapshots are only valid for the boot they were taken in
+SNAPSHOT_CACHE_DIR = "/run/alg-installer"
+
+# Binary pci.ids index produced by compile_pci_ids.py at ISO build time
+PCI_IDS_INDEX = "pci-ids.idx"
+PCI_IDS_MAGIC = b"ALGPCI01"
+_PCI_IDS_HEADER = struct.Struct("<8s4I")
+_PCI_IDS_VENDOR = struct.Struct("<II")
+_PCI_IDS_DEVICE = struct.Struct("<II")
+_PCI_IDS_SUBSYSTEM = struct.Struct("<QI")
+
+@dataclass(frozen=True, slots=True)
+class PciDevice:
+    """A PCI device as seen in sysfs. Ids are bare lowercase hex strings."""
+    slot: str
+    pci_class: str
+    vendor: str
+    device: str
+    subsystem_vendor: str
+    subsystem_device: str
+    driver: Optional[str]
+
+@dataclass(frozen=True, slots=True)
+class BlockDevice:
     """
-    Detects NVIDIA GPU and returns its information.
-    Sets empty list if no NVIDIA GPU is found.
+    A physical disk as seen in /sys/block. kind is "nvme", "ssd" or "hdd";
+    queue_depth is the device's command queue depth where it reports one,
+    else the block layer's request queue size.
+    """
+    name: str
+    rotational: bool
+    removable: bool
+    size_bytes: int
+    kind: str
+    discard: bool
+    queue_depth: int
+
+@dataclass(frozen=True, slots=True)
+class CpuInfo:
+    """
+    The CPU as seen in /proc/cpuinfo. x86_64_level is 0 on other
+    architectures; the core type counts are 0 unless the CPU is hybrid.
+    """
+    vendor: str
+    model_name: str
+    x86_64_level: int
+    cores: int
+    threads: int
+    performance_cores: int = 0
+    efficiency_cores: int = 0
+
+@dataclass(frozen=True, slots=True)
+class HardwareSnapshot:
+    """Every hardware fact the installer needs, gathered in one pass."""
+    boot_id: str
+    pci_devices: tuple
+    cpu: CpuInfo
+    cmdline: str
+    firmware_type: str
+    memory_total_kib: int
+    swap_total_kib: int
+    block_devices: tuple
+
+def _read_sysfs_attr(device_path, attr):
+    """Reads a sysfs attribute, returns "" if it is missing."""
+    try:
+        with open(os.path.join(device_path, attr), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def _read_sysfs_id(device_path, attr):
+    """Reads a hex id attribute ("0x10de") as a bare lowercase string ("10de")."""
+    value = _read_sysfs_attr(device_path, attr).lower()
+    return value[2:] if value.startswith("0x") else value
+
+def scan_pci_devices(path=PCI_DEVICES_PATH):
+    """
+    Walks /sys/bus/pci/devices once.
+    Returns a PciDevice with the slot, class, vendor, device and
+    subsystem ids of every PCI device and its bound kernel driver.
     """
-    nvidia_gpu_info = []
+    pci_devices = []
     try:
-        lspci_output = subprocess.run(
-            "LANG=C lspci | grep -i nvidia",
-            capture_output=True, shell=True, text=True, check=True
-        )
+        slots = sorted(os.listdir(path))
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to scan PCI devices: {e}")
+        return pci_devices
 
-        for line in lspci_output.stdout.split("\n"):
-            if line.strip().startswith("01:00.0 VGA compatible controller"):
-                nvidia_gpu_info.append(line.split(":")[1].strip())
+    for slot in slots:
+        device_path = os.path.join(path, slot)
+        driver_link = os.path.join(device_path, "driver")
+        pci_devices.append(PciDevice(
+            slot=slot,
+            pci_class=_read_sysfs_id(device_path, "class"),
+            vendor=_read_sysfs_id(device_path, "vendor"),
+            device=_read_sysfs_id(device_path, "device"),
+            subsystem_vendor=_read_sysfs_id(device_path, "subsystem_vendor"),
+            subsystem_device=_read_sysfs_id(device_path, "subsystem_device"),
+            driver=os.path.basename(os.readlink(driver_link)) if os.path.islink(driver_link) else None,
+        ))
 
-        if not nvidia_gpu_info:
-            libcalamares.utils.debug("No NVIDIA GPU information found.")
+    return pci_devices
 
-    except subprocess.CalledProcessError:
+def get_display_devices(pci_devices):
+    """Returns the display-class (VGA, 3D, other display) devices."""
+    return [device for device in pci_devices if device.pci_class.startswith("03")]
+
+def open_pci_ids_index(path=None):
+    """
+    Memory-maps the compiled pci.ids index.
+    Returns the mmap, or None when the index is missing or invalid.
+    """
+    if path is None:
+        path = os.path.join(libcalamares.job.working_path, PCI_IDS_INDEX)
+
+    try:
+        with open(path, "rb") as f:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        libcalamares.utils.debug(f"No pci.ids index available: {e}")
+        return None
+
+    if index.size() < _PCI_IDS_HEADER.size or index[:len(PCI_IDS_MAGIC)] != PCI_IDS_MAGIC:
+        libcalamares.utils.warning(f"Invalid pci.ids index: {path}")
+        index.close()
+        return None
+    return index
+
+def _search_pci_ids(index, table_offset, count, record, key):
+    """Binary-searches one sorted table of the index, returns the name or None."""
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        entry_key, name_offset = record.unpack_from(index, table_offset + middle * record.size)
+        if entry_key < key:
+            low = middle + 1
+        elif entry_key > key:
+            high = middle
+        else:
+            strings_offset = _PCI_IDS_HEADER.unpack_from(index)[4]
+            start = strings_offset + name_offset
+            return index[start:index.find(b"\0", start)].decode("utf-8", errors="replace")
+    return None
+
+def lookup_pci_names(index, device):
+    """
+    Looks up the vendor, device and subsystem names of a PciDevice in the
+    compiled pci.ids index in O(log n). Missing names are returned as None.
+    """
+    _, n_vendors, n_devices, n_subsystems, _ = _PCI_IDS_HEADER.unpack_from(index)
+    vendors_offset = _PCI_IDS_HEADER.size
+    devices_offset = vendors_offset + n_vendors * _PCI_IDS_VENDOR.size
+    subsystems_offset = devices_offset + n_devices * _PCI_IDS_DEVICE.size
+
+    try:
+        vendor, dev = int(device.vendor, 16), int(device.device, 16)
+        subvendor, subdevice = int(device.subsystem_vendor or "0", 16), int(device.subsystem_device or "0", 16)
+    except ValueError:
+        return None, None, None
+
+    return (
+        _search_pci_ids(index, vendors_offset, n_vendors, _PCI_IDS_VENDOR, vendor),
+        _search_pci_ids(index, devices_offset, n_devices, _PCI_IDS_DEVICE, (vendor << 16) | dev),
+        _search_pci_ids(index, subsystems_offset, n_subsystems, _PCI_IDS_SUBSYSTEM,
+                        (vendor << 48) | (dev << 32) | (subvendor << 16) | subdevice),
+    )
+
+def get_device_name(device, pci_ids=None):
+    """
+    Returns a human-readable name for a PciDevice, in lspci style
+    ("NVIDIA Corporation GA104 [GeForce RTX 3070]"). Falls back to the
+    bare ids when the index is unavailable or does not know the device.
+    """
+    vendor_name = device_name = None
+    if pci_ids is not None:
+        vendor_name, device_name, _ = lookup_pci_names(pci_ids, device)
+
+    if vendor_name is None and device.vendor == NVIDIA_VENDOR_ID:
+        vendor_name = "NVIDIA Corporation"
+    return f"{vendor_name or 'Vendor ' + device.vendor} {device_name or 'Device ' + device.device}"
+
+def get_gpu_names(pci_devices, pci_ids=None):
+    """Returns the names of all display devices."""
+    return [get_device_name(device, pci_ids) for device in get_display_devices(pci_devices)]
+
+def get_nvidia_gpu_info(pci_devices=None, pci_ids=None):
+    """
+    Detects NVIDIA GPUs on every PCI bus and returns their information.
+    Sets empty list if no NVIDIA GPU is found.
+    """
+    if pci_devices is None:
+        pci_devices = scan_pci_devices()
+
+    nvidia_gpu_info = [
+        get_device_name(device, pci_ids)
+        for device in get_display_devices(pci_devices)
+        if device.vendor == NVIDIA_VENDOR_ID
+    ]
+
+    if not nvidia_gpu_info:
         libcalamares.utils.debug("No NVIDIA GPU detected")
-    except Exception as e:
-        libcalamares.utils.warning(f"An unexpected error occurred while detecting NVIDIA GPU: {e}")
 
     return nvidia_gpu_info
 
-def get_gpu_driver_name():
+def get_gpu_driver_name(pci_devices=None):
     """
     Detects current GPU drivers in use.
     Returns a list of active GPU drivers.
     """
-    gpu_drivers = []
-    try:
-        lspci_output = subprocess.run(
-            "LANG=C lspci -k | grep -EA3 'VGA|3D|Display'",
-            capture_output=True, shell=True, text=True
-        )
+    if pci_devices is None:
+        pci_devices = scan_pci_devices()
+
+    return [device.driver for device in get_display_devices(pci_devices) if device.driver]
+
+def get_x86_64_level(flags):
+    """Returns the highest x86-64 level (1-4) the given cpuinfo flags support."""
+    if "lm" not in flags:
+        return 0
+
+    level = 1
+    for candidate, required in X86_64_LEVEL_FLAGS:
+        if not required <= flags:
+            break
+        level = candidate
+    return level
+
+def _count_cpu_list(cpu_list):
+    """Counts the CPUs in a sysfs cpu list such as "0-15,20"."""
+    count = 0
+    for part in cpu_list.split(","):
+        first, _, last = part.partition("-")
+        if first:
+            count += int(last or first) - int(first) + 1
+    return count
 
-        for line in lspci_output.stdout.split("\n"):
-            if line.strip().startswith("Kernel driver in use:"):
-                gpu_drivers.append(line.split(":")[1].strip())
+def get_hybrid_layout(path=CPU_DEVICES_PATH):
+    """
+    Counts the logical CPUs of each core type on a hybrid CPU.
+    Returns (performance, efficiency), or (0, 0) on a uniform CPU.
+    """
+    counts = []
+    for pmu in ("cpu_core", "cpu_atom"):
+        try:
+            with open(os.path.join(path, pmu, "cpus"), "r") as cpus_file:
+                counts.append(_count_cpu_list(cpus_file.read().strip()))
+        except (OSError, ValueError):
+            return 0, 0
+    return tuple(counts)
 
-    except subprocess.CalledProcessError as cpe:
-        libcalamares.utils.warning(f"Failed to get GPU drivers with error: {cpe.output}")
+def get_cpu_info(path=CPUINFO_PATH, devices_path=CPU_DEVICES_PATH):
+    """
+    Reads vendor, model, flags and topology from /proc/cpuinfo in one pass.
+    Returns a CpuInfo.
+    """
+    vendor = "Unknown"
+    model_name = ""
+    flags = set()
+    threads = 0
+    cores = set()
+    physical_id = core_id = None
+    try:
+        with open(path, "r") as cpuinfo_file:
+            for line in cpuinfo_file:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                value = value.strip()
+                if key == "processor":
+                    threads += 1
+                    physical_id = core_id = None
+                elif key == "vendor_id" and vendor == "Unknown":
+                    vendor = value
+                elif key == "model name" and not model_name:
+                    model_name = value
+                elif key == "flags" and not flags:
+                    flags = set(value.split())
+                elif key == "physical id":
+                    physical_id = value
+                elif key == "core id":
+                    core_id = value
+                    cores.add((physical_id, core_id))
     except Exception as e:
-        libcalamares.utils.warning(f"Failed to parse GPU driver information: {e}")
+        libcalamares.utils.warning(f"Failed to read CPU information: {e}")
 
-    return gpu_drivers
+    performance, efficiency = get_hybrid_layout(devices_path)
+    return CpuInfo(
+        vendor=vendor,
+        model_name=model_name,
+        x86_64_level=get_x86_64_level(flags),
+        cores=len(cores) or threads,
+        threads=threads,
+        performance_cores=performance,
+        efficiency_cores=efficiency,
+    )
 
 def get_cpu_type():
     """
     Detects CPU vendor (Intel/AMD).
     Returns the CPU vendor ID string.
     """
+    return get_cpu_info().vendor
+
+def get_kernel_cmdline(path=CMDLINE_PATH):
+    """Returns the raw kernel command line, or "" if it cannot be read."""
     try:
-        with open('/proc/cpuinfo', 'r') as cpuinfo_file:
-            for line in cpuinfo_file:
-                if line.startswith('vendor_id'):
-                    return line.split(':')[1].strip()
+        with open(path, "r") as cmdline_file:
+            return cmdline_file.read().strip()
     except Exception as e:
-        libcalamares.utils.warning(f"Failed to detect CPU type: {e}")
-        return "Unknown"
-    
-    return "Unknown"
+        libcalamares.utils.warning(f"Failed to read kernel command line: {e}")
+        return ""
+
+def get_firmware_type(path=EFI_FIRMWARE_PATH):
+    """Returns "efi" when booted through UEFI, "bios" otherwise."""
+    return "efi" if os.path.isdir(path) else "bios"
 
-def get_iso_bootmode(param, default=None):
+@functools.lru_cache(maxsize=None)
+def parse_kernel_cmdline(cmdline):
     """
-    Reads kernel boot parameters from /proc/cmdline
-    Returns the value of the specified parameter or default if not found
+    Parses a kernel command line into a {param: value} mapping.
+    Follows the kernel's own rules: double quotes group whitespace and are
+    stripped, a value is everything after the first "=", bare flags map
+    to None, a repeated param keeps its last value and everything after
+    "--" belongs to init.
+    The result is memoized per cmdline string; treat it as read-only.
     """
-    try:
-        with open("/proc/cmdline", "r") as kernel_boot_mode:
-            for cmd_param in kernel_boot_mode.read().split():
-                if cmd_param.startswith(f"{param}="):
-                    return cmd_param.split("=")[1]
-                elif cmd_param == param:
-                    return param
-    except Exception as e:
-        libcalamares.utils.warning(f"Failed to read kernel boot mode: {e}")
+    params = {}
+    args = []
+    current = []
+    in_quote = False
+    started = False
+    for char in cmdline:
+        if char == '"':
+            in_quote = not in_quote
+            started = True
+        elif char.isspace() and not in_quote:
+            if started:
+                args.append("".join(current))
+            current = []
+            started = False
+        else:
+            current.append(char)
+            started = True
+    if started:
+        args.append("".join(current))
+
+    for arg in args:
+        if arg == "--":
+            break
+        key, sep, value = arg.partition("=")
+        params[key] = value if sep else None
+
+    return params
+
+def get_iso_bootmode(param, default=None, cmdline=None):
+    """
+    Looks up a kernel boot parameter in /proc/cmdline, or in the given
+    cmdline string.
+    Returns the value of the specified parameter, the parameter name for
+    a bare flag, or default if not found
+    """
+    if cmdline is None:
+        cmdline = get_kernel_cmdline()
+    params = parse_kernel_cmdline(cmdline)
+    if param not in params:
         return default
-    
-    return default
+    value = params[param]
+    return param if value is None else value
+
+def get_boot_id():
+    """Returns the kernel's random boot id, or "" if it cannot be read."""
+    try:
+        with open(BOOT_ID_PATH, "r") as boot_id_file:
+            return boot_id_file.read().strip()
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to read boot id: {e}")
+        return ""
+
+def get_memory_info(path=MEMINFO_PATH):
+    """
+    Reads total RAM and swap from /proc/meminfo.
+    Returns (mem_total_kib, swap_total_kib).
+    """
+    values = {}
+    try:
+        with open(path, "r") as meminfo_file:
+            for line in meminfo_file:
+                key, _, value = line.partition(":")
+                if key in ("MemTotal", "SwapTotal"):
+                    values[key] = int(value.split()[0])
+    except (OSError, ValueError, IndexError) as e:
+        libcalamares.utils.warning(f"Failed to read memory information: {e}")
+
+    return values.get("MemTotal", 0), values.get("SwapTotal", 0)
+
+def get_block_devices(path=BLOCK_DEVICES_PATH):
+    """
+    Lists the physical disks in /sys/block.
+    Virtual devices (loop, zram, device-mapper, ...) have no device link
+    and are skipped.
+    """
+    block_devices = []
+    try:
+        names = sorted(os.listdir(path))
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to scan block devices: {e}")
+        return block_devices
+
+    for name in names:
+        device_path = os.path.join(path, name)
+        if not os.path.exists(os.path.join(device_path, "device")):
+            continue
+        sectors = _read_sysfs_attr(device_path, "size")
+        rotational = _read_sysfs_attr(device_path, "queue/rotational") == "1"
+        if name.startswith("nvme"):
+            kind = "nvme"
+        else:
+            kind = "hdd" if rotational else "ssd"
+        queue_depth = (_read_sysfs_attr(device_path, "device/queue_depth")
+                       or _read_sysfs_attr(device_path, "queue/nr_requests"))
+        block_devices.append(BlockDevice(
+            name=name,
+            rotational=rotational,
+            removable=_read_sysfs_attr(device_path, "removable") == "1",
+            # sysfs counts 512-byte sectors regardless of the logical block size
+            size_bytes=int(sectors) * 512 if sectors.isdigit() else 0,
+            kind=kind,
+            discard=_read_sysfs_attr(device_path, "queue/discard_max_bytes") not in ("", "0"),
+            queue_depth=int(queue_depth) if queue_depth.isdigit() else 0,
+        ))
+
+    return block_devices
+
+def run_probes(probes, timeout=PROBE_TIMEOUT):
+    """
+    Runs hardware probes concurrently, one daemon thread each.
+    probes maps a name to (function, fallback). Every probe gets the same
+    deadline; a probe that fails or misses it yields its fallback, so a
+    hung probe cannot stall the module. Returns (results, timings) where
+    timings maps each name to {"seconds", "status"}.
+    """
+    finished = {}
+    lock = threading.Lock()
+
+    def worker(name, function):
+        start = time.monotonic()
+        try:
+            value, status = function(), "ok"
+        except Exception as e:
+            libcalamares.utils.warning(f"Hardware probe {name} failed: {e}")
+            value, status = None, "error"
+        with lock:
+            finished[name] = (value, status, round(time.monotonic() - start, 3))
+
+    threads = []
+    for name, (function, _) in probes.items():
+        thread = threading.Thread(target=worker, args=(name, function), name=f"probe-{name}", daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+    results, timings = {}, {}
+    with lock:
+        for name, (_, fallback) in probes.items():
+            if name in finished:
+                value, status, seconds = finished[name]
+            else:
+                libcalamares.utils.warning(f"Hardware probe {name} timed out after {timeout}s")
+                value, status, seconds = None, "timeout", timeout
+            results[name] = fallback if status != "ok" else value
+            timings[name] = {"seconds": seconds, "status": status}
+
+    return results, timings
+
+def take_snapshot(boot_id, timeout=PROBE_TIMEOUT, root="/"):
+    """
+    Probes the hardware once, all probes in parallel.
+    Every path is read under root, so a machine recorded with
+    record_hardware.py can be replayed from a directory.
+    Returns (HardwareSnapshot, probe timings).
+    """
+    def under_root(path):
+        return os.path.join(root, path.lstrip("/"))
+
+    results, timings = run_probes({
+        "gpu": (functools.partial(scan_pci_devices, under_root(PCI_DEVICES_PATH)), []),
+        "cpu": (functools.partial(get_cpu_info, under_root(CPUINFO_PATH), under_root(CPU_DEVICES_PATH)),
+                CpuInfo("Unknown", "", 0, 0, 0)),
+        "cmdline": (functools.partial(get_kernel_cmdline, under_root(CMDLINE_PATH)), ""),
+        "firmware": (functools.partial(get_firmware_type, under_root(EFI_FIRMWARE_PATH)), "bios"),
+        "memory": (functools.partial(get_memory_info, under_root(MEMINFO_PATH)), (0, 0)),
+        "storage": (functools.partial(get_block_devices, under_root(BLOCK_DEVICES_PATH)), []),
+    }, timeout)
+
+    snapshot = HardwareSnapshot(
+        boot_id=boot_id,
+        pci_devices=tuple(results["gpu"]),
+        cpu=results["cpu"],
+        cmdline=results["cmdline"],
+        firmware_type=results["firmware"],
+        memory_total_kib=results["memory"][0],
+        swap_total_kib=results["memory"][1],
+        block_devices=tuple(results["storage"]),
+    )
+    return snapshot, timings
+
+def snapshot_path(boot_id, cache_dir=SNAPSHOT_CACHE_DIR):
+    """Returns the cache file of the snapshot for the given boot."""
+    return os.path.join(cache_dir, f"hardware-{boot_id}.json")
+
+def save_snapshot(snapshot, cache_dir=SNAPSHOT_CACHE_DIR):
+    """
+    Serializes the snapshot to its cache file.
+    Returns the path written, or None on failure.
+    """
+    if not snapshot.boot_id:
+        return None
+
+    path = snapshot_path(snapshot.boot_id, cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(asdict(snapshot), f)
+        return path
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to cache hardware snapshot: {e}")
+        return None
+
+def load_snapshot(boot_id, cache_dir=SNAPSHOT_CACHE_DIR):
+    """
+    Loads the snapshot cached for this boot.
+    Returns None when there is no usable snapshot.
+    """
+    if not boot_id:
+        return None
+
+    try:
+        with open(snapshot_path(boot_id, cache_dir), "r") as f:
+            data = json.load(f)
+        data["pci_devices"] = tuple(PciDevice(**device) for device in data["pci_devices"])
+        data["block_devices"] = tuple(BlockDevice(**device) for device in data["block_devices"])
+        data["cpu"] = CpuInfo(**data["cpu"])
+        snapshot = HardwareSnapshot(**data)
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+    return snapshot if snapshot.boot_id == boot_id else None
 
 def run():
     """
     Main entry point for the hardware detection module.
     Detects hardware configurations and stores them in global storage.
     """
+    replay_root = alg_runner.get_config("replayRoot")
+    if replay_root:
+        # A replayed machine is not this boot's hardware, keep it out of the cache
+        libcalamares.utils.debug(f"Replaying hardware from {replay_root}")
+        boot_id = ""
+        snapshot = None
+    else:
+        # Reuse the snapshot of this boot if an earlier run already probed the hardware
+        boot_id = get_boot_id()
+        snapshot = load_snapshot(boot_id)
+    if snapshot is None:
+        snapshot, timings = take_snapshot(boot_id, root=replay_root or "/")
+        # Do not pin fallback values from failed probes for the rest of the boot
+        if all(timing["status"] == "ok" for timing in timings.values()):
+            cache_path = save_snapshot(snapshot)
+        else:
+            cache_path = None
+        libcalamares.globalstorage.insert("hardware_probe_timings", timings)
+        libcalamares.utils.debug(f"Hardware probe timings: {timings}")
+    else:
+        libcalamares.utils.debug("Loaded hardware snapshot from cache")
+        cache_path = snapshot_path(boot_id)
+
     # Detect hardware information
-    nvidia_info = get_nvidia_gpu_info()
-    gpu_drivers = get_gpu_driver_name()
-    cpu_type = get_cpu_type()
-    kernel_boot_mode = get_iso_bootmode("driver", "free")  # default to free drivers
+    pci_ids = open_pci_ids_index()
+    gpu_devices = get_display_devices(snapshot.pci_devices)
+    gpu_names = get_gpu_names(snapshot.pci_devices, pci_ids)
+    nvidia_info = get_nvidia_gpu_info(snapshot.pci_devices, pci_ids)
+    if pci_ids is not None:
+        pci_ids.close()
+    gpu_drivers = get_gpu_driver_name(snapshot.pci_devices)
+    cpu_type = snapshot.cpu.vendor
+    kernel_boot_mode = get_iso_bootmode("driver", "free", snapshot.cmdline)  # default to free drivers
 
     # Store all hardware information in global storage
     gs = libcalamares.globalstorage
+    gs.insert("hardware_snapshot", cache_path)
+    gs.insert("gpu_devices", [asdict(device) for device in gpu_devices])
+    gs.insert("gpu_names", gpu_names)
     gs.insert("nvidia_gpu_name", nvidia_info)
     gs.insert("gpuDrivers", gpu_drivers)
     gs.insert("kernel_boot_mode", kernel_boot_mode)
+    gs.insert("kernel_cmdline", dict(parse_kernel_cmdline(snapshot.cmdline)))
     gs.insert("cpu_vendor", cpu_type)
+    gs.insert("cpu_info", asdict(snapshot.cpu))
+    gs.insert("memory_total_kib", snapshot.memory_total_kib)
+    gs.insert("swap_total_kib", snapshot.swap_total_kib)
+    gs.insert("block_devices", [asdict(device) for device in snapshot.block_devices])
 
     # Log detected hardware information
     libcalamares.utils.debug(f"Detected CPU vendor: {cpu_type}")
+    libcalamares.utils.debug(f"Detected CPU: {snapshot.cpu}")
+    libcalamares.utils.debug(f"Detected GPUs: {gpu_names}")
     libcalamares.utils.debug(f"Detected GPU drivers: {gpu_drivers}")
     libcalamares.utils.debug(f"Detected NVIDIA GPU: {nvidia_info}")
     libcalamares.utils.debug(f"Kernel boot mode: {kernel_boot_mode}")
 
+    alg_runner.publish("hardware_detection")
     return None
\ No newline at end of file
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+ALG Custom Install Module - Hardware Detection
+Records the files hardware_detection reads on a machine into a fixture
+archive, and replays a recorded machine into a directory that
+hardware_detection can use as its root (see replayRoot):
+
+    python3 record_hardware.py record fleet.jsonl.gz optimus-laptop
+    python3 record_hardware.py replay fleet.jsonl.gz optimus-laptop /tmp/optimus
+    python3 record_hardware.py list fleet.jsonl.gz
+
+An archive holds one profile per line, as JSON (gzip-compressed when the
+name ends in .gz; recording appends a gzip member):
+    {"name": "optimus-laptop",
+     "files": {"proc/cpuinfo": "...", "sys/bus/pci/devices/0000:01:00.0/vendor": "0x10de\\n", ...},
+     "links": {"sys/bus/pci/devices/0000:01:00.0/driver": "../../../bus/pci/drivers/nvidia"},
+     "dirs": ["sys/firmware/efi", ...],
+     "lspci": "<lspci -vmmnkD output>"}
+Only the attributes hardware_detection reads are kept. A profile may also
+carry an "expect" mapping of facts the tests check the replay against.
+"""
+
+import os
+import sys
+import gzip
+import json
+import subprocess
+
+PROC_FILES = ("proc/cpuinfo", "proc/cmdline", "proc/meminfo")
+PCI_DEVICES_DIR = "sys/bus/pci/devices"
+PCI_ATTRS = ("class", "vendor", "device", "subsystem_vendor", "subsystem_device")
+BLOCK_DIR = "sys/block"
+BLOCK_ATTRS = ("size", "removable", "queue/rotational", "queue/discard_max_bytes",
+               "queue/nr_requests", "device/queue_depth")
+HYBRID_PMU_FILES = ("sys/devices/cpu_core/cpus", "sys/devices/cpu_atom/cpus")
+EFI_DIR = "sys/firmware/efi"
+
+LSPCI_COMMAND = ["lspci", "-vmmnkD"]
+
+def _read(path):
+    """Returns a file's text, or None when it cannot be read."""
+    try:
+        with open(path, "r", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+def record_profile(name, root="/", lspci=None):
+    """
+    Records the hardware under root as a profile dict.
+    lspci is the lspci -vmmnkD output for the machine; it is captured by
+    running lspci when not given.
+    """
+    files, links, dirs = {}, {}, []
+
+    def keep(rel):
+        content = _read(os.path.join(root, rel))
+        if content is not None:
+            files[rel] = content
+
+    for rel in PROC_FILES + HYBRID_PMU_FILES:
+        keep(rel)
+
+    for slot in _listdir(os.path.join(root, PCI_DEVICES_DIR)):
+        device = f"{PCI_DEVICES_DIR}/{slot}"
+        dirs.append(device)
+        for attr in PCI_ATTRS:
+            keep(f"{device}/{attr}")
+        driver = os.path.join(root, device, "driver")
+        if os.path.islink(driver):
+            links[f"{device}/driver"] = os.readlink(driver)
+
+    for disk in _listdir(os.path.join(root, BLOCK_DIR)):
+        if not os.path.exists(os.path.join(root, BLOCK_DIR, disk, "device")):
+            continue
+        dirs.append(f"{BLOCK_DIR}/{disk}/device")
+        for attr in BLOCK_ATTRS:
+            keep(f"{BLOCK_DIR}/{disk}/{attr}")
+
+    if os.path.isdir(os.path.join(root, EFI_DIR)):
+        dirs.append(EFI_DIR)
+
+    if lspci is None:
+        try:
+            lspci = subprocess.run(LSPCI_COMMAND, capture_output=True, text=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"lspci failed, recording without it: {e}", file=sys.stderr)
+            lspci = ""
+
+    return {"name": name, "files": files, "links": links, "dirs": dirs, "lspci": lspci}
+
+def replay_profile(profile, root):
+    """Recreates a recorded profile's files under root."""
+    for rel in profile.get("dirs", []):
+        os.makedirs(os.path.join(root, rel), exist_ok=True)
+    for rel, content in profile.get("files", {}).items():
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    for rel, target in profile.get("links", {}).items():
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.symlink(target, path)
+
+def parse_lspci(text):
+    """
+    Parses lspci -vmmnkD output into one {field: value} dict per device,
+    e.g. {"Slot": "0000:01:00.0", "Class": "0300", "Vendor": "10de", "Driver": "nvidia", ...}.
+    """
+    devices = []
+    current = {}
+    for line in text.splitlines():
+        if not line.strip():
+            if current:
+                devices.append(current)
+            current = {}
+            continue
+        key, _, value = line.partition(":")
+        current[key.strip()] = value.strip()
+    if current:
+        devices.append(current)
+    return devices
+
+def _open_archive(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def read_archive(path):
+    """Yields the profiles of an archive, one at a time."""
+    with _open_archive(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def append_profiles(path, profiles):
+    """Appends profiles to an archive, creating it if needed."""
+    with _open_archive(path, "a") as f:
+        for profile in profiles:
+            f.write(json.dumps(profile, separators=(",", ":"), sort_keys=True) + "\n")
+
+def find_profile(path, name):
+    """Returns the named profile of an archive, or None."""
+    for profile in read_archive(path):
+        if profile.get("name") == name:
+            return profile
+    return None
+
+def main(argv):
+    usage = (f"usage: {argv[0]} record <archive> <name>\n"
+             f"       {argv[0]} replay <archive> <name> <directory>\n"
+             f"       {argv[0]} list <archive>")
+    command = argv[1] if len(argv) > 1 else None
+
+    if command == "record" and len(argv) == 4:
+        append_profiles(argv[2], [record_profile(argv[3])])
+        print(f"Recorded {argv[3]} into {argv[2]}")
+        return 0
+
+    if command == "replay" and len(argv) == 5:
+        profile = find_profile(argv[2], argv[3])
+        if profile is None:
+            print(f"{argv[2]}: no profile named {argv[3]}", file=sys.stderr)
+            return 1
+        replay_profile(profile, argv[4])
+        print(f"Replayed {argv[3]} into {argv[4]}")
+        return 0
+
+    if command == "list" and len(argv) == 3:
+        for profile in read_archive(argv[2]):
+            print(profile.get("name"))
+        return 0
+
+    print(usage, file=sys.stderr)
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
+import re
+import json
+import time
+import threading
+import fnmatch
+import contextlib
 import libcalamares
+import alg_runner
 
 # This module is important to the custom codebase, because other modules depend on it to add or remove packages as required. Any atomic operation with pacman shall take place in this module only.
 
@@ -11,12 +17,112 @@ import libcalamares
 # 1) refactor code - break up into functions - done
 # 2) add functions for Packagechooser - done
 # 3) add and sanitize variables for cpu_type and and write a function to remove specific microcode on the basis of cpu_type - done
-# 4) add function to remove nvidia packages - port nvidia_removal from iso-profiles to here
+# 4) add function to remove nvidia packages - port nvidia_removal from iso-profiles to here - done
 # 5) remove packages from old packages module & rename currect packages to packages_alg
 # 6) move get_cpu_type() to hardware module (needs testing, hence this function remains here until testing) - done
-# 7) implement old nvidia_package_removal as failsafe, based on grub boot mode
-# 8) modify remove_livecd_packages() to accomodate themed/pure values from GS, and remove packages accordingly
-# 9) add function to remove packages from edition_chooser module
+# 7) implement old nvidia_package_removal as failsafe, based on grub boot mode - done
+# 8) modify remove_livecd_packages() to accomodate themed/pure values from GS, and remove packages accordingly - done, edition_chooser queues them
+# 9) add function to remove packages from edition_chooser module - done, via the pacman_queue GS key
+
+# Heavy alpm hooks held back while this module runs pacman. Each hook is
+# masked with a /dev/null override in /etc/pacman.d/hooks and its work is
+# done once after the last transaction, if any transaction triggered it.
+DEFERRED_HOOKS = {
+    "60-mkinitcpio-remove.hook": "initramfs",
+    "90-mkinitcpio-install.hook": "initramfs",
+    "60-depmod.hook": "depmod",
+    "fontconfig.hook": "fontconfig",
+    "gtk-update-icon-cache.hook": "icon-cache",
+}
+
+# Seconds a pacman transaction may take, downloads included; see pacmanTimeout
+PACMAN_TIMEOUT = 3600
+
+# Seconds each deferred hook command may take
+HOOK_TIMEOUT = 600
+
+NVIDIA_VENDOR_ID = "10de"
+
+# Written in the target when an NVIDIA driver family replaces nouveau
+NOUVEAU_BLACKLIST = "etc/modprobe.d/alg-blacklist-nouveau.conf"
+
+# pacman --ask bits answering "remove the conflicting package?" with yes,
+# so a new NVIDIA driver family replaces the old one in one transaction
+PACMAN_ASK_REMOVE_CONFLICTS = "4"
+
+# Packages installed for each NVIDIA driver family. The legacy branches
+# come from the AUR and must be provided by a local repository.
+NVIDIA_DRIVER_FAMILIES = {
+    "open": ["nvidia-open", "nvidia-utils", "nvidia-settings"],
+    "proprietary": ["nvidia", "nvidia-utils", "nvidia-settings"],
+    "legacy470": ["nvidia-470xx-dkms", "nvidia-470xx-utils", "nvidia-470xx-settings"],
+    "legacy390": ["nvidia-390xx-dkms", "nvidia-390xx-utils", "nvidia-390xx-settings"],
+    "nouveau": [],
+}
+
+# From newest to oldest hardware support; with several GPUs the latest
+# family in this order is the one that drives all of them
+NVIDIA_FAMILY_ORDER = ["open", "proprietary", "legacy470", "legacy390", "nouveau"]
+
+# Every NVIDIA driver package any family may bring along
+NVIDIA_DRIVER_PACKAGES = [
+    "nvidia", "nvidia-open", "nvidia-dkms", "nvidia-open-dkms", "nvidia-utils", "nvidia-settings",
+    "nvidia-prime", "nvidia-470xx-dkms", "nvidia-470xx-utils", "nvidia-470xx-settings",
+    "nvidia-390xx-dkms", "nvidia-390xx-utils", "nvidia-390xx-settings",
+]
+
+# NVIDIA device id blocks per GPU generation, inclusive and sorted. Each
+# generation is allocated a contiguous block, so new ids inside a known
+# block need no change here; single ids that break the pattern go in the
+# nvidiaDeviceOverrides setting. Ids below the table are pre-Fermi.
+NVIDIA_DEVICE_RANGES = [
+    (0x06c0, 0x06df, "legacy390"),    # Fermi GF100
+    (0x0dc0, 0x0dff, "legacy390"),    # Fermi GF106, GF108
+    (0x0e20, 0x0e3f, "legacy390"),    # Fermi GF104
+    (0x0f00, 0x0f03, "legacy390"),    # Fermi GF108
+    (0x0fc0, 0x0fff, "legacy470"),    # Kepler GK107
+    (0x1000, 0x103f, "legacy470"),    # Kepler GK110
+    (0x1040, 0x10bf, "legacy390"),    # Fermi GF119, GF110
+    (0x10c0, 0x10df, "nouveau"),      # Tesla GT218, dropped by the 390 driver
+    (0x10e0, 0x10ff, "legacy390"),
+    (0x1140, 0x117f, "legacy390"),    # Fermi GF117
+    (0x1180, 0x11ff, "legacy470"),    # Kepler GK104, GK106
+    (0x1200, 0x127f, "legacy390"),    # Fermi GF114, GF116
+    (0x1280, 0x12ff, "legacy470"),    # Kepler GK208
+    (0x1340, 0x13ff, "proprietary"),  # Maxwell GM107, GM108, GM204
+    (0x1400, 0x17ff, "proprietary"),  # Maxwell GM206, GM200, Pascal GP100
+    (0x1b00, 0x1d7f, "proprietary"),  # Pascal GP102 - GP108
+    (0x1d80, 0x1dff, "proprietary"),  # Volta GV100
+    (0x1e00, 0x1fff, "open"),         # Turing TU102 - TU117
+    (0x2080, 0x20ff, "open"),         # Ampere GA100
+    (0x2180, 0x21ff, "open"),         # Turing TU116
+    (0x2200, 0x25ff, "open"),         # Ampere GA102 - GA107, Hopper
+    (0x2600, 0x2fff, "open"),         # Ada Lovelace, Blackwell
+]
+
+# Built lazily by get_nvidia_device_table()
+_nvidia_device_table = None
+
+# Serializes every pacman invocation issued by this module
+_pacman_lock = threading.Lock()
+
+# Every pacman invocation of this run, as returned by run_pacman()
+_pacman_calls = []
+
+# Slice of the job progress bar owned by the plan step being executed
+_progress_range = (0.0, 1.0)
+
+# Lines of interest in pacman's (non-tty) output
+_PACKAGES_RE = re.compile(r"^Packages \((\d+)\)")
+_OPERATION_RE = re.compile(
+    r"^(?:\(\s*\d+/\d+\)\s+)?(installing|upgrading|reinstalling|downgrading|removing) (\S+?)(?:\.\.\.)?(?:\s+\[.*)?$"
+)
+_HOOK_RE = re.compile(r"^\(\s*\d+/\d+\)\s+(.+)$")
+_BREAKS_RE = re.compile(r"^:: removing (\S+) breaks dependency '([^']+)' required by (\S+)$")
+_UNSATISFIED_RE = re.compile(r"^:: unable to satisfy dependency '([^']+)' required by (\S+)$")
+
+# Errors about the database lock, which no subset of the packages avoids
+_LOCK_ERRORS = ("database is locked", "unable to lock database")
 
 def remove_db_lock(install_path):
     """Remove pacman database lock file if it exists."""
@@ -25,65 +131,451 @@ def remove_db_lock(install_path):
         with libcalamares.utils.raised_privileges():
             os.remove(db_lock)
 
-def remove_cpu_microcode_packages():
-    """Remove CPU microcode packages based on CPU vendor."""
+def find_lock_holders(install_path):
+    """
+    Finds pacman processes working on the target system.
+    Matches processes chrooted into install_path, and processes pointed
+    at it with --root/--sysroot. Returns a list of PIDs.
+    """
+    target_root = os.path.realpath(install_path)
+    holders = []
+
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/comm", "r") as f:
+                if f.read().strip() != "pacman":
+                    continue
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                args = [arg.decode(errors="replace") for arg in f.read().split(b"\0")]
+            root = os.readlink(f"/proc/{pid}/root")
+        except OSError:
+            # Process exited or is not ours to inspect
+            continue
+
+        if os.path.realpath(root) == target_root or target_root in map(os.path.realpath, args[1:]):
+            holders.append(int(pid))
+
+    return holders
+
+def wait_for_db_lock(install_path, timeout=None):
+    """
+    Waits until the target's pacman database lock is free.
+    While a pacman process in the target holds the lock, waits with
+    exponential backoff. A lock without a holder is stale and is removed.
+    Returns False if the lock is still held after the timeout.
+    """
+    if timeout is None:
+        timeout = alg_runner.get_config("lockTimeout", 300)
+
+    db_lock = os.path.join(install_path, "var/lib/pacman/db.lck")
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+
+    while os.path.exists(db_lock):
+        holders = find_lock_holders(install_path)
+        if not holders:
+            libcalamares.utils.debug("Removing stale pacman database lock")
+            remove_db_lock(install_path)
+            break
+        if time.monotonic() >= deadline:
+            libcalamares.utils.warning(f"pacman database is still locked by {holders}")
+            return False
+        libcalamares.utils.debug(f"pacman database locked by {holders}, waiting {delay:.1f}s")
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, 5)
+
+    return True
+
+def _strip_version(dep):
+    """Strip a version constraint ("glibc>=2.38", "sh=5.2") from a dependency string."""
+    for op in ("<", ">", "="):
+        dep = dep.split(op, 1)[0]
+    return dep.strip()
+
+def read_local_db(install_path):
+    """
+    Builds an index of installed packages from the target's pacman local DB.
+    Parses every var/lib/pacman/local/*/desc file once and returns a dict of
+    name -> {"version", "size", "explicit", "depends", "provides", "required_by"}.
+    """
+    local_db_path = os.path.join(install_path, "var/lib/pacman/local")
+    local_db = {}
+
+    try:
+        entries = os.listdir(local_db_path)
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to read pacman local database: {e}")
+        return local_db
+
+    for entry in entries:
+        desc = os.path.join(local_db_path, entry, "desc")
+        fields = {}
+        section = None
+        try:
+            with open(desc, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith("%") and line.endswith("%"):
+                        section = line[1:-1]
+                        fields[section] = []
+                    elif line and section:
+                        fields[section].append(line)
+        except OSError:
+            continue
+
+        if not fields.get("NAME"):
+            continue
+
+        size = fields.get("SIZE", ["0"])[0]
+        local_db[fields["NAME"][0]] = {
+            "version": fields.get("VERSION", [""])[0],
+            "size": int(size) if size.isdigit() else 0,
+            "explicit": fields.get("REASON", ["0"])[0] != "1",
+            "depends": [_strip_version(d) for d in fields.get("DEPENDS", [])],
+            "provides": [_strip_version(p) for p in fields.get("PROVIDES", [])],
+            "required_by": [],
+        }
+
+    providers = {}
+    for name, pkg in local_db.items():
+        providers.setdefault(name, []).append(name)
+        for provided in pkg["provides"]:
+            providers.setdefault(provided, []).append(name)
+
+    for name, pkg in local_db.items():
+        for dep in pkg["depends"]:
+            for provider in providers.get(dep, []):
+                if name not in local_db[provider]["required_by"]:
+                    local_db[provider]["required_by"].append(name)
+
+    return local_db
+
+def filter_installed(packages, local_db):
+    """Return only the packages that are installed in the target."""
+    missing = [pkg for pkg in packages if pkg not in local_db]
+    if missing:
+        libcalamares.utils.debug(f"Skipping packages that are not installed: {missing}")
+    return [pkg for pkg in packages if pkg in local_db]
+
+def filter_removable(packages, local_db):
+    """
+    Drops packages that are still required by an installed package outside
+    the removal set, since pacman would refuse the whole transaction.
+    """
+    removable = filter_installed(packages, local_db)
+    changed = True
+    while changed:
+        changed = False
+        for pkg in list(removable):
+            blockers = [r for r in local_db[pkg]["required_by"] if r not in removable]
+            if blockers:
+                libcalamares.utils.warning(f"Keeping {pkg}, required by {blockers}")
+                removable.remove(pkg)
+                changed = True
+    return removable
+
+def parse_pacman_line(line, result):
+    """
+    Parses one line of pacman output into the structured result.
+    Returns the fraction of packages processed when the line reports
+    progress on a package, None otherwise.
+    """
+    line = line.strip()
+
+    if line.startswith(":: Running ") and line.endswith(" hooks..."):
+        result["hooks_running"] = True
+        return None
+
+    if line == ":: Processing package changes...":
+        # Pre-transaction hooks are done, the package operations follow
+        result["hooks_running"] = False
+        return None
+
+    if result["hooks_running"]:
+        match = _HOOK_RE.match(line)
+        if match:
+            result["hooks"].append(match.group(1))
+            return None
+
+    match = _PACKAGES_RE.match(line)
+    if match:
+        result["total"] = int(match.group(1))
+        return None
+
+    match = _OPERATION_RE.match(line)
+    if match:
+        result["done"] += 1
+        return min(result["done"] / result["total"], 1.0) if result["total"] else None
+
+    match = _BREAKS_RE.match(line)
+    if match:
+        result["breaks"].append({
+            "package": match.group(1),
+            "dependency": match.group(2),
+            "required_by": match.group(3),
+        })
+        return None
+
+    match = _UNSATISFIED_RE.match(line)
+    if match:
+        result["unsatisfied"].append({"dependency": match.group(1), "required_by": match.group(2)})
+        return None
+
+    if line.startswith("error: target not found: "):
+        result["not_found"].append(line[len("error: target not found: "):])
+    elif line.endswith(" exists in filesystem"):
+        result["conflicts"].append(line)
+    elif line.startswith("error: "):
+        result["errors"].append(line[len("error: "):])
+    return None
+
+def describe_pacman_failure(result):
+    """Return a one-line summary of why a pacman invocation failed."""
+    reasons = [f"target not found: {pkg}" for pkg in result["not_found"]]
+    reasons += [f"removing {b['package']} breaks dependency '{b['dependency']}' required by {b['required_by']}"
+                for b in result["breaks"]]
+    reasons += [f"unable to satisfy dependency '{u['dependency']}' required by {u['required_by']}"
+                for u in result["unsatisfied"]]
+    reasons += result["conflicts"] + result["errors"]
+    return "; ".join(reasons) or f"exit status {result['exit']}"
+
+def is_package_failure(result):
+    """
+    Checks whether a failed pacman invocation failed because of the packages
+    it was given, so a smaller set may succeed: pacman exited with an error
+    and reported what went wrong. A timeout, a pacman that did not start or
+    a locked database fails the same way for any set.
+    """
+    if result["exit"] <= 0:
+        return False
+    errors = [error for error in result["errors"] if not any(lock in error for lock in _LOCK_ERRORS)]
+    return bool(result["not_found"] or result["breaks"] or result["unsatisfied"]
+                or result["conflicts"] or errors)
+
+def report_step_progress(fraction):
+    """Moves the job progress within the slice of the current plan step."""
+    low, high = _progress_range
+    libcalamares.job.setprogress(low + (high - low) * fraction)
+
+def run_pacman(args):
+    """
+    Runs pacman with the given arguments inside the target system.
+    Invocations are serialized and each one waits for the database lock.
+    Output is streamed line by line to drive the job progress and is
+    parsed into a result dict with the exit status, the packages
+    processed, the hooks run and the structured errors.
+    """
+    command = ["pacman"] + args
+    result = {
+        "command": command,
+        "exit": 0,
+        "seconds": 0.0,
+        "total": 0,
+        "done": 0,
+        "hooks_running": False,
+        "hooks": [],
+        "not_found": [],
+        "breaks": [],
+        "unsatisfied": [],
+        "conflicts": [],
+        "errors": [],
+    }
+
+    def on_line(line):
+        fraction = parse_pacman_line(line, result)
+        if fraction is not None:
+            report_step_progress(fraction)
+
+    with _pacman_lock:
+        install_path = libcalamares.globalstorage.value("rootMountPoint")
+        if install_path and not wait_for_db_lock(install_path):
+            result["exit"] = 1
+            result["errors"].append("database is locked")
+            return result
+
+        process = alg_runner.stream_target(command, on_line, alg_runner.get_config("pacmanTimeout", PACMAN_TIMEOUT))
+        result["exit"] = process.returncode
+        result["seconds"] = process.seconds
+        _pacman_calls.append(result)
+
+    if result["exit"] != 0:
+        libcalamares.utils.warning(f"{' '.join(command[:2])} failed: {describe_pacman_failure(result)}")
+    return result
+
+def get_cpu_microcode_packages():
+    """Return the CPU microcode packages that do not match the CPU vendor."""
     cpu_vendor = libcalamares.globalstorage.value("cpu_vendor")
-    
+
     if not cpu_vendor:
         libcalamares.utils.warning("CPU vendor information not found in global storage")
-        return
+        return []
 
-    try:
-        if 'GenuineIntel' in cpu_vendor:
-            libcalamares.utils.target_env_call(['pacman', '-Rns', '--noconfirm', 'amd-ucode'])
-        elif 'AuthenticAMD' in cpu_vendor:
-            libcalamares.utils.target_env_call(['pacman', '-Rns', '--noconfirm', 'intel-ucode'])
-        else:
-            libcalamares.utils.debug(f"Unknown CPU vendor: {cpu_vendor}")
-    except Exception as e:
-        libcalamares.utils.warning(f"Failed to remove microcode package: {e}")
+    if 'GenuineIntel' in cpu_vendor:
+        return ['amd-ucode']
+    elif 'AuthenticAMD' in cpu_vendor:
+        return ['intel-ucode']
 
-def remove_firmware_packages():
-    """Remove firmware packages based on boot type."""
+    libcalamares.utils.debug(f"Unknown CPU vendor: {cpu_vendor}")
+    return []
+
+def get_firmware_packages():
+    """Return the EFI packages to remove on BIOS installs."""
     fw_type = libcalamares.globalstorage.value("firmwareType")
-    
+
     if fw_type == 'bios':
-        try:
-            libcalamares.utils.target_env_call(
-                ['pacman', '-Rns', '--noconfirm', 'efibootmgr', 'refind-efi']
-            )
-        except Exception as e:
-            libcalamares.utils.warning(f"Failed to remove EFI packages: {e}")
-
-def remove_nvidia_drivers():
-    """Remove NVIDIA drivers based on boot mode and GPU detection."""
+        return ['efibootmgr', 'refind-efi']
+    return []
+
+def get_nvidia_device_table():
+    """
+    Returns the NVIDIA device id -> driver family table.
+    Built once from NVIDIA_DEVICE_RANGES plus the nvidiaDeviceOverrides
+    setting, so each lookup is a single dict access.
+    """
+    global _nvidia_device_table
+
+    if _nvidia_device_table is None:
+        table = {}
+        for first, last, family in NVIDIA_DEVICE_RANGES:
+            for device_id in range(first, last + 1):
+                table[device_id] = family
+        for device_id, family in (alg_runner.get_config("nvidiaDeviceOverrides", {}) or {}).items():
+            if family in NVIDIA_DRIVER_FAMILIES:
+                table[int(str(device_id), 16)] = family
+            else:
+                libcalamares.utils.warning(f"Unknown NVIDIA driver family {family} for {device_id}")
+        _nvidia_device_table = table
+
+    return _nvidia_device_table
+
+def get_nvidia_driver_family(device_id):
+    """
+    Returns the driver family for an NVIDIA PCI device id ("2484").
+    Ids beyond the table belong to generations newer than it and get
+    the open kernel modules.
+    """
+    try:
+        device_id = int(device_id, 16)
+    except (TypeError, ValueError):
+        return "nouveau"
+
+    family = get_nvidia_device_table().get(device_id)
+    if family is None:
+        family = "open" if device_id > NVIDIA_DEVICE_RANGES[-1][1] else "nouveau"
+    return family
+
+def plan_nvidia_driver():
+    """
+    Decides the NVIDIA driver from the GPUs hardware_detection found on
+    every bus. With several NVIDIA GPUs the family that supports all of
+    them wins; a second GPU from another vendor marks a hybrid setup.
+    Returns a dict with the family, the packages to install, the packages
+    to remove up front, the packages of the ISO's driver to remove only once
+    the new family is installed ("replace"), and whether nouveau gets
+    blacklisted.
+    """
     kernel_boot_mode = libcalamares.globalstorage.value("kernel_boot_mode")
-    
-    if not kernel_boot_mode:
+    gpu_devices = libcalamares.globalstorage.value("gpu_devices")
+
+    if kernel_boot_mode != "nonfree":
+        return {"family": "nouveau", "install": [], "remove": list(NVIDIA_DRIVER_PACKAGES),
+                "replace": [], "blacklist": False}
+
+    if gpu_devices is None:
+        # No device information, keep whatever driver the ISO booted with
+        return {"family": None, "install": [], "remove": [], "replace": [], "blacklist": True}
+
+    nvidia_gpus = [gpu for gpu in gpu_devices if gpu.get("vendor") == NVIDIA_VENDOR_ID]
+    families = [get_nvidia_driver_family(gpu.get("device")) for gpu in nvidia_gpus]
+    family = max(families, key=NVIDIA_FAMILY_ORDER.index) if families else "nouveau"
+    hybrid = bool(nvidia_gpus) and len(nvidia_gpus) < len(gpu_devices)
+
+    install = list(NVIDIA_DRIVER_FAMILIES[family])
+    if hybrid and family != "nouveau":
+        install.append("nvidia-prime")
+
+    libcalamares.utils.debug(f"NVIDIA driver family: {family} for {[gpu.get('device') for gpu in nvidia_gpus]}"
+                             + (" (hybrid graphics)" if hybrid else ""))
+    others = [pkg for pkg in NVIDIA_DRIVER_PACKAGES if pkg not in install]
+    return {
+        "family": family,
+        "install": install,
+        # Without a replacement the ISO's driver can go with the other removals;
+        # otherwise it stays until the new family is in place
+        "remove": [] if install else others,
+        "replace": others if install else [],
+        "blacklist": family != "nouveau",
+    }
+
+def get_nvidia_packages():
+    """Return the NVIDIA driver packages to remove based on boot mode and GPUs."""
+    if not libcalamares.globalstorage.value("kernel_boot_mode"):
         libcalamares.utils.warning("No kernel_boot_mode found in global storage")
-        return
+        return []
 
-    if kernel_boot_mode == "free":
-        try:
-            libcalamares.utils.target_env_call(
-                ["pacman", "-Rns", "--noconfirm", "nvidia", "nvidia-utils", "nvidia-settings"]
-            )
-            libcalamares.utils.debug("NVIDIA drivers removed successfully")
-        except Exception as e:
-            libcalamares.utils.warning(f"Failed to remove NVIDIA drivers: {e}")
-    
-    elif kernel_boot_mode == "nonfree":
-        try:
-            with open("/usr/lib/modprobe.d/nvidia-utils.conf", "w") as f:
-                f.write("blacklist nouveau\n")
-            libcalamares.utils.debug("Nouveau driver blacklisted for NVIDIA")
-        except IOError as e:
-            libcalamares.utils.warning(f"Failed to blacklist nouveau: {e}")
-
-def remove_livecd_packages():
-    """Remove packages that are only needed in the live environment."""
-    # Preserve the existing package list
-    live_cd_packages = [
+    return plan_nvidia_driver()["remove"]
+
+def get_installed_nvidia_family(local_db):
+    """Returns the NVIDIA driver family installed in the target, or None."""
+    for family in NVIDIA_FAMILY_ORDER:
+        packages = NVIDIA_DRIVER_FAMILIES[family]
+        if packages and packages[0] in local_db:
+            return family
+    return None
+
+def replace_nvidia_driver(install_path, family, family_packages, old_packages):
+    """
+    Removes what is left of the ISO's NVIDIA driver once the new family is
+    installed; packages that conflict with it are already gone with the
+    install transaction. When the new family did not get installed, the
+    ISO's driver is kept if it also drives the GPUs that needed family;
+    otherwise every NVIDIA driver is removed and nouveau is used instead.
+    Returns the packages left installed.
+    """
+    local_db = read_local_db(install_path)
+    missing = [pkg for pkg in family_packages if pkg not in local_db]
+    if not missing:
+        leftovers = filter_removable([pkg for pkg in old_packages if pkg in local_db], local_db)
+        return remove_packages(leftovers)
+
+    # Families later in NVIDIA_FAMILY_ORDER drive the GPUs of the earlier ones
+    current = get_installed_nvidia_family(local_db)
+    if current is not None and NVIDIA_FAMILY_ORDER.index(current) >= NVIDIA_FAMILY_ORDER.index(family):
+        libcalamares.utils.warning(f"NVIDIA driver packages {missing} were not installed, "
+                                   f"keeping the {current} driver")
+        return [pkg for pkg in old_packages if pkg in local_db]
+
+    libcalamares.utils.warning(f"NVIDIA driver packages {missing} were not installed and the "
+                               f"{current} driver does not support the GPU, falling back to nouveau")
+    unblacklist_nouveau(install_path)
+    installed = [pkg for pkg in NVIDIA_DRIVER_PACKAGES if pkg in local_db]
+    return remove_packages(filter_removable(installed, local_db))
+
+def blacklist_nouveau(install_path):
+    """Blacklists nouveau in the target for an NVIDIA driver family."""
+    path = os.path.join(install_path, NOUVEAU_BLACKLIST)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("blacklist nouveau\n")
+        libcalamares.utils.debug("Nouveau driver blacklisted for NVIDIA")
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to blacklist nouveau: {e}")
+
+def unblacklist_nouveau(install_path):
+    """Removes the blacklist written by blacklist_nouveau(), if any."""
+    try:
+        os.remove(os.path.join(install_path, NOUVEAU_BLACKLIST))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to remove the nouveau blacklist: {e}")
+
+def get_livecd_packages():
+    """Return packages that are only needed in the live environment."""
+    return [
         "calamares", "boost", "solid", "yaml-cpp", "kpmcore",
         "hwinfo", "qt5-svg", "polkit-qt5", "plasma-framework",
         "qt5-xmlpatterns", "squashfs-tools", "linux-atm",
@@ -92,27 +584,677 @@ def remove_livecd_packages():
         "ckbcomp", "mkinitcpio-openswap"
     ]
 
-    for pkg in live_cd_packages:
-        try:
-            libcalamares.utils.target_env_call(['pacman', '-Rns', '--noconfirm', pkg])
-        except Exception as e:
-            libcalamares.utils.warning(f"Could not remove package {pkg}: {e}")
+def get_optimized_repositories():
+    """
+    Returns the optimizedRepositories entries the CPU can use, highest
+    x86-64 level first.
+    """
+    cpu_info = libcalamares.globalstorage.value("cpu_info") or {}
+    cpu_level = cpu_info.get("x86_64_level", 0)
+    repositories = [repo for repo in alg_runner.get_config("optimizedRepositories", [])
+                    if repo.get("name") and 0 < repo.get("level", 0) <= cpu_level]
+    return sorted(repositories, key=lambda repo: repo["level"], reverse=True)
+
+def add_optimized_repositories(install_path, repositories):
+    """
+    Adds optimized repositories to the target's pacman.conf, ahead of the
+    generic ones so pacman prefers their builds, and allows their package
+    architectures. Repositories already configured are left alone.
+    """
+    conf_path = os.path.join(install_path, "etc/pacman.conf")
+    try:
+        with open(conf_path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to read pacman.conf: {e}")
+        return False
+
+    sections = [line.strip()[1:-1] for line in lines
+                if line.strip().startswith("[") and line.strip().endswith("]")]
+    repositories = [repo for repo in repositories if repo["name"] not in sections]
+    if not repositories:
+        return True
+
+    block = []
+    for repo in repositories:
+        block.append(f"[{repo['name']}]")
+        if repo.get("include"):
+            block.append(f"Include = {repo['include']}")
+        if repo.get("server"):
+            block.append(f"Server = {repo['server']}")
+        block.append("")
 
-def handle_packagechooser_packages():
-    """Handle packages selected via PackageChooser module."""
+    architectures = sorted({f"x86_64_v{repo['level']}" for repo in repositories if repo["level"] > 1})
+    first_repo = next((index for index, line in enumerate(lines)
+                       if line.strip().startswith("[") and line.strip() != "[options]"), len(lines))
+    for index, line in enumerate(lines[:first_repo]):
+        key, _, value = line.partition("=")
+        if key.strip() == "Architecture":
+            missing = [arch for arch in architectures if arch not in value.split()]
+            lines[index] = f"Architecture = {' '.join(value.split() + missing)}"
+            break
+    else:
+        options = next((index for index, line in enumerate(lines) if line.strip() == "[options]"), None)
+        if options is not None:
+            lines.insert(options + 1, f"Architecture = {' '.join(['auto'] + architectures)}")
+            first_repo += 1
+    lines[first_repo:first_repo] = block
+
+    try:
+        with open(conf_path + ".new", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(conf_path + ".new", conf_path)
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to write pacman.conf: {e}")
+        return False
+
+    libcalamares.utils.debug(f"Optimized repositories added: {[repo['name'] for repo in repositories]}")
+    return True
+
+def get_queued_work(action):
+    """
+    Returns the packages other modules queued for an action, keyed by module.
+    Modules queue work by appending {"action": "install"|"remove",
+    "packages": [...], "source": "<module>"} to the "pacman_queue" GS list;
+    the next packages_remover instance folds it into its transactions.
+    """
+    queued = {}
+    for item in libcalamares.globalstorage.value("pacman_queue") or []:
+        if item.get("action") == action:
+            source = item.get("source", "queue")
+            queued.setdefault(source, []).extend(item.get("packages", []))
+    return queued
+
+def get_removal_sources():
+    """Return the packages each removal step wants dropped, keyed by step."""
+    sources = {
+        "microcode": get_cpu_microcode_packages(),
+        "firmware": get_firmware_packages(),
+        "nvidia": get_nvidia_packages(),
+        "livecd": get_livecd_packages(),
+    }
+    for source, packages in get_queued_work("remove").items():
+        sources.setdefault(source, []).extend(packages)
+    return sources
+
+def plan_removals(local_db, sources=None):
+    """
+    Gathers every package the removal steps decided to drop.
+    Returns an ordered list without duplicates, limited to packages that
+    are installed and can be removed without breaking other packages.
+    """
+    if sources is None:
+        sources = get_removal_sources()
+
+    packages = []
+    for source_packages in sources.values():
+        for pkg in source_packages:
+            if pkg not in packages:
+                packages.append(pkg)
+    return filter_removable(packages, local_db)
+
+def estimate_freed_bytes(packages, local_db):
+    """
+    Estimates the installed size freed by `pacman -Rns packages`.
+    Includes dependencies that would be left orphaned by the removal.
+    """
+    removed = set(packages)
+    changed = True
+    while changed:
+        changed = False
+        for pkg in list(removed):
+            for dep in local_db.get(pkg, {}).get("depends", []):
+                info = local_db.get(dep)
+                if (info and dep not in removed and not info["explicit"]
+                        and all(r in removed for r in info["required_by"])):
+                    removed.add(dep)
+                    changed = True
+    return sum(local_db[pkg]["size"] for pkg in removed if pkg in local_db)
+
+def remove_packages(packages):
+    """
+    Removes packages in a single pacman transaction.
+    If the transaction fails, the packages pacman blamed are dropped and the
+    rest retried; otherwise the set is bisected and each half retried, so
+    one bad package only costs O(log n) extra transactions. Failures that
+    do not depend on the packages (see is_package_failure()) are not
+    retried.
+    Returns the list of packages that could not be removed.
+    """
+    if not packages:
+        return []
+
+    result = run_pacman(['-Rns', '--noconfirm'] + packages)
+    if result["exit"] == 0:
+        return []
+
+    if not is_package_failure(result):
+        libcalamares.utils.warning(f"Could not remove packages {packages}, not retrying")
+        return list(packages)
+
+    # When pacman names the offending packages, drop them and retry the rest at once
+    culprits = set(result["not_found"]) | {b["package"] for b in result["breaks"]}
+    failed = [pkg for pkg in packages if pkg in culprits]
+    if failed and len(failed) < len(packages):
+        libcalamares.utils.warning(f"Could not remove packages {failed}")
+        return failed + remove_packages([pkg for pkg in packages if pkg not in culprits])
+
+    if len(packages) == 1:
+        libcalamares.utils.warning(f"Could not remove package {packages[0]}")
+        return packages
+
+    middle = len(packages) // 2
+    return remove_packages(packages[:middle]) + remove_packages(packages[middle:])
+
+def get_packagechooser_packages(local_db):
+    """Return packages selected via PackageChooser that are not installed yet."""
     selected_packages = libcalamares.globalstorage.value("packagechooser_packages")
     
     if not selected_packages:
+        return []
+
+    return [pkg for pkg in selected_packages if pkg not in local_db]
+
+def get_install_sources(local_db):
+    """Return the packages each step wants installed, keyed by step."""
+    sources = {
+        "packagechooser": get_packagechooser_packages(local_db),
+        "nvidia": [pkg for pkg in plan_nvidia_driver()["install"] if pkg not in local_db],
+    }
+    for source, packages in get_queued_work("install").items():
+        sources.setdefault(source, []).extend(pkg for pkg in packages if pkg not in local_db)
+    return sources
+
+def get_install_packages(local_db, sources=None):
+    """Return every package to install, in order and without duplicates."""
+    if sources is None:
+        sources = get_install_sources(local_db)
+
+    packages = []
+    for source_packages in sources.values():
+        for pkg in source_packages:
+            if pkg not in packages:
+                packages.append(pkg)
+    return packages
+
+def find_cached_packages(packages, cache_dirs):
+    """
+    Looks up package files for the given names in the live system's caches.
+    Returns a dict of name -> (cache_dir, filename); when a cache holds
+    several versions, the most recently modified file wins.
+    """
+    wanted = set(packages)
+    found = {}
+
+    for cache_dir in cache_dirs:
+        try:
+            entries = os.scandir(cache_dir)
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if ".pkg.tar" not in entry.name or entry.name.endswith(".sig"):
+                    continue
+                # name-pkgver-pkgrel-arch.pkg.tar.zst
+                parts = entry.name.rsplit("-", 3)
+                if len(parts) != 4 or parts[0] not in wanted:
+                    continue
+                mtime = entry.stat().st_mtime
+                current = found.get(parts[0])
+                if current is None or (current[0] == cache_dir and mtime > current[2]):
+                    found[parts[0]] = (cache_dir, entry.name, mtime)
+
+    return {name: (cache_dir, filename) for name, (cache_dir, filename, _) in found.items()}
+
+def plan_installs(packages):
+    """
+    Splits packages into those installable from a local cache and those
+    that need the network. Returns (offline, network) where offline maps
+    name -> [cache_dir, filename].
+    """
+    if not alg_runner.get_config("offlineInstall", True):
+        return {}, list(packages)
+
+    cached = find_cached_packages(packages, alg_runner.get_config("offlineCacheDirs", ["/var/cache/pacman/pkg"]))
+    offline = {pkg: list(cached[pkg]) for pkg in packages if pkg in cached}
+    network = [pkg for pkg in packages if pkg not in cached]
+    return offline, network
+
+def _bind_cache_dirs(install_path, cache_dirs):
+    """
+    Bind-mounts the live cache directories into the target.
+    Returns a dict of host cache_dir -> path as seen inside the target.
+    """
+    mounts = {}
+    for index, cache_dir in enumerate(cache_dirs):
+        target_dir = f"/var/cache/pacman/alg-offline-{index}"
+        mount_point = os.path.join(install_path, target_dir.lstrip("/"))
+        try:
+            os.makedirs(mount_point, exist_ok=True)
+        except OSError as e:
+            libcalamares.utils.warning(f"Failed to create {mount_point}: {e}")
+            continue
+        if libcalamares.utils.mount(cache_dir, mount_point, "", "bind,ro") == 0:
+            mounts[cache_dir] = target_dir
+        else:
+            libcalamares.utils.warning(f"Failed to bind-mount package cache {cache_dir}")
+    return mounts
+
+def _unbind_cache_dirs(install_path, mounts):
+    """Unmounts the cache directories bound by _bind_cache_dirs()."""
+    for target_dir in mounts.values():
+        mount_point = os.path.join(install_path, target_dir.lstrip("/"))
+        result = alg_runner.run(["umount", mount_point])
+        if not result.ok:
+            libcalamares.utils.warning(f"Failed to release package cache {mount_point}: "
+                                       f"{result.stderr.strip() or result.returncode}")
+            continue
+        try:
+            os.rmdir(mount_point)
+        except OSError as e:
+            libcalamares.utils.warning(f"Failed to release package cache {mount_point}: {e}")
+
+def install_packages(install_path, offline, network, replace_conflicts=False):
+    """
+    Installs packages in the target.
+    Packages found in the live cache are installed with pacman -U straight
+    from a bind mount, without syncing or copying; everything else (and any
+    local install that fails) goes through pacman -S. With replace_conflicts
+    installed packages that conflict with the new ones are removed in the
+    same transaction, which fails as a whole if any package is missing.
+    """
+    network = list(network)
+    options = ['--needed', '--noconfirm']
+    if replace_conflicts:
+        options += ['--ask', PACMAN_ASK_REMOVE_CONFLICTS]
+
+    if offline:
+        cache_dirs = sorted({cache_dir for cache_dir, _ in offline.values()})
+        mounts = _bind_cache_dirs(install_path, cache_dirs)
+        files = []
+        for pkg, (cache_dir, filename) in offline.items():
+            if cache_dir in mounts:
+                files.append(f"{mounts[cache_dir]}/{filename}")
+            else:
+                network.append(pkg)
+        try:
+            if files and run_pacman(['-U'] + options + files)["exit"] != 0:
+                libcalamares.utils.warning("Offline install failed, falling back to the network")
+                network.extend(pkg for pkg, (cache_dir, _) in offline.items() if cache_dir in mounts)
+        finally:
+            _unbind_cache_dirs(install_path, mounts)
+
+    if not network:
         return
-    
+
     try:
-        # Install selected packages
-        libcalamares.utils.target_env_call(
-            ['pacman', '-S', '--noconfirm'] + selected_packages
-        )
+        if run_pacman(['-S'] + options + network)["exit"] != 0:
+            libcalamares.utils.warning("Failed to install selected packages")
     except Exception as e:
         libcalamares.utils.warning(f"Failed to install selected packages: {e}")
 
+def read_hook_triggers(path):
+    """
+    Reads the [Trigger] sections of an alpm hook file.
+    Returns a list of {"type", "operations", "targets"} dicts.
+    """
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to read hook {path}: {e}")
+        return []
+
+    triggers = []
+    current = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            current = {"type": None, "operations": [], "targets": []} if line == "[Trigger]" else None
+            if current is not None:
+                triggers.append(current)
+            continue
+        if current is None or "=" not in line:
+            continue
+        key, value = (part.strip() for part in line.split("=", 1))
+        if key == "Type":
+            current["type"] = value
+        elif key == "Operation":
+            current["operations"].append(value)
+        elif key == "Target":
+            current["targets"].append(value)
+    return triggers
+
+def match_hook_targets(value, targets):
+    """
+    Matches a path or package name against a trigger's targets like alpm
+    does: the last matching target decides, and a "!" target excludes.
+    """
+    for target in reversed(targets):
+        inverted = target.startswith("!")
+        if inverted or target.startswith("\\"):
+            target = target[1:]
+        if fnmatch.fnmatchcase(value, target):
+            return not inverted
+    return False
+
+def get_trigger_prefixes(hooks):
+    """
+    Returns the literal leading part of every path target of the hooks, so
+    package file lists can be cut down before globbing.
+    """
+    prefixes = set()
+    for triggers in hooks.values():
+        for trigger in triggers:
+            if trigger["type"] == "Path":
+                prefixes.update(re.split(r"[*?\[]", target.lstrip("!\\"), maxsplit=1)[0]
+                                for target in trigger["targets"])
+    return tuple(sorted(prefixes))
+
+def read_package_files(install_path, entry, prefixes):
+    """Returns the files of a local DB entry that start with one of prefixes."""
+    if not prefixes:
+        return []
+    try:
+        with open(os.path.join(install_path, "var/lib/pacman/local", entry, "files"), "r") as f:
+            text = f.read()
+    except OSError:
+        return []
+    _, _, files = text.partition("%FILES%\n")
+    return [line for line in files.split("\n\n", 1)[0].splitlines() if line.startswith(prefixes)]
+
+def snapshot_package_files(install_path, prefixes):
+    """Returns {local DB entry: files under prefixes} for every installed package."""
+    try:
+        entries = os.listdir(os.path.join(install_path, "var/lib/pacman/local"))
+    except OSError:
+        return {}
+    return {entry: read_package_files(install_path, entry, prefixes)
+            for entry in entries if entry != "ALPM_DB_VERSION"}
+
+def get_package_changes(install_path, before, prefixes):
+    """
+    Compares the local DB with a snapshot taken by snapshot_package_files().
+    Returns a list of (operation, package, files) in alpm's terms: Install,
+    Upgrade (old and new files) or Remove (the files the package had).
+    """
+    after = snapshot_package_files(install_path, ())
+    before_names = {entry.rsplit("-", 2)[0]: entry for entry in before}
+    after_names = {entry.rsplit("-", 2)[0]: entry for entry in after}
+
+    changes = []
+    for name, entry in after_names.items():
+        if entry in before:
+            continue
+        files = read_package_files(install_path, entry, prefixes)
+        if name in before_names:
+            changes.append(("Upgrade", name, files + before[before_names[name]]))
+        else:
+            changes.append(("Install", name, files))
+    for name, entry in before_names.items():
+        if name not in after_names:
+            changes.append(("Remove", name, before[entry]))
+    return changes
+
+def get_triggered_actions(hooks, changes):
+    """
+    Works out which held back hooks the package changes triggered.
+    Returns {action: [matched paths]} in the order of hooks.
+    """
+    actions = {}
+    for hook, triggers in hooks.items():
+        action = DEFERRED_HOOKS[hook]
+        for trigger in triggers:
+            for operation, name, files in changes:
+                if operation not in trigger["operations"]:
+                    continue
+                if trigger["type"] == "Package":
+                    if match_hook_targets(name, trigger["targets"]):
+                        actions.setdefault(action, [])
+                    continue
+                matched = [path for path in files if match_hook_targets(path, trigger["targets"])]
+                if matched:
+                    actions.setdefault(action, []).extend(matched)
+    return {action: sorted(set(paths)) for action, paths in actions.items()}
+
+def mask_hooks(install_path):
+    """
+    Masks the heavy hooks from DEFERRED_HOOKS that exist in the target.
+    Returns the list of hook files that were masked.
+    """
+    hooks_dir = os.path.join(install_path, "etc/pacman.d/hooks")
+    masked = []
+
+    for hook in DEFERRED_HOOKS:
+        override = os.path.join(hooks_dir, hook)
+        if not os.path.exists(os.path.join(install_path, "usr/share/libalpm/hooks", hook)):
+            continue
+        if os.path.lexists(override):
+            # An admin override already exists, leave it alone
+            continue
+        try:
+            os.makedirs(hooks_dir, exist_ok=True)
+            os.symlink("/dev/null", override)
+            masked.append(hook)
+        except OSError as e:
+            libcalamares.utils.warning(f"Failed to hold back hook {hook}: {e}")
+
+    return masked
+
+def unmask_hooks(install_path, masked):
+    """Removes the /dev/null overrides created by mask_hooks()."""
+    for hook in masked:
+        try:
+            os.remove(os.path.join(install_path, "etc/pacman.d/hooks", hook))
+        except OSError as e:
+            libcalamares.utils.warning(f"Failed to restore hook {hook}: {e}")
+
+def _path_components(paths, prefix):
+    """Returns the names right below prefix in the given paths ("usr/share/icons/" -> themes)."""
+    return {path[len(prefix):].split("/", 1)[0] for path in paths if path.startswith(prefix)} - {""}
+
+def run_deferred_hooks(install_path, actions, paths=None):
+    """
+    Runs the work of each held back hook once.
+    The initramfs is left to the initcpio module when deferInitramfs is set,
+    so it is generated a single time for the whole exec phase. With paths
+    ({action: matched paths}), depmod and the icon cache only run for the
+    kernels and themes the transactions touched.
+    """
+    if "initramfs" in actions and not alg_runner.get_config("deferInitramfs", True):
+        alg_runner.run_target(["mkinitcpio", "-P"], HOOK_TIMEOUT)
+
+    if "depmod" in actions:
+        modules_dir = os.path.join(install_path, "usr/lib/modules")
+        kernels = sorted(os.listdir(modules_dir)) if os.path.isdir(modules_dir) else []
+        if paths is not None:
+            kernels = [kernel for kernel in kernels
+                       if kernel in _path_components(paths.get("depmod", []), "usr/lib/modules/")]
+        for kernel in kernels:
+            if os.path.isdir(os.path.join(modules_dir, kernel, "kernel")):
+                alg_runner.run_target(["depmod", kernel], HOOK_TIMEOUT)
+
+    if "fontconfig" in actions:
+        alg_runner.run_target(["fc-cache", "-s"], HOOK_TIMEOUT)
+
+    if "icon-cache" in actions:
+        icons_dir = os.path.join(install_path, "usr/share/icons")
+        themes = sorted(os.listdir(icons_dir)) if os.path.isdir(icons_dir) else []
+        if paths is not None:
+            themes = [theme for theme in themes
+                      if theme in _path_components(paths.get("icon-cache", []), "usr/share/icons/")]
+        for theme in themes:
+            if os.path.exists(os.path.join(icons_dir, theme, "index.theme")):
+                alg_runner.run_target(
+                    ["gtk-update-icon-cache", "-q", "-t", "-f", f"/usr/share/icons/{theme}"], HOOK_TIMEOUT
+                )
+
+@contextlib.contextmanager
+def timing_span(spans, name):
+    """
+    Records the wall time of a block and the pacman commands it ran.
+    Appends {"step", "seconds", "commands"} to spans, unless spans is None.
+    """
+    first_call = len(_pacman_calls)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if spans is not None:
+            spans.append({
+                "step": name,
+                "seconds": round(time.monotonic() - start, 3),
+                "commands": _pacman_calls[first_call:],
+            })
+
+@contextlib.contextmanager
+def held_hooks(install_path, spans=None):
+    """
+    Holds back heavy hooks for the duration of the block, then runs once
+    each of them that a transaction in the block triggered, judged from the
+    hooks' [Trigger] sections and the files of the packages that changed.
+    The deferred actions are published as "deferred_hooks".
+    """
+    masked = mask_hooks(install_path)
+    hooks = {hook: read_hook_triggers(os.path.join(install_path, "usr/share/libalpm/hooks", hook))
+             for hook in masked}
+    prefixes = get_trigger_prefixes(hooks)
+    # Files of the packages about to be removed are gone afterwards
+    before = snapshot_package_files(install_path, prefixes) if masked else {}
+    try:
+        yield
+    finally:
+        unmask_hooks(install_path, masked)
+
+    paths = get_triggered_actions(hooks, get_package_changes(install_path, before, prefixes)) if masked else {}
+    actions = list(paths)
+    libcalamares.globalstorage.insert("deferred_hooks", actions)
+    with timing_span(spans, "hooks"):
+        run_deferred_hooks(install_path, actions, paths)
+
+def is_dry_run():
+    """
+    Checks whether the module should only compute its plan.
+    Enabled by the "dry_run" GS key or the dryRun module setting.
+    """
+    return bool(libcalamares.globalstorage.value("dry_run") or alg_runner.get_config("dryRun", False))
+
+def build_plan(local_db):
+    """
+    Computes every action the module would take, without touching the target.
+    Returns a dict with the ordered steps, the estimated bytes freed and
+    the number of pacman invocations the plan needs.
+    """
+    steps = []
+
+    repositories = get_optimized_repositories()
+    if repositories:
+        steps.append({"action": "repositories", "repositories": repositories})
+
+    nvidia = plan_nvidia_driver()
+    if nvidia["blacklist"]:
+        steps.append({"action": "blacklist", "module": "nouveau", "family": nvidia["family"]})
+
+    sources = get_removal_sources()
+    removals = plan_removals(local_db, sources)
+    if removals:
+        steps.append({
+            "action": "remove",
+            "packages": removals,
+            "sources": {name: [pkg for pkg in pkgs if pkg in removals]
+                        for name, pkgs in sources.items()},
+            "bytes": estimate_freed_bytes(removals, local_db),
+        })
+
+    install_sources = get_install_sources(local_db)
+    installs = get_install_packages(local_db, install_sources)
+    if installs:
+        offline, network = plan_installs(installs)
+        steps.append({
+            "action": "install",
+            "packages": installs,
+            "sources": {name: pkgs for name, pkgs in install_sources.items() if pkgs},
+            "offline": offline,
+            "network": network,
+            "replaceConflicts": bool(nvidia["replace"]) and any(pkg in installs for pkg in nvidia["install"]),
+        })
+
+    replaced = [pkg for pkg in nvidia["replace"] if pkg in local_db]
+    if replaced:
+        steps.append({
+            "action": "replace-driver",
+            "family": nvidia["family"],
+            "requires": nvidia["install"],
+            "packages": replaced,
+        })
+
+    return {
+        "inputs": {
+            "cpu_vendor": libcalamares.globalstorage.value("cpu_vendor"),
+            "cpu_info": libcalamares.globalstorage.value("cpu_info"),
+            "firmwareType": libcalamares.globalstorage.value("firmwareType"),
+            "kernel_boot_mode": libcalamares.globalstorage.value("kernel_boot_mode"),
+        },
+        "steps": steps,
+        "bytesFreed": sum(step.get("bytes", 0) for step in steps),
+        "pacmanInvocations": sum(
+            bool(step["offline"]) + bool(step["network"]) if step["action"] == "install" else 1
+            for step in steps if step["action"] in ("remove", "install", "replace-driver")
+        ),
+    }
+
+def write_plan(plan, plan_file):
+    """Write the transaction plan as JSON."""
+    try:
+        with open(plan_file, "w") as f:
+            json.dump(plan, f, indent=2)
+        libcalamares.utils.debug(f"Transaction plan written to {plan_file}")
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to write transaction plan: {e}")
+
+def execute_plan(plan, install_path, spans=None):
+    """
+    Carries out the steps of a transaction plan in order.
+    Each step is timed and advances the job progress.
+    """
+    global _progress_range
+
+    steps = plan["steps"]
+    for index, step in enumerate(steps):
+        # The last slice of the progress bar is left for the deferred hooks
+        _progress_range = (0.9 * index / len(steps), 0.9 * (index + 1) / len(steps))
+        with timing_span(spans, step["action"]):
+            if step["action"] == "repositories":
+                add_optimized_repositories(install_path, step["repositories"])
+            elif step["action"] == "blacklist":
+                blacklist_nouveau(install_path)
+            elif step["action"] == "remove":
+                failed = remove_packages(step["packages"])
+                if failed:
+                    libcalamares.utils.warning(f"Packages left installed: {failed}")
+            elif step["action"] == "install":
+                install_packages(install_path, step["offline"], step["network"], step.get("replaceConflicts", False))
+            elif step["action"] == "replace-driver":
+                kept = replace_nvidia_driver(install_path, step["family"], step["requires"], step["packages"])
+                if kept:
+                    libcalamares.utils.warning(f"Previous NVIDIA driver packages left installed: {kept}")
+        report_step_progress(1.0)
+    _progress_range = (0.0, 1.0)
+
+def report_timings(spans):
+    """Writes the timing summary to globalstorage and the install log."""
+    libcalamares.globalstorage.insert("packages_remover_timings", spans)
+    for span in spans:
+        commands = ", ".join(
+            f"{' '.join(call['command'][:2])} exit {call['exit']} in {call['seconds']}s"
+            for call in span["commands"]
+        )
+        libcalamares.utils.debug(f"packages_remover: {span['step']} took {span['seconds']}s"
+                                 + (f" [{commands}]" if commands else ""))
+
 def run():
     """
     Main entry point for the packages module.
@@ -124,83 +1266,38 @@ def run():
     if not install_path:
         return "No install path specified", False
 
-    # Remove pacman db lock if it exists
-    remove_db_lock(install_path)
+    spans = []
+
+    # Index installed packages once for every step below
+    with timing_span(spans, "local-db"):
+        local_db = read_local_db(install_path)
+    with timing_span(spans, "plan"):
+        plan = build_plan(local_db)
+    libcalamares.globalstorage.insert("packages_remover_plan", plan)
+
+    if is_dry_run():
+        write_plan(plan, alg_runner.get_config("planFile", "/tmp/packages_remover-plan.json"))
+        report_timings(spans)
+        return None
+
+    # Make sure no pacman is running in the target, break a stale lock
+    with timing_span(spans, "lock"):
+        unlocked = wait_for_db_lock(install_path)
+    if not unlocked:
+        report_timings(spans)
+        return "The pacman database in the target is locked", False
 
     # Perform all package operations
-    remove_cpu_microcode_packages()
-    remove_firmware_packages()
-    remove_nvidia_drivers()
-    remove_livecd_packages()
-    handle_packagechooser_packages()
+    if plan["pacmanInvocations"]:
+        with held_hooks(install_path, spans):
+            execute_plan(plan, install_path, spans)
+    else:
+        execute_plan(plan, install_path, spans)
+    libcalamares.job.setprogress(1.0)
+    report_timings(spans)
 
-    return None
+    # Queued work has been folded into this run's transactions
+    libcalamares.globalstorage.insert("pacman_queue", [])
 
-# TODO: 4
-# def remove_nvidia_packages():
-#     supported_nvidia_gpus_rtx = (
-#     "GeForce RTX 2060, "
-#     "GeForce RTX 2060 Super, "
-#     "GeForce RTX 2070, "
-#     "GeForce RTX 2070 Super, "
-#     "GeForce RTX 2080, "
-#     "GeForce RTX 2080 Super, "
-#     "GeForce RTX 2080 Ti, "
-#     "GeForce GTX 1660, "
-#     "GeForce GTX 1660 Ti, "
-#     "GeForce GTX 1660 Super, "
-#     "GeForce RTX 3060, "
-#     "GeForce RTX 3060 Ti, "
-#     "GeForce RTX 3070, "
-#     "GeForce RTX 3070 Ti, "
-#     "GeForce RTX 3080, "
-#     "GeForce RTX 3080 Ti, "
-#     "GeForce RTX 3090, "
-#     "GeForce RTX 4060, "
-#     "GeForce RTX 4060 Ti, "
-#     "GeForce RTX 4070, "
-#     "GeForce RTX 4070 Ti, "
-#     "GeForce RTX 4080, "
-#     "GeForce RTX 4090")
-#
-#     supported_nvidia_gpus_gtx = (
-#     "GeForce GTX 750, "
-#     "GeForce GTX 750 Ti, "
-#     "GeForce GTX 760, "
-#     "GeForce GTX 770, "
-#     "GeForce GTX 780, "
-#     "GeForce GTX 780 Ti, "
-#     "GeForce GTX 850M, "
-#     "GeForce GTX 860M, "
-#     "GeForce GTX 870M, "
-#     "GeForce GTX 880M, "
-#     "GeForce GTX 950, "
-#     "GeForce GTX 960, "
-#     "GeForce GTX 970, "
-#     "GeForce GTX 980, "
-#     "GeForce GTX 980 Ti, "
-#     "GeForce GTX 1050, "
-#     "GeForce GTX 1050 Ti, "
-#     "GeForce GTX 1060, "
-#     "GeForce GTX 1070, "
-#     "GeForce GTX 1070 Ti, "
-#     "GeForce GTX 1080, "
-#     "GeForce GTX 1080 Ti")
-#
-#     nvidia_gpu_info = libcalamares.globalstorage.value("nvidia_gpu_name")
-#
-#      if "NVIDIA" in nvidia_gpu_info and any(gpu in nvidia_gpu_info for gpu in supported_nvidia_gpus_rtx.split(", ")):
-#         try:
-#             libcalamares.utils.target_env_call(['pacman', '-S', '--noconfirm', 'nvidia-open'])
-#             print("nvidia-open package installed successfully.")
-#         except Exception as e:
-#             libcalamares.utils.warning(f"Failed to install nvidia-open: {e}")
-#
-#     elif "NVIDIA" in nvidia_gpu_info and any(gpu in nvidia_gpu_info for gpu in supported_nvidia_gpus_gtx.split(", ")):
-#         try:
-#             libcalamares.utils.target_env_call(['pacman', '-S', '--noconfirm', 'nvidia'])
-#             print("nvidia package installed successfully.")
-#         except Exception as e:
-#             libcalamares.utils.warning(f"Failed to install nvidia: {e}")
-#     else:
-#         print("No supported NVIDIA GPU detected. Skipping installation of NVIDIA drivers.")
+    alg_runner.publish("packages_remover")
+    return None
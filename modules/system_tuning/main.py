@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+
+"""
+ALG Custom Install Module - System Tuning
+This file is part of the ALG project and is
+meant to be shipped with calamares.
+"""
+
+import os
+import re
+import shlex
+import libcalamares
+import alg_runner
+
+# This module tunes the installed system for the hardware it was installed on.
+# It relies on the hardware_detection module for the hardware facts, and
+# writes straight into the target instead of spawning tools in the chroot.
+
+SYSFS_BLOCK_PATH = "/sys/class/block"
+
+SCHEDULER_RULES_FILE = "etc/udev/rules.d/60-ioschedulers.rules"
+
+# Which kernel disk names each kind of disk can have
+SCHEDULER_RULE_MATCHES = {
+    "nvme": 'KERNEL=="nvme[0-9]*n[0-9]*"',
+    "ssd": 'KERNEL=="sd[a-z]*|mmcblk[0-9]*|vd[a-z]*", ATTR{queue/rotational}=="0"',
+    "hdd": 'KERNEL=="sd[a-z]*|vd[a-z]*", ATTR{queue/rotational}=="1"',
+}
+
+DEFAULT_SCHEDULERS = {"nvme": "none", "ssd": "mq-deadline", "hdd": "bfq"}
+
+FSTRIM_TIMER = "usr/lib/systemd/system/fstrim.timer"
+TIMERS_WANTS_DIR = "etc/systemd/system/timers.target.wants"
+
+# File systems whose mount options are tuned
+TUNABLE_FILESYSTEMS = {"ext4", "btrfs", "xfs", "f2fs"}
+
+ZRAM_GENERATOR = "usr/lib/systemd/system-generators/zram-generator"
+ZRAM_CONFIG = "etc/systemd/zram-generator.conf"
+SWAPFILE = "swapfile"
+SWAP_SYSCTL = "etc/sysctl.d/99-swap.conf"
+
+# Seconds mkswap or btrfs mkswapfile may take on a slow disk
+SWAPFILE_TIMEOUT = 300
+
+# Swappiness for each kind of swap. Swapping to compressed RAM is cheaper
+# than dropping page cache, so zram wants a value above 100.
+DEFAULT_SWAPPINESS = {"zram": 180, "swapfile": 60}
+
+# Config files holding the parallelism knobs
+MKINITCPIO_CONF = "etc/mkinitcpio.conf"
+MAKEPKG_CONF = "etc/makepkg.conf"
+PACMAN_CONF = "etc/pacman.conf"
+
+# mkinitcpio compressors that take -T0; an unset COMPRESSION means zstd
+THREADED_COMPRESSORS = {"zstd", "xz"}
+DEFAULT_COMPRESSION = "zstd"
+
+# Access time options that noatime supersedes
+_ATIME_OPTIONS = {"atime", "relatime", "strictatime", "noatime"}
+
+def get_block_devices():
+    """Return the physical disks found by hardware_detection, keyed by name."""
+    return {device["name"]: device
+            for device in libcalamares.globalstorage.value("block_devices") or []}
+
+def get_parent_disk(device, sysfs_path=SYSFS_BLOCK_PATH):
+    """
+    Maps a device node such as /dev/nvme0n1p2 to the name of its disk.
+    A whole disk maps to itself; returns None for unknown devices.
+    """
+    name = os.path.basename(device or "")
+    entry = os.path.join(sysfs_path, name)
+    if not name or not os.path.exists(entry):
+        return None
+    if os.path.exists(os.path.join(entry, "partition")):
+        return os.path.basename(os.path.dirname(os.path.realpath(entry)))
+    return name
+
+def get_target_mounts(block_devices, sysfs_path=SYSFS_BLOCK_PATH):
+    """
+    Maps every mount point of the target to the disk it lives on.
+    Returns {mount point: block device dict}.
+    """
+    mounts = {}
+    for partition in libcalamares.globalstorage.value("partitions") or []:
+        mount_point = partition.get("mountPoint")
+        disk = get_parent_disk(partition.get("device"), sysfs_path)
+        if mount_point and disk in block_devices:
+            mounts[mount_point] = block_devices[disk]
+    return mounts
+
+def write_scheduler_rules(root, block_devices):
+    """
+    Writes udev rules selecting the I/O scheduler for each kind of disk in
+    the machine. Returns the kinds a rule was written for.
+    """
+    schedulers = {**DEFAULT_SCHEDULERS, **alg_runner.get_config("ioSchedulers", {})}
+    kinds = sorted({device["kind"] for device in block_devices.values()
+                    if device["kind"] in SCHEDULER_RULE_MATCHES and schedulers.get(device["kind"])})
+    if not kinds:
+        return []
+
+    lines = ["# I/O schedulers chosen by the installer for the disks in this machine"]
+    for kind in kinds:
+        lines.append(f'ACTION=="add|change", ENV{{DEVTYPE}}=="disk", {SCHEDULER_RULE_MATCHES[kind]}, '
+                     f'ATTR{{queue/scheduler}}="{schedulers[kind]}"')
+
+    rules_path = os.path.join(root, SCHEDULER_RULES_FILE)
+    try:
+        os.makedirs(os.path.dirname(rules_path), exist_ok=True)
+        with open(rules_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to write I/O scheduler rules: {e}")
+        return []
+
+    libcalamares.utils.debug(f"I/O scheduler rules written for {kinds}")
+    return kinds
+
+def enable_fstrim_timer(root):
+    """Enables fstrim.timer in the target the way systemctl enable would."""
+    wants_dir = os.path.join(root, TIMERS_WANTS_DIR)
+    link = os.path.join(wants_dir, "fstrim.timer")
+    if not os.path.exists(os.path.join(root, FSTRIM_TIMER)):
+        libcalamares.utils.warning("fstrim.timer is not installed in the target")
+        return False
+    if os.path.lexists(link):
+        return True
+
+    try:
+        os.makedirs(wants_dir, exist_ok=True)
+        os.symlink(f"/{FSTRIM_TIMER}", link)
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to enable fstrim.timer: {e}")
+        return False
+
+    libcalamares.utils.debug("fstrim.timer enabled")
+    return True
+
+def tune_mount_options(options, extra):
+    """
+    Adds the extra options to a comma separated fstab option string.
+    noatime replaces any other access time option.
+    """
+    current = [option for option in options.split(",") if option and option != "defaults"]
+    if "noatime" in extra:
+        current = [option for option in current if option not in _ATIME_OPTIONS]
+    current += [option for option in extra if option not in current]
+    return ",".join(current) or "defaults"
+
+def tune_fstab(root, mounts, trim):
+    """
+    Rewrites the mount options of the target's fstab entries for the
+    disk each one lives on. Returns the mount points that were changed.
+    """
+    mount_options = alg_runner.get_config("mountOptions", {})
+    fstab_path = os.path.join(root, "etc/fstab")
+    try:
+        with open(fstab_path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to read fstab: {e}")
+        return []
+
+    changed = []
+    for index, line in enumerate(lines):
+        if line.lstrip().startswith("#"):
+            continue
+        # Keep the original column alignment by splitting on the separators
+        fields = re.split(r"(\s+)", line)
+        if len(fields) < 7 or fields[2] not in mounts or fields[4] not in TUNABLE_FILESYSTEMS:
+            continue
+        disk = mounts[fields[2]]
+        extra = list(mount_options.get(disk["kind"], []))
+        if trim == "discard" and disk["discard"] and not disk["rotational"]:
+            extra.append("discard")
+        options = tune_mount_options(fields[6], extra)
+        if options != fields[6]:
+            fields[6] = options
+            lines[index] = "".join(fields)
+            changed.append(fields[2])
+
+    if not changed:
+        return changed
+
+    try:
+        with open(fstab_path + ".new", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(fstab_path + ".new", fstab_path)
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to write fstab: {e}")
+        return []
+
+    libcalamares.utils.debug(f"Mount options tuned for {changed}")
+    return changed
+
+def get_root_filesystem():
+    """Returns the file system type of the target's root partition."""
+    for partition in libcalamares.globalstorage.value("partitions") or []:
+        if partition.get("mountPoint") == "/":
+            return partition.get("fs", "")
+    return ""
+
+def has_disk_swap():
+    """Checks whether the user set up a swap partition."""
+    return any(partition.get("fs") == "linuxswap"
+               for partition in libcalamares.globalstorage.value("partitions") or [])
+
+def plan_swap(memory_kib, threads, disk_swap, zram_available, mode="auto"):
+    """
+    Sizes swap for the target from its RAM and CPU count.
+    Returns {"type", "size_mib", "algorithm", "swappiness"}, type None when
+    no swap is set up.
+    zram gets all of RAM on small machines and half of it, at least 4 GiB
+    and at most 16 GiB, on bigger ones; CPUs with few threads use the
+    cheaper lz4 instead of zstd. A swapfile is only a fallback when there
+    is neither zram-generator nor a swap partition.
+    """
+    memory_mib = memory_kib // 1024
+    swappiness = {**DEFAULT_SWAPPINESS, **alg_runner.get_config("swappiness", {})}
+    plan = {"type": None, "size_mib": 0, "algorithm": None, "swappiness": None}
+    if mode == "none" or memory_mib <= 0:
+        return plan
+
+    if mode in ("auto", "zram") and zram_available:
+        plan.update(
+            type="zram",
+            size_mib=min(memory_mib, max(memory_mib // 2, 4096), 16384),
+            algorithm="zstd" if threads >= 4 else "lz4",
+        )
+    elif mode in ("auto", "swapfile") and not disk_swap:
+        plan.update(
+            type="swapfile",
+            size_mib=memory_mib * 2 if memory_mib <= 2048 else min(memory_mib, 8192),
+        )
+    else:
+        return plan
+
+    plan["swappiness"] = swappiness[plan["type"]]
+    return plan
+
+def write_zram_config(root, plan):
+    """Writes the zram-generator configuration for the swap plan."""
+    config_path = os.path.join(root, ZRAM_CONFIG)
+    try:
+        os.makedirs(os.path.dirname(config_path), exist_ok=True)
+        with open(config_path, "w") as f:
+            f.write("[zram0]\n"
+                    f"zram-size = {plan['size_mib']}\n"
+                    f"compression-algorithm = {plan['algorithm']}\n"
+                    "swap-priority = 100\n")
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to write zram-generator configuration: {e}")
+        return False
+
+    libcalamares.utils.debug(f"zram configured: {plan['size_mib']} MiB, {plan['algorithm']}")
+    return True
+
+def create_swapfile(root, plan, filesystem):
+    """
+    Creates /swapfile in the target and adds it to fstab.
+    btrfs swapfiles must not be copy-on-write, so btrfs-progs creates those.
+    """
+    swapfile = os.path.join(root, SWAPFILE)
+    if os.path.exists(swapfile):
+        libcalamares.utils.warning("The target already has a swapfile")
+        return False
+
+    try:
+        if filesystem == "btrfs":
+            command = ["btrfs", "filesystem", "mkswapfile", "--size", f"{plan['size_mib']}m", f"/{SWAPFILE}"]
+        else:
+            fd = os.open(swapfile, os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                os.posix_fallocate(fd, 0, plan["size_mib"] * 1024 * 1024)
+            finally:
+                os.close(fd)
+            command = ["mkswap", f"/{SWAPFILE}"]
+        if not alg_runner.run_target(command, SWAPFILE_TIMEOUT).ok:
+            raise OSError(f"{command[0]} failed")
+        with open(os.path.join(root, "etc/fstab"), "a") as f:
+            f.write(f"/{SWAPFILE} none swap defaults 0 0\n")
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to create swapfile: {e}")
+        if os.path.exists(swapfile):
+            os.remove(swapfile)
+        return False
+
+    libcalamares.utils.debug(f"Swapfile created: {plan['size_mib']} MiB")
+    return True
+
+def write_swap_sysctl(root, plan):
+    """Writes the swap related sysctl settings for the swap plan."""
+    lines = [f"vm.swappiness = {plan['swappiness']}"]
+    if plan["type"] == "zram":
+        # Read-ahead makes no sense for swap that lives in RAM
+        lines.append("vm.page-cluster = 0")
+
+    sysctl_path = os.path.join(root, SWAP_SYSCTL)
+    try:
+        os.makedirs(os.path.dirname(sysctl_path), exist_ok=True)
+        with open(sysctl_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    except OSError as e:
+        libcalamares.utils.warning(f"Failed to write swap sysctl settings: {e}")
+        return False
+    return True
+
+def configure_swap(root):
+    """Sizes and sets up zram or a swapfile in the target."""
+    gs = libcalamares.globalstorage
+    cpu_info = gs.value("cpu_info") or {}
+    plan = plan_swap(
+        gs.value("memory_total_kib") or 0,
+        cpu_info.get("threads", 0),
+        has_disk_swap(),
+        os.path.exists(os.path.join(root, ZRAM_GENERATOR)),
+        alg_runner.get_config("swap", "auto"),
+    )
+    gs.insert("swap_plan", plan)
+    if plan["type"] is None:
+        libcalamares.utils.debug("No swap set up by system_tuning")
+        return plan
+
+    if plan["type"] == "zram":
+        configured = write_zram_config(root, plan)
+    else:
+        configured = create_swapfile(root, plan, get_root_filesystem())
+    if configured:
+        write_swap_sysctl(root, plan)
+    return plan
+
+def get_initramfs_compression(root):
+    """
+    Returns the compressor the target's mkinitcpio.conf sets, the default
+    when it sets none, or None when the file cannot be read.
+    """
+    try:
+        with open(os.path.join(root, MKINITCPIO_CONF), "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    compression = DEFAULT_COMPRESSION
+    for line in lines:
+        # The file is sourced by bash, the last assignment wins
+        match = re.match(r"""^\s*COMPRESSION\s*=\s*["']?([^"'\s#]*)""", line)
+        if match:
+            compression = match.group(1) or DEFAULT_COMPRESSION
+    return compression
+
+def get_compression_options(root):
+    """
+    Returns the options the target's mkinitcpio.conf passes to the
+    compressor, an empty list when it sets none.
+    """
+    try:
+        with open(os.path.join(root, MKINITCPIO_CONF), "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    options = []
+    for line in lines:
+        match = re.match(r"^\s*COMPRESSION_OPTIONS\s*=\s*\((.*)\)", line)
+        if match:
+            try:
+                options = shlex.split(match.group(1), comments=True)
+            except ValueError:
+                options = []
+    return options
+
+def _has_thread_option(options):
+    return any(option.startswith("-T") or option.startswith("--threads") for option in options)
+
+def plan_parallelism(threads, compression=DEFAULT_COMPRESSION, compression_options=()):
+    """
+    Works out the parallelism settings for a CPU with the given number of
+    threads, given the target's initramfs compressor and its options.
+    Returns {config file: [(key, line, section)]}.
+    """
+    edits = {}
+    if threads > 1:
+        if compression in THREADED_COMPRESSORS and not _has_thread_option(compression_options):
+            # -T0 lets the compressor use every core of whatever machine rebuilds the initramfs
+            options = " ".join(shlex.quote(option) for option in [*compression_options, "-T0"])
+            edits[MKINITCPIO_CONF] = [("COMPRESSION_OPTIONS", f"COMPRESSION_OPTIONS=({options})", None)]
+        if alg_runner.get_config("makeflags", True):
+            edits[MAKEPKG_CONF] = [("MAKEFLAGS", f'MAKEFLAGS="-j{threads}"', None)]
+
+    downloads = alg_runner.get_config("parallelDownloads", 5)
+    if downloads and downloads > 1:
+        edits[PACMAN_CONF] = [("ParallelDownloads", f"ParallelDownloads = {downloads}", "options")]
+
+    return edits
+
+def _find_key(lines, key, section):
+    """
+    Finds the line setting key, commented out or not, inside section.
+    Returns (index of the line or None, index to insert a new line at).
+    """
+    pattern = re.compile(rf"^\s*#?\s*{re.escape(key)}\s*=")
+    current = None
+    found = None
+    insert_at = len(lines)
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            if current == section and section is not None:
+                insert_at = index
+                break
+            current = stripped[1:-1]
+            if current == section:
+                insert_at = index + 1
+            continue
+        if current == section and pattern.match(line):
+            # A live setting wins over a commented-out example
+            if found is None or not line.lstrip().startswith("#"):
+                found = index
+            if not line.lstrip().startswith("#"):
+                break
+    return found, insert_at
+
+def apply_config_edits(root, edits):
+    """
+    Applies the edits of each config file in memory and writes every file
+    once. Files missing from the target are skipped.
+    Returns the files that were changed.
+    """
+    changed = []
+    for relative_path, settings in edits.items():
+        path = os.path.join(root, relative_path)
+        try:
+            with open(path, "r") as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            libcalamares.utils.warning(f"Failed to read {relative_path}: {e}")
+            continue
+
+        original = list(lines)
+        for key, new_line, section in settings:
+            found, insert_at = _find_key(lines, key, section)
+            if found is not None:
+                lines[found] = new_line
+                continue
+            # Keep the blank line that separates sections
+            while insert_at > 0 and not lines[insert_at - 1].strip():
+                insert_at -= 1
+            lines.insert(insert_at, new_line)
+        if lines == original:
+            continue
+
+        try:
+            with open(path + ".new", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(path + ".new", path)
+        except OSError as e:
+            libcalamares.utils.warning(f"Failed to write {relative_path}: {e}")
+            continue
+        changed.append(relative_path)
+
+    if changed:
+        libcalamares.utils.debug(f"Parallelism settings written to {changed}")
+    return changed
+
+def run():
+    """
+    Main entry point for the system tuning module.
+    Tunes I/O schedulers, trimming and mount options for the target disks,
+    sizes swap for its memory and sets parallelism for its CPU.
+    """
+    root = libcalamares.globalstorage.value("rootMountPoint")
+    if not root:
+        return "No install path specified", False
+
+    cpu_info = libcalamares.globalstorage.value("cpu_info") or {}
+    apply_config_edits(root, plan_parallelism(cpu_info.get("threads", 0), get_initramfs_compression(root),
+                                              get_compression_options(root)))
+    configure_swap(root)
+    # Swap setup is the only step that starts processes
+    alg_runner.publish("system_tuning")
+
+    block_devices = get_block_devices()
+    if not block_devices:
+        libcalamares.utils.warning("No block devices found in global storage, skipping storage tuning")
+        return None
+
+    mounts = get_target_mounts(block_devices)
+    trim = alg_runner.get_config("trim", "timer")
+
+    write_scheduler_rules(root, block_devices)
+    if trim == "timer" and any(disk["discard"] and not disk["rotational"] for disk in mounts.values()):
+        enable_fstrim_timer(root)
+    tune_fstab(root, mounts, trim)
+
+    return None
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the libcalamares module that Calamares provides to
+Python jobs, so the modules can be imported and run outside the installer.
+
+It keeps the parts of the API the modules use:
+    - globalstorage: an in-memory GlobalStorage
+    - job: configuration, working_path and the progress reported
+    - utils: logging, mount, raised_privileges and the target_env_*
+      calls, which run against the fake chroot below
+
+Commands "run in the target" never spawn a process. They are dispatched
+by program name to handlers registered on chroot, optionally sleep for a
+simulated latency, and are recorded in chroot.calls:
+
+    libcalamares.reset()
+    libcalamares.chroot.on("pacman", lambda args: (0, ["Packages (1) foo"]))
+    libcalamares.chroot.latency["pacman"] = 0.05
+
+Tests that need a clean installer state call reset().
+
+Importing it also puts modules/ on the Python path, where alg_runner is
+importable like it is in the installer.
+"""
+
+import os
+import sys
+import time
+import threading
+import contextlib
+import subprocess
+
+_MODULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "modules")
+if _MODULES_DIR not in sys.path:
+    sys.path.append(_MODULES_DIR)
+
+# Exit code Calamares reports for a target command that missed its deadline
+TIMED_OUT = -4
+
+class GlobalStorage:
+    """Dict-backed globalstorage."""
+
+    def __init__(self):
+        self._values = {}
+
+    def value(self, key):
+        return self._values.get(key)
+
+    def insert(self, key, value):
+        self._values[key] = value
+
+    def contains(self, key):
+        return key in self._values
+
+    def remove(self, key):
+        return self._values.pop(key, None) is not None
+
+    def keys(self):
+        return list(self._values)
+
+    def count(self):
+        return len(self._values)
+
+    def clear(self):
+        self._values.clear()
+
+class Job:
+    """The running job: its module configuration, directory and progress."""
+
+    def __init__(self):
+        self.configuration = {}
+        self.working_path = ""
+        self.module_name = ""
+        self.pretty_name = ""
+        self.progress = []
+
+    def setprogress(self, progress):
+        self.progress.append(progress)
+
+class FakeChroot:
+    """
+    The target system commands are run in.
+    A handler takes the command's arguments (without the program name) and
+    returns (exit status, output lines). Programs without a handler succeed
+    without output.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.latency = {}
+        self.calls = []
+        self.mounts = []
+        self._lock = threading.Lock()
+
+    def on(self, program, handler):
+        """Registers the handler run for a program."""
+        self.handlers[program] = handler
+
+    def run(self, command, timeout=0):
+        """
+        Runs a command in the target. A command whose latency exceeds the
+        timeout (in seconds, 0 for none) is cut off like Calamares does.
+        Returns (exit status, output lines).
+        """
+        program = command[0]
+        with self._lock:
+            self.calls.append(list(command))
+        delay = self.latency.get(program, 0)
+        if timeout and delay > timeout:
+            time.sleep(timeout)
+            return TIMED_OUT, []
+        if delay:
+            time.sleep(delay)
+        handler = self.handlers.get(program)
+        if handler is None:
+            return 0, []
+        status, lines = handler(list(command[1:]))
+        return status, list(lines)
+
+    def count(self, program=None):
+        """Number of commands run, or of those running program."""
+        return sum(1 for call in self.calls if program is None or call[0] == program)
+
+    def reset(self):
+        self.handlers.clear()
+        self.latency.clear()
+        self.calls.clear()
+        self.mounts.clear()
+
+class Utils:
+    """libcalamares.utils, logging to lists instead of the session log."""
+
+    def __init__(self, chroot):
+        self._chroot = chroot
+        self.debug_log = []
+        self.warning_log = []
+
+    def debug(self, message):
+        self.debug_log.append(message)
+
+    def warning(self, message):
+        self.warning_log.append(message)
+
+    def error(self, message):
+        self.warning_log.append(message)
+
+    def target_env_call(self, command, stdin=None, timeout=0):
+        status, _ = self._chroot.run(command, timeout)
+        return status
+
+    def check_target_env_call(self, command, stdin=None, timeout=0):
+        status, _ = self._chroot.run(command, timeout)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, command)
+        return 0
+
+    def check_target_env_output(self, command, stdin=None, timeout=0):
+        status, lines = self._chroot.run(command, timeout)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, command)
+        return "\n".join(lines)
+
+    def target_env_process_output(self, command, callback=None, stdin=None, timeout=0):
+        status, lines = self._chroot.run(command, timeout)
+        for line in lines:
+            if callback is not None:
+                callback(line)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, command)
+        return 0
+
+    def mount(self, device_path, mount_point, filesystem_type="", options=""):
+        self._chroot.mounts.append((device_path, mount_point, filesystem_type, options))
+        return 0
+
+    @contextlib.contextmanager
+    def raised_privileges(self):
+        yield
+
+    def reset(self):
+        self.debug_log.clear()
+        self.warning_log.clear()
+
+globalstorage = GlobalStorage()
+job = Job()
+chroot = FakeChroot()
+utils = Utils(chroot)
+
+def reset():
+    """Returns the installer to a clean state between tests."""
+    globalstorage.clear()
+    job.__init__()
+    chroot.reset()
+    utils.reset()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmarks of the module jobs.
+Each job's run() is timed against a fake target system, with pacman
+simulated by the fake chroot in tests/libcalamares.py, and the processes
+it spawns are counted. A job that spawns more processes or takes longer
+than its budget below fails the suite.
+
+TestExecSequence runs the ALG jobs in the order of settings.conf's exec
+sequence, with stand-ins for the calamares modules they depend on.
+"""
+
+import unittest
+from unittest.mock import patch
+import os
+import json
+import time
+import shutil
+import tempfile
+import functools
+import subprocess
+from pathlib import Path
+import sys
+
+import yaml
+
+import libcalamares
+
+sys.path.append(str(Path(__file__).parent.parent))
+import modules.hardware_detection.main as hardware_detection
+import modules.edition_chooser.main as edition_chooser
+import modules.packages_remover.main as packages_remover
+import alg_runner
+from modules.edition_chooser.compile_editions import compile_manifest
+from modules.hardware_detection.record_hardware import read_archive, replay_profile
+
+REPO_DIR = Path(__file__).parent.parent
+EDITIONS_MANIFEST = REPO_DIR / "modules" / "edition_chooser" / "editions.yaml"
+
+# Recorded machines hardware_detection is benchmarked on; point
+# ALG_HARDWARE_PROFILES at a fleet archive to run the whole fleet
+HARDWARE_PROFILES = os.environ.get("ALG_HARDWARE_PROFILES",
+                                   str(Path(__file__).parent / "fixtures" / "hardware-profiles.jsonl"))
+
+# Seconds each simulated pacman transaction takes
+PACMAN_LATENCY = 0.05
+
+# Process spawns (host and target) and best wall-clock seconds allowed per
+# scenario. Lower a budget when a change makes a job cheaper; raising one
+# should be a deliberate part of the change that needs it.
+BUDGETS = {
+    "hardware_detection/cold": {"spawns": 0, "seconds": 2.0},
+    "hardware_detection/cached": {"spawns": 0, "seconds": 0.5},
+    # per replayed profile
+    "hardware_detection/profiles": {"spawns": 0, "seconds": 0.05},
+    "edition_chooser/kde": {"spawns": 0, "seconds": 0.5},
+    "edition_chooser/gnome": {"spawns": 0, "seconds": 0.5},
+    # pacman -Rns, pacman -S; the removed and installed packages trigger no held back hook
+    "packages_remover/install": {"spawns": 2, "seconds": 2 * PACMAN_LATENCY + 0.5},
+}
+
+ROUNDS = 3
+
+# Packages installed in the fake target
+TARGET_PACKAGES = packages_remover.get_livecd_packages() + [
+    "linux", "bash", "amd-ucode", "intel-ucode", "efibootmgr", "refind-efi",
+    "nvidia", "nvidia-utils", "nvidia-settings", "qogir-icon-theme",
+]
+
+class SpawnCounter:
+    """Counts the processes started on the host while active."""
+
+    def __init__(self):
+        self.count = 0
+        self._popen = subprocess.Popen
+        self._patcher = patch("subprocess.Popen", self._counting_popen)
+
+    def _counting_popen(self, *args, **kwargs):
+        self.count += 1
+        return self._popen(*args, **kwargs)
+
+    def __enter__(self):
+        self._patcher.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._patcher.stop()
+
+def _write_desc(local_db, name):
+    entry = os.path.join(local_db, f"{name}-1.0-1")
+    os.makedirs(entry, exist_ok=True)
+    with open(os.path.join(entry, "desc"), "w") as f:
+        f.write(f"%NAME%\n{name}\n\n%VERSION%\n1.0-1\n\n%SIZE%\n4096\n\n")
+
+def make_target(root):
+    """Lays out a minimal installed system under root."""
+    local_db = os.path.join(root, "var/lib/pacman/local")
+    for name in TARGET_PACKAGES:
+        _write_desc(local_db, name)
+    hooks_dir = os.path.join(root, "usr/share/libalpm/hooks")
+    os.makedirs(hooks_dir)
+    for hook in ("90-mkinitcpio-install.hook", "60-depmod.hook", "fontconfig.hook"):
+        Path(hooks_dir, hook).touch()
+    os.makedirs(os.path.join(root, "usr/lib/modules/6.10.0-alg/kernel"))
+    os.makedirs(os.path.join(root, "etc"))
+    with open(os.path.join(root, "etc/pacman.conf"), "w") as f:
+        f.write("[options]\nArchitecture = auto\n\n[core]\nInclude = /etc/pacman.d/mirrorlist\n")
+
+def fake_pacman(root):
+    """Returns a chroot handler that applies pacman transactions to root's local DB."""
+    local_db = os.path.join(root, "var/lib/pacman/local")
+
+    def pacman(args):
+        operation = args[0]
+        targets = [arg for arg in args[1:] if not arg.startswith("-")]
+        installed = {entry.rsplit("-", 2)[0]: entry for entry in os.listdir(local_db)}
+
+        if operation == "-Rns":
+            missing = [pkg for pkg in targets if pkg not in installed]
+            if missing:
+                return 1, [f"error: target not found: {pkg}" for pkg in missing]
+            for pkg in targets:
+                shutil.rmtree(os.path.join(local_db, installed[pkg]))
+            verb = "removing"
+        else:
+            if operation == "-U":
+                targets = [os.path.basename(path).rsplit("-", 3)[0] for path in targets]
+            for pkg in targets:
+                _write_desc(local_db, pkg)
+            verb = "installing"
+
+        lines = [f"Packages ({len(targets)}) {' '.join(targets)}"]
+        lines += [f"({index}/{len(targets)}) {verb} {pkg}" for index, pkg in enumerate(targets, 1)]
+        return 0, lines
+
+    return pacman
+
+
+class ModuleBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        libcalamares.reset()
+        alg_runner.reset()
+        self.addCleanup(libcalamares.reset)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def measure(self, scenario, job, prepare=None, units=1):
+        """
+        Runs job ROUNDS times, each after prepare(), and checks the spawns
+        of every round and the best wall time against the scenario's budget,
+        which is per unit of work when the job handles several.
+        Returns the result of the last round.
+        """
+        budget = {key: value * units for key, value in BUDGETS[scenario].items()}
+        best = None
+        for _ in range(ROUNDS):
+            if prepare is not None:
+                prepare()
+            calls = len(libcalamares.chroot.calls) + len(libcalamares.chroot.mounts)
+            with SpawnCounter() as host:
+                start = time.perf_counter()
+                result = job()
+                seconds = time.perf_counter() - start
+            spawns = host.count + len(libcalamares.chroot.calls) + len(libcalamares.chroot.mounts) - calls
+            self.assertLessEqual(spawns, budget["spawns"],
+                                 f"{scenario} spawned {spawns} processes, budget {budget['spawns']}")
+            best = seconds if best is None else min(best, seconds)
+        self.assertLessEqual(best, budget["seconds"],
+                             f"{scenario} took {best:.3f}s, budget {budget['seconds']}s")
+        return result
+
+    def new_target(self):
+        root = tempfile.mkdtemp(dir=self.tmp.name)
+        make_target(root)
+        return root
+
+    def install_editions_index(self):
+        module_dir = os.path.join(self.tmp.name, "edition_chooser")
+        os.makedirs(module_dir, exist_ok=True)
+        with open(EDITIONS_MANIFEST, "r") as f:
+            compiled, errors = compile_manifest(yaml.safe_load(f))
+        self.assertEqual(errors, [])
+        with open(os.path.join(module_dir, edition_chooser.EDITIONS_INDEX), "w") as f:
+            json.dump(compiled, f)
+        libcalamares.job.working_path = module_dir
+
+
+class TestHardwareDetectionBenchmark(ModuleBenchmark):
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = os.path.join(self.tmp.name, "cache")
+        for name in ("load_snapshot", "save_snapshot"):
+            patcher = patch.object(hardware_detection, name,
+                                   functools.partial(getattr(hardware_detection, name), cache_dir=cache_dir))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache_dir = cache_dir
+
+    def test_cold_run(self):
+        self.measure("hardware_detection/cold", hardware_detection.run,
+                     prepare=lambda: shutil.rmtree(self.cache_dir, ignore_errors=True))
+        self.assertIsNotNone(libcalamares.globalstorage.value("cpu_info"))
+
+    def test_cached_run(self):
+        hardware_detection.run()
+        self.measure("hardware_detection/cached", hardware_detection.run)
+        self.assertIsNotNone(libcalamares.globalstorage.value("block_devices"))
+
+    def test_replayed_profiles(self):
+        roots = []
+        for profile in read_archive(HARDWARE_PROFILES):
+            root = tempfile.mkdtemp(dir=self.tmp.name)
+            replay_profile(profile, root)
+            roots.append(root)
+        self.assertTrue(roots)
+
+        def detect_all():
+            for root in roots:
+                libcalamares.job.configuration = {"replayRoot": root}
+                hardware_detection.run()
+
+        self.measure("hardware_detection/profiles", detect_all, units=len(roots))
+
+
+class TestEditionChooserBenchmark(ModuleBenchmark):
+
+    def run_edition(self, scenario, desktop):
+        self.install_editions_index()
+        home = os.path.join(self.tmp.name, "home")
+        os.makedirs(home)
+        root = self.new_target()
+
+        def prepare():
+            libcalamares.globalstorage.clear()
+            libcalamares.globalstorage.insert("rootMountPoint", root)
+            libcalamares.globalstorage.insert("theme_config", {"dark": False})
+            libcalamares.globalstorage.insert(edition_chooser.PACKAGECHOOSER_KEY, "themed")
+
+        def both_steps():
+            for step in edition_chooser.STEPS:
+                libcalamares.job.configuration = {"step": step}
+                result = edition_chooser.run()
+                if result is not None:
+                    return result
+            return None
+
+        with patch.dict(os.environ, {"XDG_CURRENT_DESKTOP": desktop, "HOME": home}):
+            self.assertIsNone(self.measure(scenario, both_steps, prepare))
+        return root
+
+    def test_kde(self):
+        root = self.run_edition("edition_chooser/kde", "KDE")
+        self.assertTrue(os.path.exists(os.path.join(root, "etc/skel/.config/kdeglobals")))
+        self.assertTrue(libcalamares.globalstorage.value("pacman_queue"))
+
+    def test_gnome(self):
+        root = self.run_edition("edition_chooser/gnome", "GNOME")
+        self.assertTrue(os.path.exists(os.path.join(root, "etc/dconf/db/local")))
+
+
+class TestPackagesRemoverBenchmark(ModuleBenchmark):
+
+    def test_install(self):
+        libcalamares.job.configuration = {"offlineCacheDirs": [os.path.join(self.tmp.name, "pkg")]}
+        libcalamares.chroot.latency["pacman"] = PACMAN_LATENCY
+        roots = []
+
+        def prepare():
+            root = self.new_target()
+            roots.append(root)
+            libcalamares.chroot.on("pacman", fake_pacman(root))
+            libcalamares.globalstorage.clear()
+            libcalamares.globalstorage.insert("rootMountPoint", root)
+            libcalamares.globalstorage.insert("cpu_vendor", "GenuineIntel")
+            libcalamares.globalstorage.insert("firmwareType", "efi")
+            libcalamares.globalstorage.insert("kernel_boot_mode", "free")
+            libcalamares.globalstorage.insert("pacman_queue", [
+                {"action": "install", "packages": ["qogir-kde-theme", "kvantum"], "source": "edition_chooser"},
+            ])
+
+        self.assertIsNone(self.measure("packages_remover/install", packages_remover.run, prepare))
+
+        installed = set(packages_remover.read_local_db(roots[-1]))
+        self.assertNotIn("calamares", installed)
+        self.assertNotIn("amd-ucode", installed)
+        self.assertNotIn("nvidia", installed)
+        self.assertIn("intel-ucode", installed)
+        self.assertIn("kvantum", installed)
+        self.assertEqual(libcalamares.chroot.count("pacman"), 2 * ROUNDS)
+
+
+class TestExecSequence(ModuleBenchmark):
+
+    COLOR_SCHEME = "[Colors:View]\nBackgroundNormal=255,255,255\n"
+
+    def exec_sequence(self):
+        """Returns the exec phase of settings.conf as (name, configuration) pairs."""
+        with open(REPO_DIR / "settings.conf", "r") as f:
+            settings = yaml.safe_load(f)
+        instances = {f"{instance['module']}@{instance['id']}": instance for instance in settings["instances"]}
+        steps = []
+        for phase in settings["sequence"]:
+            for name in phase.get("exec", []):
+                module = name.split("@")[0]
+                config = instances[name]["config"] if "@" in name else f"{module}.conf"
+                path = REPO_DIR / "modules" / module / config
+                configuration = {}
+                if path.exists():
+                    with open(path, "r") as f:
+                        configuration = yaml.safe_load(f) or {}
+                steps.append((name, configuration))
+        return steps
+
+    def test_initramfs_built_once(self):
+        names = [name for name, _ in self.exec_sequence()]
+        self.assertNotIn("shellprocess@algmkinitcpio", names)
+        self.assertEqual(names.count("initcpio"), 1)
+        self.assertGreater(names.index("initcpio"), names.index("packages_remover"))
+        self.assertGreater(names.index("initcpio"), names.index("system_tuning"))
+
+    def test_themed_kde_install(self):
+        self.install_editions_index()
+        root = self.new_target()
+        home = os.path.join(self.tmp.name, "home")
+        os.makedirs(home)
+        os.makedirs(os.path.join(root, "etc/skel"))
+        Path(root, "etc/skel/.bashrc").touch()
+        pacman = fake_pacman(root)
+
+        def pacman_with_files(args):
+            # qogir-kde-theme ships the colour scheme the theme step merges
+            if args[0] == "-S" and "qogir-kde-theme" in args:
+                schemes = os.path.join(root, "usr/share/color-schemes")
+                os.makedirs(schemes, exist_ok=True)
+                with open(os.path.join(schemes, "Qogirlight.colors"), "w") as f:
+                    f.write(self.COLOR_SCHEME)
+            return pacman(args)
+
+        def users():
+            # calamares' users module: the account's home is copied from /etc/skel
+            with open(os.path.join(root, "etc/passwd"), "a") as f:
+                f.write("alice:x:1000:1000::/home/alice:/bin/bash\n")
+            shutil.copytree(os.path.join(root, "etc/skel"), os.path.join(root, "home/alice"), dirs_exist_ok=True)
+
+        jobs = {
+            "users": users,
+            "edition_chooser": edition_chooser.run,
+            "packages_remover": packages_remover.run,
+        }
+        libcalamares.chroot.on("pacman", pacman_with_files)
+        for key, value in {"rootMountPoint": root, "cpu_vendor": "GenuineIntel", "firmwareType": "efi",
+                           "kernel_boot_mode": "free", "theme_config": {"dark": False},
+                           edition_chooser.PACKAGECHOOSER_KEY: "themed"}.items():
+            libcalamares.globalstorage.insert(key, value)
+
+        ran = []
+        with patch.dict(os.environ, {"XDG_CURRENT_DESKTOP": "KDE", "HOME": home}):
+            for name, configuration in self.exec_sequence():
+                job = jobs.get(name.split("@")[0])
+                if job is None:
+                    continue
+                libcalamares.job.configuration = {**configuration,
+                                                  "offlineCacheDirs": [os.path.join(self.tmp.name, "pkg")]}
+                self.assertIsNone(job(), name)
+                ran.append(name)
+
+        self.assertEqual(ran, ["users", "edition_chooser", "packages_remover", "edition_chooser@theme"])
+        self.assertIn("qogir-kde-theme", packages_remover.read_local_db(root))
+        for config_dir in ("etc/skel/.config", "home/alice/.config"):
+            with open(os.path.join(root, config_dir, "kdeglobals")) as f:
+                kdeglobals = f.read()
+            self.assertIn(self.COLOR_SCHEME, kdeglobals)
+            self.assertIn("ColorScheme=Qogirlight", kdeglobals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,31 +3,89 @@
 import unittest
 from unittest.mock import patch, MagicMock
 import os
+import json
+import struct
 import subprocess
+import tempfile
 from pathlib import Path
 import sys
 
 # Add the parent directory to sys.path to import the module
 sys.path.append(str(Path(__file__).parent.parent))
-from modules.editionchooser.main import (
+from modules.edition_chooser.main import (
     desktop_version,
     get_edition_version,
     _get_kde_edition,
     _get_gnome_edition,
     _get_xfce_edition,
     set_system_theme,
+    get_detection_context,
+    DetectionContext,
+    get_theme_settings,
+    write_theme,
+    build_gvdb,
+    read_gvdb,
+    serialize_gvariant_variant,
+    load_edition_plan,
     run
 )
+from modules.edition_chooser.compile_editions import compile_manifest
+import alg_runner
+
+MANIFEST = {"editions": {
+    "pure": {
+        "all": {"remove": ["qogir-icon-theme"]},
+        "kde": {"remove": ["qogir-kde-theme"]},
+        "gnome": None,
+        "xfce": {},
+    },
+    "themed": {
+        "all": {"install": ["qogir-icon-theme"]},
+        "kde": {"install": ["qogir-kde-theme"],
+                "theme": {"dark": {"ini": {"kdeglobals": {"Icons": {"Theme": "Qogir-dark"}}}}}},
+        "gnome": {"install": ["orchis-theme"]},
+        "xfce": {},
+    },
+}}
+
+
+def gvdb_lookup(data, key):
+    """Looks a key up the way GLib's gvdb reader does; returns (type, value)."""
+    table_start, table_end = struct.unpack_from("<II", data, 16)
+    n_bloom_words, n_buckets = struct.unpack_from("<II", data, table_start)
+    buckets = struct.unpack_from(f"<{n_buckets}I", data, table_start + 8 + 4 * n_bloom_words)
+    items_start = table_start + 8 + 4 * (n_bloom_words + n_buckets)
+    n_items = (table_end - items_start) // 24
+    items = [struct.unpack_from("<IIIHcxII", data, items_start + 24 * i) for i in range(n_items)]
+
+    def check_name(item, name):
+        _, parent, key_start, key_size, _, _, _ = item
+        if not name.endswith(data[key_start:key_start + key_size].decode()):
+            return False
+        rest = name[:len(name) - key_size]
+        return rest == "" if parent == 0xFFFFFFFF else check_name(items[parent], rest)
+
+    hash_value = 5381
+    for byte in key.encode():
+        hash_value = (hash_value * 33 + byte) & 0xFFFFFFFF
+    bucket = hash_value % n_buckets
+    last = n_items if bucket == n_buckets - 1 else buckets[bucket + 1]
+    for item in items[buckets[bucket]:last]:
+        if item[0] == hash_value and check_name(item, key):
+            return item[4], data[item[5]:item[6]]
+    return None
 
 class TestEditionChooser(unittest.TestCase):
     def setUp(self):
         # Mock libcalamares
-        self.libcalamares_patcher = patch('modules.editionchooser.main.libcalamares')
+        self.libcalamares_patcher = patch('modules.edition_chooser.main.libcalamares')
         self.mock_libcalamares = self.libcalamares_patcher.start()
+        alg_runner.reset()
         
         # Create a mock for globalstorage
         self.mock_gs = MagicMock()
         self.mock_libcalamares.globalstorage = self.mock_gs
+        self.mock_libcalamares.job.working_path = "/nonexistent"
 
     def tearDown(self):
         self.libcalamares_patcher.stop()
@@ -52,7 +110,7 @@ class TestEditionChooser(unittest.TestCase):
         with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'UNKNOWN'}):
             self.assertIsNone(desktop_version())
 
-    @patch('modules.editionchooser.main._get_kde_edition')
+    @patch('modules.edition_chooser.main._get_kde_edition')
     def test_get_edition_version_kde(self, mock_kde_edition):
         """Test KDE edition detection"""
         with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'KDE'}):
@@ -76,58 +134,279 @@ class TestEditionChooser(unittest.TestCase):
             with patch('os.path.exists', return_value=True):
                 self.assertEqual(_get_kde_edition(), 'themed')
 
+    def test_get_kde_edition_reads_relevant_keys_only(self):
+        """Test the scan stops at LookAndFeelPackage and ignores other groups"""
+        mock_content = ("[Icons]\nTheme=Qogir\n\n[KDE]\nLookAndFeelPackage=org.kde.breeze.desktop\n"
+                        "\n[General]\nColorScheme=Qogirlight\n")
+        mock_open = unittest.mock.mock_open(read_data=mock_content)
+        with patch('builtins.open', mock_open):
+            with patch('os.path.exists', return_value=True):
+                self.assertEqual(_get_kde_edition(), 'pure')
+
+        mock_open = unittest.mock.mock_open(read_data="[Icons]\nTheme=breeze\n[General]\nColorScheme=Qogirdark\n")
+        with patch('builtins.open', mock_open):
+            with patch('os.path.exists', return_value=True):
+                self.assertEqual(_get_kde_edition(), 'themed')
+
+    @patch('modules.edition_chooser.main._get_kde_edition', return_value='themed')
+    @patch('modules.edition_chooser.main.desktop_version', return_value='kde')
+    def test_run_detects_once(self, mock_desktop, mock_kde_edition):
+        """Test one run probes the desktop and edition exactly once"""
+        with tempfile.TemporaryDirectory() as root:
+            self.mock_gs.value.side_effect = {'theme_config': {'dark': False}, 'rootMountPoint': root}.get
+            self.assertIsNone(run())
+
+        mock_desktop.assert_called_once()
+        mock_kde_edition.assert_called_once()
+        self.mock_gs.insert.assert_any_call("edition_detection", {"desktop": "kde", "edition": "themed"})
+        self.mock_gs.insert.assert_any_call("edition_type", "themed")
+
+    @patch('modules.edition_chooser.main._get_kde_edition')
+    @patch('modules.edition_chooser.main.desktop_version', return_value='kde')
+    def test_run_queues_chosen_edition(self, mock_desktop, mock_kde_edition):
+        """Test the packagechooser choice wins and its plan reaches packages_remover"""
+        compiled, _ = compile_manifest(MANIFEST)
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, "editions.json"), "w") as f:
+                json.dump(compiled, f)
+            self.mock_libcalamares.job.working_path = root
+            self.mock_gs.value.side_effect = {
+                'packagechooser_packagechooser': 'themed',
+                'pacman_queue': [{"action": "remove", "packages": ["foo"], "source": "other"}],
+                'theme_config': {'dark': True},
+                'rootMountPoint': root,
+            }.get
+            self.assertIsNone(run())
+            self.assertFalse(os.path.exists(os.path.join(root, "etc/skel/.config/kdeglobals")))
+            with patch('libcalamares.job.configuration', {"step": "theme"}):
+                self.assertIsNone(run())
+            with open(os.path.join(root, "etc/skel/.config/kdeglobals")) as f:
+                kdeglobals = f.read()
+
+        mock_kde_edition.assert_not_called()
+        self.mock_gs.insert.assert_any_call("edition_type", "themed")
+        self.mock_gs.insert.assert_any_call("pacman_queue", [
+            {"action": "remove", "packages": ["foo"], "source": "other"},
+            {"action": "install", "packages": ["qogir-icon-theme", "qogir-kde-theme"], "source": "edition_chooser"},
+        ])
+        self.assertIn("[Icons]\nTheme=Qogir-dark\n", kdeglobals)
+
+    def test_load_edition_plan_missing_index(self):
+        """Test a missing or outdated index yields no plan"""
+        self.assertIsNone(load_edition_plan("kde", "pure", "/nonexistent/editions.json"))
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            json.dump({"version": 0, "plans": {}}, f)
+            f.flush()
+            self.assertIsNone(load_edition_plan("kde", "pure", f.name))
+
+    def test_compile_manifest(self):
+        """Test the all entry is merged into every desktop of an edition"""
+        compiled, errors = compile_manifest(MANIFEST)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(compiled["plans"]), ["pure/gnome", "pure/kde", "pure/xfce",
+                                                     "themed/gnome", "themed/kde", "themed/xfce"])
+        self.assertEqual(compiled["plans"]["pure/kde"]["remove"], ["qogir-icon-theme", "qogir-kde-theme"])
+        self.assertEqual(compiled["plans"]["pure/gnome"]["remove"], ["qogir-icon-theme"])
+        self.assertEqual(compiled["plans"]["themed/gnome"]["install"], ["qogir-icon-theme", "orchis-theme"])
+        self.assertEqual(compiled["plans"]["themed/kde"]["theme"]["light"], {})
+
+    def test_compile_manifest_errors(self):
+        """Test invalid manifests are rejected with every problem listed"""
+        manifest = {"editions": {
+            "pure": {"kde": {"remove": ["Bad Name"], "packages": []}, "gnome": {}, "xfce": {}},
+            "themed": {"all": {"install": ["kvantum"]}, "kde": {"remove": ["kvantum"]},
+                       "gnome": {}, "xfce": {}, "lxqt": {}},
+        }}
+        compiled, errors = compile_manifest(manifest)
+
+        self.assertIsNone(compiled)
+        self.assertEqual(errors, [
+            "editions.pure.kde: unknown key 'packages'",
+            "editions.pure.kde.remove: invalid package name 'Bad Name'",
+            "editions.themed: unknown desktop 'lxqt'",
+            "editions.themed.kde: 'kvantum' is both installed and removed",
+        ])
+
+    def test_shipped_manifest_compiles(self):
+        """Test the manifest in the tree is valid"""
+        import yaml
+        path = Path(__file__).parent.parent / "modules/edition_chooser/editions.yaml"
+        with open(path) as f:
+            compiled, errors = compile_manifest(yaml.safe_load(f))
+        self.assertEqual(errors, [])
+
+    @patch('modules.edition_chooser.main.desktop_version')
+    def test_get_detection_context_cached(self, mock_desktop):
+        """Test a context kept in globalstorage is reused without probing"""
+        self.mock_gs.value.side_effect = {'edition_detection': {'desktop': 'gnome', 'edition': 'pure'}}.get
+        self.assertEqual(get_detection_context(), DetectionContext('gnome', 'pure'))
+        mock_desktop.assert_not_called()
+
     @patch('subprocess.run')
     def test_get_gnome_edition_pure(self, mock_run):
         """Test GNOME pure edition detection"""
+        mock_run.return_value.returncode = 0
         mock_run.return_value.stdout = "'Adwaita'"
         self.assertEqual(_get_gnome_edition(), 'pure')
 
     @patch('subprocess.run')
     def test_get_gnome_edition_themed(self, mock_run):
         """Test GNOME themed edition detection"""
+        mock_run.return_value.returncode = 0
         mock_run.return_value.stdout = "'Orchis-Dark'"
         self.assertEqual(_get_gnome_edition(), 'themed')
 
     @patch('subprocess.run')
     def test_get_xfce_edition_pure(self, mock_run):
         """Test XFCE pure edition detection"""
+        mock_run.return_value.returncode = 0
         mock_run.return_value.stdout = "Adwaita"
         self.assertEqual(_get_xfce_edition(), 'pure')
 
     @patch('subprocess.run')
     def test_get_xfce_edition_themed(self, mock_run):
         """Test XFCE themed edition detection"""
+        mock_run.return_value.returncode = 0
         mock_run.return_value.stdout = "Qogir-Dark"
         self.assertEqual(_get_xfce_edition(), 'themed')
 
-    @patch('subprocess.run')
-    def test_set_kde_theme_pure(self, mock_run):
-        """Test setting KDE pure theme"""
-        with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'KDE', 'HOME': '/home/test'}):
-            self.mock_gs.value.return_value = {'dark': False}
+    def test_set_kde_theme_pure(self):
+        """Test the KDE theme is written to kdeglobals and kwinrc in /etc/skel"""
+        with tempfile.TemporaryDirectory() as root, \
+                patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'KDE', 'HOME': '/nonexistent'}), \
+                patch('subprocess.run') as mock_run:
+            skel = os.path.join(root, "etc/skel/.config")
+            os.makedirs(skel)
+            with open(os.path.join(skel, "kdeglobals"), "w") as f:
+                f.write("[General]\nfixed=Hack,10,-1,5,50,0,0,0,0,0\n\n[KDE]\nSingleClick=false\n")
+            self.mock_gs.value.side_effect = {'theme_config': {'dark': True}, 'rootMountPoint': root}.get
             set_system_theme()
-            mock_run.assert_called()
 
-    @patch('subprocess.run')
-    def test_set_gnome_theme_pure(self, mock_run):
-        """Test setting GNOME pure theme"""
-        with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'GNOME'}):
-            self.mock_gs.value.return_value = {'dark': False}
+            with open(os.path.join(skel, "kdeglobals")) as f:
+                kdeglobals = f.read()
+            with open(os.path.join(skel, "kwinrc")) as f:
+                kwinrc = f.read()
+            mock_run.assert_not_called()
+
+        self.assertEqual(kdeglobals, "[General]\nfixed=Hack,10,-1,5,50,0,0,0,0,0\nColorScheme=BreezeDark\n\n"
+                                     "[KDE]\nSingleClick=false\nLookAndFeelPackage=org.kde.breezedark.desktop\n\n")
+        self.assertEqual(kwinrc, "[org.kde.kdecoration2]\nlibrary=org.kde.breeze\ntheme=Breeze\n\n")
+
+    def test_set_kde_theme_existing_users(self):
+        """Test accounts created before theming get the theme in their homes"""
+        with tempfile.TemporaryDirectory() as root, \
+                patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'KDE'}):
+            os.makedirs(os.path.join(root, "etc"))
+            os.makedirs(os.path.join(root, "home/alice/.config"))
+            with open(os.path.join(root, "etc/passwd"), "w") as f:
+                f.write("root:x:0:0::/root:/bin/bash\n"
+                        "alice:x:1000:1000::/home/alice:/bin/bash\n"
+                        "bob:x:1001:1001::/home/bob:/bin/bash\n"
+                        "nobody:x:65534:65534::/:/usr/bin/nologin\n")
+            self.mock_gs.value.side_effect = {'theme_config': {'dark': False}, 'rootMountPoint': root}.get
             set_system_theme()
-            mock_run.assert_called()
 
-    @patch('subprocess.run')
-    def test_set_xfce_theme_pure(self, mock_run):
-        """Test setting XFCE pure theme"""
-        with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'XFCE'}):
-            self.mock_gs.value.return_value = {'dark': False}
+            with open(os.path.join(root, "home/alice/.config/kdeglobals")) as f:
+                kdeglobals = f.read()
+            self.assertFalse(os.path.exists(os.path.join(root, "home/bob")))
+            self.assertFalse(os.path.exists(os.path.join(root, ".config")))
+
+        self.assertIn("ColorScheme=BreezeLight", kdeglobals)
+
+    def test_set_gnome_theme_pure(self):
+        """Test the GNOME theme is compiled into the target's dconf system database"""
+        with tempfile.TemporaryDirectory() as root, \
+                patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'GNOME'}), \
+                patch('subprocess.run') as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = "'Orchis-Light'"
+            self.mock_gs.value.side_effect = {'theme_config': {'dark': False}, 'rootMountPoint': root}.get
             set_system_theme()
-            mock_run.assert_called()
+
+            with open(os.path.join(root, "etc/dconf/db/local"), "rb") as f:
+                database = f.read()
+            with open(os.path.join(root, "etc/dconf/db/local.d/00-alg-edition")) as f:
+                keyfile = f.read()
+            with open(os.path.join(root, "etc/dconf/profile/user")) as f:
+                profile = f.read()
+            self.assertFalse(os.path.exists(os.path.join(root, "etc/skel/.config/dconf")))
+
+        self.assertEqual(gvdb_lookup(database, "/org/gnome/desktop/interface/color-scheme"),
+                         (b"v", serialize_gvariant_variant("prefer-light")))
+        self.assertEqual(gvdb_lookup(database, "/org/gnome/shell/extensions/user-theme/name"),
+                         (b"v", serialize_gvariant_variant("Orchis-Light")))
+        self.assertEqual(keyfile, "[org/gnome/desktop/interface]\ncolor-scheme='prefer-light'\n\n"
+                                  "[org/gnome/shell/extensions/user-theme]\nname='Orchis-Light'\n\n")
+        self.assertEqual(profile, "user-db:user\nsystem-db:local\n")
+
+    def test_set_xfce_theme_pure(self):
+        """Test the XFCE theme is written to the xfconf channels in /etc/skel"""
+        with tempfile.TemporaryDirectory() as root, \
+                patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'XFCE'}), \
+                patch('subprocess.run') as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = "Adwaita"
+            self.mock_gs.value.side_effect = {'theme_config': {'dark': False}, 'rootMountPoint': root}.get
+            set_system_theme()
+
+            with open(os.path.join(root, "etc/skel/.config/xfce4/xfconf/xfce-perchannel-xml/xsettings.xml")) as f:
+                xsettings = f.read()
+
+        self.assertEqual(xsettings, '<?xml version="1.0" encoding="UTF-8"?>\n\n'
+                                    '<channel name="xsettings" version="1.0">\n'
+                                    '  <property name="Net" type="empty">\n'
+                                    '    <property name="ThemeName" type="string" value="Adwaita" />\n'
+                                    '  </property>\n'
+                                    '</channel>\n')
+
+    def test_get_theme_settings_themed_kde(self):
+        """Test the themed KDE edition uses the Qogir colours and decoration"""
+        settings = get_theme_settings("kde", "themed", dark=False)
+        self.assertEqual(settings["ini"]["kdeglobals"], {"General": {"ColorScheme": "Qogirlight"}})
+        self.assertEqual(settings["ini"]["kwinrc"]["org.kde.kdecoration2"]["theme"],
+                         "__aurorae__svg__Qogir-light-circle")
+
+    def test_write_theme_merges_color_scheme(self):
+        """Test the colour groups of the scheme are copied into kdeglobals"""
+        with tempfile.TemporaryDirectory() as home, tempfile.TemporaryDirectory() as schemes:
+            with open(os.path.join(schemes, "Qogirlight.colors"), "w") as f:
+                f.write("[Colors:View]\nBackgroundNormal=255,255,255\n\n[General]\nName=Qogir Light\n")
+            write_theme(home, get_theme_settings("kde", "themed"), schemes)
+            with open(os.path.join(home, ".config/kdeglobals")) as f:
+                kdeglobals = f.read()
+
+        self.assertIn("[Colors:View]\nBackgroundNormal=255,255,255\n", kdeglobals)
+        self.assertNotIn("Name=Qogir Light", kdeglobals)
+
+    def test_gvdb_roundtrip_and_merge(self):
+        """Test databases can be read back and directories list their children"""
+        values = {
+            "/org/gnome/desktop/interface/color-scheme": "prefer-dark",
+            "/org/gnome/desktop/interface/font-name": "Cantarell 11",
+            "/org/gnome/shell/favorite-apps": ["firefox.desktop"],
+            "/org/gnome/mutter/dynamic-workspaces": True,
+        }
+        database = build_gvdb(values)
+
+        self.assertEqual(read_gvdb(database), {key: serialize_gvariant_variant(value)
+                                               for key, value in values.items()})
+        item_type, children = gvdb_lookup(database, "/org/gnome/")
+        self.assertEqual(item_type, b"L")
+        self.assertEqual(len(children), 4 * 3)
+        self.assertEqual(gvdb_lookup(database, "/")[0], b"L")
+        self.assertIsNone(gvdb_lookup(database, "/org/kde/"))
+
+        merged = build_gvdb({**read_gvdb(database), "/org/gnome/mutter/dynamic-workspaces": False})
+        self.assertEqual(gvdb_lookup(merged, "/org/gnome/mutter/dynamic-workspaces"),
+                         (b"v", serialize_gvariant_variant(False)))
+        self.assertEqual(gvdb_lookup(merged, "/org/gnome/shell/favorite-apps"),
+                         (b"v", serialize_gvariant_variant(["firefox.desktop"])))
 
     def test_run_successful(self):
         """Test successful run of the module"""
         with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'KDE'}):
-            with patch('modules.editionchooser.main.set_system_theme'):
+            with patch('modules.edition_chooser.main.set_system_theme'):
                 result = run()
                 self.assertIsNone(result)
                 self.mock_gs.insert.assert_called()
@@ -139,10 +418,18 @@ class TestEditionChooser(unittest.TestCase):
             self.assertFalse(success)
             self.assertIn("Failed to determine desktop environment", result)
 
+    @patch('libcalamares.job.configuration', {"step": "unpack"})
+    def test_run_unknown_step(self):
+        """Test run with a step the module does not know"""
+        result, success = run()
+        self.assertFalse(success)
+        self.assertIn("Unknown edition_chooser step", result)
+
+    @patch('libcalamares.job.configuration', {"step": "theme"})
     def test_run_theme_setting_failure(self):
         """Test run with theme setting failure"""
         with patch.dict('os.environ', {'XDG_CURRENT_DESKTOP': 'KDE'}):
-            with patch('modules.editionchooser.main.set_system_theme', 
+            with patch('modules.edition_chooser.main.set_system_theme', 
                       side_effect=Exception("Theme setting failed")):
                 result, success = run()
                 self.assertFalse(success)
@@ -152,8 +439,9 @@ class TestEdgeCases(unittest.TestCase):
     """Test edge cases and error handling"""
 
     def setUp(self):
-        self.libcalamares_patcher = patch('modules.editionchooser.main.libcalamares')
+        self.libcalamares_patcher = patch('modules.edition_chooser.main.libcalamares')
         self.mock_libcalamares = self.libcalamares_patcher.start()
+        alg_runner.reset()
 
     def tearDown(self):
         self.libcalamares_patcher.stop()
@@ -171,13 +459,13 @@ class TestEdgeCases(unittest.TestCase):
     @patch('subprocess.run')
     def test_gnome_edition_command_failure(self, mock_run):
         """Test GNOME edition detection with command failure"""
-        mock_run.side_effect = subprocess.CalledProcessError(1, 'gsettings')
+        mock_run.side_effect = FileNotFoundError(2, 'No such file or directory', 'gsettings')
         self.assertEqual(_get_gnome_edition(), 'pure')
 
     @patch('subprocess.run')
     def test_xfce_edition_command_failure(self, mock_run):
         """Test XFCE edition detection with command failure"""
-        mock_run.side_effect = subprocess.CalledProcessError(1, 'xfconf-query')
+        mock_run.side_effect = FileNotFoundError(2, 'No such file or directory', 'xfconf-query')
         self.assertEqual(_get_xfce_edition(), 'pure')
 
 if __name__ == '__main__':
@@ -2,24 +2,80 @@
 
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
-import subprocess
+import os
+import shutil
+import tempfile
 from pathlib import Path
 import sys
 
 # Add the parent directory to sys.path to import the module
 sys.path.append(str(Path(__file__).parent.parent))
-from modules.hardware.main import (
+from modules.hardware_detection.main import (
+    PciDevice,
+    BlockDevice,
+    CpuInfo,
+    HardwareSnapshot,
+    run_probes,
+    take_snapshot,
+    get_block_devices,
+    save_snapshot,
+    load_snapshot,
+    scan_pci_devices,
+    get_display_devices,
+    open_pci_ids_index,
+    lookup_pci_names,
+    get_gpu_names,
     get_nvidia_gpu_info,
     get_gpu_driver_name,
     get_cpu_type,
+    get_cpu_info,
+    get_x86_64_level,
+    get_hybrid_layout,
     get_iso_bootmode,
+    parse_kernel_cmdline,
     run
 )
+from modules.hardware_detection.compile_pci_ids import parse_pci_ids, build_index
+from modules.hardware_detection.record_hardware import (
+    record_profile,
+    replay_profile,
+    parse_lspci,
+    read_archive,
+    append_profiles,
+)
+from modules.packages_remover.main import plan_nvidia_driver
+import libcalamares
+
+HARDWARE_PROFILES = Path(__file__).parent / "fixtures" / "hardware-profiles.jsonl"
+
+PCI_IDS_SAMPLE = """# sample pci.ids
+10de  NVIDIA Corporation
+\t1f91  TU117M [GeForce GTX 1650 Mobile / Max-Q]
+\t\t1043 1e11  GeForce GTX 1650 Mobile
+\t2484  GA104 [GeForce RTX 3070]
+8086  Intel Corporation
+\t3e9b  CoffeeLake-H GT2 [UHD Graphics 630]
+C 00  Unclassified device
+\t00  Non-VGA unclassified device
+"""
+
+def make_pci_device(root, slot, pci_class, vendor, device, driver=None,
+                    subsystem_vendor="0x0000", subsystem_device="0x0000"):
+    """Creates a fake /sys/bus/pci/devices/<slot> entry under root."""
+    path = os.path.join(root, slot)
+    os.makedirs(path)
+    for attr, value in [("class", pci_class), ("vendor", vendor), ("device", device),
+                        ("subsystem_vendor", subsystem_vendor), ("subsystem_device", subsystem_device)]:
+        with open(os.path.join(path, attr), "w") as f:
+            f.write(value + "\n")
+    if driver:
+        os.symlink(f"../../../bus/pci/drivers/{driver}", os.path.join(path, "driver"))
+
 
 class TestHardwareDetection(unittest.TestCase):
     def setUp(self):
         # Mock libcalamares
-        self.libcalamares_patcher = patch('modules.hardware.main.libcalamares')
+        self.libcalamares_patcher = patch('modules.hardware_detection.main.libcalamares')
         self.mock_libcalamares = self.libcalamares_patcher.start()
         
         # Create a mock for globalstorage
@@ -29,47 +85,182 @@ class TestHardwareDetection(unittest.TestCase):
     def tearDown(self):
         self.libcalamares_patcher.stop()
 
-    @patch('subprocess.run')
-    def test_get_nvidia_gpu_info_with_gpu(self, mock_run):
-        """Test NVIDIA GPU detection when GPU is present"""
-        mock_run.return_value.stdout = (
-            "01:00.0 VGA compatible controller: NVIDIA Corporation GA104 [GeForce RTX 3070] (rev a1)\n"
-            "02:00.0 Audio device: NVIDIA Corporation Device 228b (rev a1)"
-        )
-        expected_result = ['NVIDIA Corporation GA104 [GeForce RTX 3070] (rev a1)']
-        self.assertEqual(get_nvidia_gpu_info(), expected_result)
-
-    @patch('subprocess.run')
-    def test_get_nvidia_gpu_info_no_gpu(self, mock_run):
+    def make_optimus_laptop(self, root):
+        make_pci_device(root, "0000:00:02.0", "0x030000", "0x8086", "0x3e9b", "i915")
+        make_pci_device(root, "0000:00:1f.3", "0x040380", "0x8086", "0xa348", "snd_hda_intel")
+        make_pci_device(root, "0000:02:00.0", "0x030200", "0x10de", "0x1f91", "nouveau",
+                        subsystem_vendor="0x1043", subsystem_device="0x1e11")
+
+    def test_scan_pci_devices(self):
+        """Test reading PCI devices from sysfs"""
+        with tempfile.TemporaryDirectory() as root:
+            self.make_optimus_laptop(root)
+            devices = scan_pci_devices(root)
+
+        self.assertEqual(len(devices), 3)
+        self.assertEqual(devices[2], PciDevice(
+            slot="0000:02:00.0", pci_class="030200", vendor="10de", device="1f91",
+            subsystem_vendor="1043", subsystem_device="1e11", driver="nouveau",
+        ))
+        self.assertEqual([d.slot for d in get_display_devices(devices)], ["0000:00:02.0", "0000:02:00.0"])
+
+    def test_get_nvidia_gpu_info_with_gpu(self):
+        """Test NVIDIA GPU detection when GPU is present on any bus"""
+        with tempfile.TemporaryDirectory() as root:
+            self.make_optimus_laptop(root)
+            devices = scan_pci_devices(root)
+        self.assertEqual(get_nvidia_gpu_info(devices), ['NVIDIA Corporation Device 1f91'])
+
+    def test_get_nvidia_gpu_info_no_gpu(self):
         """Test NVIDIA GPU detection when no GPU is present"""
-        mock_run.side_effect = subprocess.CalledProcessError(1, 'lspci')
-        self.assertEqual(get_nvidia_gpu_info(), [])
+        with tempfile.TemporaryDirectory() as root:
+            make_pci_device(root, "0000:00:02.0", "0x030000", "0x8086", "0x3e9b", "i915")
+            devices = scan_pci_devices(root)
+        self.assertEqual(get_nvidia_gpu_info(devices), [])
 
-    @patch('subprocess.run')
-    def test_get_nvidia_gpu_info_error(self, mock_run):
-        """Test NVIDIA GPU detection with unexpected error"""
-        mock_run.side_effect = Exception("Unexpected error")
-        self.assertEqual(get_nvidia_gpu_info(), [])
+    def test_get_nvidia_gpu_info_error(self):
+        """Test NVIDIA GPU detection with unreadable sysfs"""
+        self.assertEqual(get_nvidia_gpu_info(scan_pci_devices("/nonexistent")), [])
 
-    @patch('subprocess.run')
-    def test_get_gpu_driver_name_with_driver(self, mock_run):
+    def test_get_gpu_driver_name_with_driver(self):
         """Test GPU driver detection when driver is present"""
-        mock_run.return_value.stdout = (
-            "00:02.0 VGA compatible controller: Intel Corporation UHD Graphics 630\n"
-            "\tKernel driver in use: i915\n"
-            "\tKernel modules: i915\n"
-            "01:00.0 VGA compatible controller: NVIDIA Corporation GA104 [GeForce RTX 3070]\n"
-            "\tKernel driver in use: nvidia\n"
-            "\tKernel modules: nvidia"
+        with tempfile.TemporaryDirectory() as root:
+            self.make_optimus_laptop(root)
+            devices = scan_pci_devices(root)
+        self.assertEqual(get_gpu_driver_name(devices), ['i915', 'nouveau'])
+
+    def test_get_gpu_driver_name_no_driver(self):
+        """Test GPU driver detection when no driver is bound"""
+        with tempfile.TemporaryDirectory() as root:
+            make_pci_device(root, "0000:01:00.0", "0x030000", "0x10de", "0x2484")
+            devices = scan_pci_devices(root)
+        self.assertEqual(get_gpu_driver_name(devices), [])
+
+    def test_snapshot_cache_roundtrip(self):
+        """Test the snapshot is cached per boot id"""
+        snapshot = HardwareSnapshot(
+            boot_id="8c1a7a6e-0f5e-4d2a-9b1f-3c7c4f7a2d11",
+            pci_devices=(PciDevice("0000:01:00.0", "030000", "10de", "2484", "1043", "87c1", "nvidia"),),
+            cpu=CpuInfo("GenuineIntel", "Intel(R) Core(TM) i7-12700H", 3, 14, 20, 12, 8),
+            cmdline="BOOT_IMAGE=/boot/vmlinuz-linux driver=nonfree",
+            firmware_type="efi",
+            memory_total_kib=16318480,
+            swap_total_kib=0,
+            block_devices=(BlockDevice("nvme0n1", False, False, 512110190592, "nvme", True, 1023),),
         )
-        expected_result = ['i915', 'nvidia']
-        self.assertEqual(get_gpu_driver_name(), expected_result)
-
-    @patch('subprocess.run')
-    def test_get_gpu_driver_name_no_driver(self, mock_run):
-        """Test GPU driver detection when no driver is present"""
-        mock_run.side_effect = subprocess.CalledProcessError(1, 'lspci')
-        self.assertEqual(get_gpu_driver_name(), [])
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = save_snapshot(snapshot, cache_dir)
+            self.assertTrue(path.endswith("hardware-8c1a7a6e-0f5e-4d2a-9b1f-3c7c4f7a2d11.json"))
+            self.assertEqual(load_snapshot(snapshot.boot_id, cache_dir), snapshot)
+            self.assertIsNone(load_snapshot("another-boot", cache_dir))
+
+    def test_pci_ids_index_lookup(self):
+        """Test names are resolved from the compiled pci.ids index"""
+        index_data = build_index(*parse_pci_ids(PCI_IDS_SAMPLE.splitlines()))
+        with tempfile.TemporaryDirectory() as root:
+            index_path = os.path.join(root, "pci-ids.idx")
+            with open(index_path, "wb") as f:
+                f.write(index_data)
+            make_pci_device(root, "0000:00:02.0", "0x030000", "0x8086", "0x3e9b", "i915")
+            make_pci_device(root, "0000:01:00.0", "0x030000", "0x10de", "0x1f91", "nvidia",
+                            subsystem_vendor="0x1043", subsystem_device="0x1e11")
+            make_pci_device(root, "0000:02:00.0", "0x030000", "0x1002", "0x73bf")
+            devices = scan_pci_devices(root)
+            index = open_pci_ids_index(index_path)
+
+            self.assertEqual(lookup_pci_names(index, devices[1]), (
+                "NVIDIA Corporation", "TU117M [GeForce GTX 1650 Mobile / Max-Q]", "GeForce GTX 1650 Mobile"))
+            self.assertEqual(get_gpu_names(devices, index), [
+                "Intel Corporation CoffeeLake-H GT2 [UHD Graphics 630]",
+                "NVIDIA Corporation TU117M [GeForce GTX 1650 Mobile / Max-Q]",
+                "Vendor 1002 Device 73bf",
+            ])
+            self.assertEqual(get_nvidia_gpu_info(devices, index),
+                             ["NVIDIA Corporation TU117M [GeForce GTX 1650 Mobile / Max-Q]"])
+            index.close()
+
+    def test_pci_ids_index_missing(self):
+        """Test a missing index is reported as unavailable"""
+        self.assertIsNone(open_pci_ids_index("/nonexistent/pci-ids.idx"))
+
+    def test_run_probes_timeout_uses_fallback(self):
+        """Test a hung probe yields its fallback without stalling the others"""
+        hang = __import__("threading").Event()
+        results, timings = run_probes({
+            "cpu": (lambda: "GenuineIntel", "Unknown"),
+            "gpu": (lambda: hang.wait(5) or ["never"], []),
+            "memory": (lambda: 1 / 0, (0, 0)),
+        }, timeout=0.2)
+        hang.set()
+
+        self.assertEqual(results, {"cpu": "GenuineIntel", "gpu": [], "memory": (0, 0)})
+        self.assertEqual(timings["cpu"]["status"], "ok")
+        self.assertEqual(timings["gpu"]["status"], "timeout")
+        self.assertEqual(timings["memory"]["status"], "error")
+
+    def test_get_block_devices(self):
+        """Test physical disks are listed and virtual ones skipped"""
+        with tempfile.TemporaryDirectory() as root:
+            for name, rotational, discard, physical in [("loop0", "0", "4096", False),
+                                                        ("nvme0n1", "0", "2199023255040", True),
+                                                        ("sda", "1", "0", True),
+                                                        ("sdb", "0", "2147450880", True)]:
+                os.makedirs(os.path.join(root, name, "queue"))
+                attrs = {"queue/rotational": rotational, "queue/discard_max_bytes": discard,
+                         "queue/nr_requests": "1023", "size": "1000"}
+                if physical:
+                    os.makedirs(os.path.join(root, name, "device"))
+                    if name.startswith("sd"):
+                        attrs["device/queue_depth"] = "32"
+                for attr, value in attrs.items():
+                    with open(os.path.join(root, name, attr), "w") as f:
+                        f.write(value + "\n")
+            devices = get_block_devices(root)
+
+        self.assertEqual(devices, [BlockDevice("nvme0n1", False, False, 512000, "nvme", True, 1023),
+                                   BlockDevice("sda", True, False, 512000, "hdd", False, 32),
+                                   BlockDevice("sdb", False, False, 512000, "ssd", True, 32)])
+
+    def test_get_cpu_info(self):
+        """Test flags, cores and threads are read in one pass"""
+        v3_flags = ("fpu lm cx16 lahf_lm popcnt pni sse4_1 sse4_2 ssse3 "
+                    "avx avx2 bmi1 bmi2 f16c fma abm movbe xsave")
+        cpuinfo = "".join(
+            f"processor\t: {cpu}\nvendor_id\t: AuthenticAMD\n"
+            f"model name\t: AMD Ryzen 7 5800X\nphysical id\t: 0\n"
+            f"core id\t\t: {cpu // 2}\nflags\t\t: {v3_flags}\n\n"
+            for cpu in range(4)
+        )
+        with tempfile.NamedTemporaryFile("w", suffix="cpuinfo") as f:
+            f.write(cpuinfo)
+            f.flush()
+            with patch('modules.hardware_detection.main.get_hybrid_layout', return_value=(0, 0)):
+                info = get_cpu_info(f.name)
+
+        self.assertEqual(info, CpuInfo("AuthenticAMD", "AMD Ryzen 7 5800X", 3, 2, 4))
+
+    def test_get_x86_64_level(self):
+        """Test each level needs every flag of the levels below it"""
+        v2 = {"lm", "cx16", "lahf_lm", "popcnt", "pni", "sse4_1", "sse4_2", "ssse3"}
+        v3 = v2 | {"avx", "avx2", "bmi1", "bmi2", "f16c", "fma", "abm", "movbe", "xsave"}
+        v4 = v3 | {"avx512f", "avx512bw", "avx512cd", "avx512dq", "avx512vl"}
+        self.assertEqual(get_x86_64_level(set()), 0)
+        self.assertEqual(get_x86_64_level({"lm"}), 1)
+        self.assertEqual(get_x86_64_level(v2), 2)
+        self.assertEqual(get_x86_64_level(v3), 3)
+        self.assertEqual(get_x86_64_level(v3 - {"movbe"}), 2)
+        self.assertEqual(get_x86_64_level(v4), 4)
+        self.assertEqual(get_x86_64_level(v4 - {"avx2"}), 2)
+
+    def test_get_hybrid_layout(self):
+        """Test performance and efficiency CPUs are counted from sysfs"""
+        with tempfile.TemporaryDirectory() as root:
+            self.assertEqual(get_hybrid_layout(root), (0, 0))
+            for pmu, cpus in [("cpu_core", "0-11"), ("cpu_atom", "12-19")]:
+                os.makedirs(os.path.join(root, pmu))
+                with open(os.path.join(root, pmu, "cpus"), "w") as f:
+                    f.write(cpus + "\n")
+            self.assertEqual(get_hybrid_layout(root), (12, 8))
 
     def test_get_cpu_type_intel(self):
         """Test CPU type detection for Intel CPU"""
@@ -113,28 +304,61 @@ class TestHardwareDetection(unittest.TestCase):
         with patch('builtins.open', side_effect=IOError):
             self.assertEqual(get_iso_bootmode("driver", "free"), "free")
 
+    def test_parse_kernel_cmdline(self):
+        """Test quoting, "=" inside values, bare flags and repeated params"""
+        params = parse_kernel_cmdline(
+            'BOOT_IMAGE=/boot/vmlinuz-linux root=UUID=1234-abcd '
+            'alg.label="ALG Live" "quoted=a b" nomodeset '
+            'driver=free driver=nonfree -- single'
+        )
+        self.assertEqual(params, {
+            "BOOT_IMAGE": "/boot/vmlinuz-linux",
+            "root": "UUID=1234-abcd",
+            "alg.label": "ALG Live",
+            "quoted": "a b",
+            "nomodeset": None,
+            "driver": "nonfree",
+        })
+
+    def test_get_iso_bootmode_from_cmdline(self):
+        """Test values containing "=" and bare flags are returned whole"""
+        cmdline = "root=UUID=1234-abcd copytoram"
+        self.assertEqual(get_iso_bootmode("root", cmdline=cmdline), "UUID=1234-abcd")
+        self.assertEqual(get_iso_bootmode("copytoram", cmdline=cmdline), "copytoram")
+        self.assertIsNone(get_iso_bootmode("nomodeset", cmdline=cmdline))
+
 class TestHardwareDetectionRun(unittest.TestCase):
     """Test the main run function of the hardware detection module"""
 
     def setUp(self):
-        self.libcalamares_patcher = patch('modules.hardware.main.libcalamares')
+        self.libcalamares_patcher = patch('modules.hardware_detection.main.libcalamares')
         self.mock_libcalamares = self.libcalamares_patcher.start()
         self.mock_gs = MagicMock()
         self.mock_libcalamares.globalstorage = self.mock_gs
+        self.mock_libcalamares.job.configuration = {}
+        # Always probe, never touch the real snapshot cache
+        self.cache_patchers = [
+            patch('modules.hardware_detection.main.load_snapshot', return_value=None),
+            patch('modules.hardware_detection.main.save_snapshot', return_value=None),
+        ]
+        for patcher in self.cache_patchers:
+            patcher.start()
 
     def tearDown(self):
+        for patcher in self.cache_patchers:
+            patcher.stop()
         self.libcalamares_patcher.stop()
 
-    @patch('modules.hardware.main.get_nvidia_gpu_info')
-    @patch('modules.hardware.main.get_gpu_driver_name')
-    @patch('modules.hardware.main.get_cpu_type')
-    @patch('modules.hardware.main.get_iso_bootmode')
+    @patch('modules.hardware_detection.main.get_nvidia_gpu_info')
+    @patch('modules.hardware_detection.main.get_gpu_driver_name')
+    @patch('modules.hardware_detection.main.get_cpu_info')
+    @patch('modules.hardware_detection.main.get_iso_bootmode')
     def test_run_successful(self, mock_bootmode, mock_cpu, mock_gpu_driver, mock_nvidia):
         """Test successful run with all components"""
         # Setup mock returns
         mock_nvidia.return_value = ['NVIDIA GeForce RTX 3070']
         mock_gpu_driver.return_value = ['nvidia']
-        mock_cpu.return_value = 'GenuineIntel'
+        mock_cpu.return_value = CpuInfo("GenuineIntel", "", 3, 4, 8)
         mock_bootmode.return_value = 'nonfree'
 
         # Run the function
@@ -149,15 +373,15 @@ class TestHardwareDetectionRun(unittest.TestCase):
         self.mock_gs.insert.assert_any_call("cpu_vendor", 'GenuineIntel')
         self.mock_gs.insert.assert_any_call("kernel_boot_mode", 'nonfree')
 
-    @patch('modules.hardware.main.get_nvidia_gpu_info')
-    @patch('modules.hardware.main.get_gpu_driver_name')
-    @patch('modules.hardware.main.get_cpu_type')
-    @patch('modules.hardware.main.get_iso_bootmode')
+    @patch('modules.hardware_detection.main.get_nvidia_gpu_info')
+    @patch('modules.hardware_detection.main.get_gpu_driver_name')
+    @patch('modules.hardware_detection.main.get_cpu_info')
+    @patch('modules.hardware_detection.main.get_iso_bootmode')
     def test_run_with_no_nvidia(self, mock_bootmode, mock_cpu, mock_gpu_driver, mock_nvidia):
         """Test run without NVIDIA GPU"""
         mock_nvidia.return_value = []
         mock_gpu_driver.return_value = ['i915']
-        mock_cpu.return_value = 'GenuineIntel'
+        mock_cpu.return_value = CpuInfo("GenuineIntel", "", 3, 4, 8)
         mock_bootmode.return_value = 'free'
 
         result = run()
@@ -166,27 +390,106 @@ class TestHardwareDetectionRun(unittest.TestCase):
         self.mock_gs.insert.assert_any_call("nvidia_gpu_name", [])
         self.mock_gs.insert.assert_any_call("gpuDrivers", ['i915'])
 
+class TestHardwareProfiles(unittest.TestCase):
+    """Replays the recorded machines in tests/fixtures through the module"""
+
+    def setUp(self):
+        libcalamares.reset()
+        self.profiles = list(read_archive(str(HARDWARE_PROFILES)))
+
+    def replay(self, profile):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        replay_profile(profile, root)
+        return root
+
+    def test_pci_scan_matches_lspci(self):
+        for profile in self.profiles:
+            with self.subTest(profile=profile["name"]):
+                devices = scan_pci_devices(os.path.join(self.replay(profile), "sys/bus/pci/devices"))
+                expected = parse_lspci(profile["lspci"])
+                self.assertEqual([d.slot for d in devices], sorted(e["Slot"] for e in expected))
+                for device, entry in zip(devices, sorted(expected, key=lambda e: e["Slot"])):
+                    self.assertTrue(device.pci_class.startswith(entry["Class"]))
+                    self.assertEqual((device.vendor, device.device), (entry["Vendor"], entry["Device"]))
+                    self.assertEqual((device.subsystem_vendor, device.subsystem_device),
+                                     (entry["SVendor"], entry["SDevice"]))
+                    self.assertEqual(device.driver, entry.get("Driver"))
+
+    def test_run_on_replayed_profiles(self):
+        for profile in self.profiles:
+            with self.subTest(profile=profile["name"]):
+                libcalamares.reset()
+                libcalamares.job.configuration = {"replayRoot": self.replay(profile)}
+                self.assertIsNone(run())
+
+                gs = libcalamares.globalstorage
+                expect = profile.get("expect", {})
+                cpu = gs.value("cpu_info")
+                for key in ("x86_64_level", "cores", "threads", "performance_cores", "efficiency_cores"):
+                    if key in expect:
+                        self.assertEqual(cpu[key], expect[key], key)
+                for key, gs_key in (("cpu_vendor", "cpu_vendor"), ("kernel_boot_mode", "kernel_boot_mode"),
+                                    ("memory_total_kib", "memory_total_kib"),
+                                    ("swap_total_kib", "swap_total_kib"), ("gpu_drivers", "gpuDrivers")):
+                    if key in expect:
+                        self.assertEqual(gs.value(gs_key), expect[key], key)
+                if "block_devices" in expect:
+                    self.assertEqual({d["name"]: d["kind"] for d in gs.value("block_devices")},
+                                     expect["block_devices"])
+                self.assertIsNone(gs.value("hardware_snapshot"))
+                self.assertTrue(all(t["status"] == "ok" for t in gs.value("hardware_probe_timings").values()))
+
+                # The driver packages_remover picks for the replayed GPUs
+                if "nvidia_family" in expect:
+                    plan = plan_nvidia_driver()
+                    self.assertEqual(plan["family"], expect["nvidia_family"])
+                    if "hybrid_graphics" in expect:
+                        self.assertEqual("nvidia-prime" in plan["install"], expect["hybrid_graphics"])
+
+    def test_take_snapshot_firmware_type(self):
+        for profile in self.profiles:
+            if "firmware_type" in profile.get("expect", {}):
+                with self.subTest(profile=profile["name"]):
+                    snapshot, _ = take_snapshot("", root=self.replay(profile))
+                    self.assertEqual(snapshot.firmware_type, profile["expect"]["firmware_type"])
+
+    def test_record_replay_roundtrip(self):
+        profile = self.profiles[0]
+        with tempfile.TemporaryDirectory() as archive_dir:
+            archive = os.path.join(archive_dir, "fleet.jsonl.gz")
+            recorded = record_profile("copy", self.replay(profile), lspci=profile["lspci"])
+            append_profiles(archive, [recorded])
+            append_profiles(archive, [dict(recorded, name="second")])
+            profiles = list(read_archive(archive))
+
+        self.assertEqual([p["name"] for p in profiles], ["copy", "second"])
+        for key in ("files", "links", "lspci"):
+            self.assertEqual(profiles[0][key], profile[key])
+        self.assertEqual(sorted(profiles[0]["dirs"]), sorted(profile["dirs"]))
+
+
 class TestEdgeCases(unittest.TestCase):
     """Test edge cases and error handling"""
 
     def setUp(self):
-        self.libcalamares_patcher = patch('modules.hardware.main.libcalamares')
+        self.libcalamares_patcher = patch('modules.hardware_detection.main.libcalamares')
         self.mock_libcalamares = self.libcalamares_patcher.start()
 
     def tearDown(self):
         self.libcalamares_patcher.stop()
 
-    @patch('subprocess.run')
-    def test_nvidia_gpu_info_malformed_output(self, mock_run):
-        """Test NVIDIA GPU detection with malformed lspci output"""
-        mock_run.return_value.stdout = "malformed:output:without:expected:format"
-        self.assertEqual(get_nvidia_gpu_info(), [])
-
-    @patch('subprocess.run')
-    def test_gpu_driver_name_empty_output(self, mock_run):
-        """Test GPU driver detection with empty output"""
-        mock_run.return_value.stdout = ""
-        self.assertEqual(get_gpu_driver_name(), [])
+    def test_scan_pci_devices_missing_attributes(self):
+        """Test PCI scan with a device directory lacking attributes"""
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "0000:00:00.0"))
+            devices = scan_pci_devices(root)
+        self.assertEqual(devices[0].pci_class, "")
+        self.assertEqual(get_display_devices(devices), [])
+
+    def test_gpu_driver_name_empty_output(self):
+        """Test GPU driver detection with no PCI devices"""
+        self.assertEqual(get_gpu_driver_name([]), [])
 
     def test_cpu_type_malformed_file(self):
         """Test CPU type detection with malformed cpuinfo file"""
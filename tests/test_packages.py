@@ -2,77 +2,657 @@ import unittest
 from unittest.mock import patch, MagicMock
 import libcalamares
 import os
+import shutil
+import subprocess
+import tempfile
+from modules.packages_remover.main import (
+    plan_removals,
+    remove_packages,
+    read_local_db,
+    filter_removable,
+    estimate_freed_bytes,
+    build_plan,
+    find_cached_packages,
+    install_packages,
+    held_hooks,
+    wait_for_db_lock,
+    get_removal_sources,
+    execute_plan,
+    report_timings,
+    run_pacman,
+    get_nvidia_driver_family,
+    plan_nvidia_driver,
+    get_optimized_repositories,
+    add_optimized_repositories,
+    remove_db_lock,
+    get_cpu_microcode_packages,
+    get_firmware_packages,
+    get_nvidia_packages,
+)
 
 class TestCalamaresFunctions(unittest.TestCase):
 
-    @patch('builtins.open', new_callable=unittest.mock.mock_open, read_data='vendor_id : GenuineIntel\n')
-    def test_get_cpu_type_intel(self, mock_file):
-        cpu_type = get_cpu_type()
-        self.assertEqual(cpu_type, 'GenuineIntel')
+    def setUp(self):
+        libcalamares.reset()
 
-    @patch('builtins.open', new_callable=unittest.mock.mock_open, read_data='vendor_id : AuthenticAMD\n')
-    def test_get_cpu_type_amd(self, mock_file):
-        cpu_type = get_cpu_type()
-        self.assertEqual(cpu_type, 'AuthenticAMD')
+    def test_remove_db_lock(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "var/lib/pacman"))
+            db_lock = os.path.join(root, "var/lib/pacman/db.lck")
+            open(db_lock, "w").close()
+            remove_db_lock(root)
+            self.assertFalse(os.path.exists(db_lock))
+            # Nothing to do the second time
+            remove_db_lock(root)
 
-    @patch('os.path.exists', return_value=True)
-    @patch('misc.raised_privileges')
-    @patch('os.remove')
-    def test_remove_db_lock(self, mock_remove, mock_privileges, mock_exists):
-        remove_db_lock('/fake/path')
-        mock_remove.assert_called_once_with('/fake/path/var/lib/pacman/db.lck')
+    def test_get_cpu_microcode_packages_intel(self):
+        libcalamares.globalstorage.insert("cpu_vendor", "GenuineIntel")
+        self.assertEqual(get_cpu_microcode_packages(), ['amd-ucode'])
 
-    @patch('libcalamares.utils.target_env_call')
-    @patch('libcalamares.globalstorage.value', return_value='GenuineIntel')
-    def test_remove_cpu_microcode_package_intel(self, mock_globalstorage, mock_target_env_call):
-        remove_cpu_microcode_package()
-        mock_target_env_call.assert_called_once_with(['pacman', '-Rns', '--noconfirm', 'amd-ucode'])
+    def test_get_cpu_microcode_packages_amd(self):
+        libcalamares.globalstorage.insert("cpu_vendor", "AuthenticAMD")
+        self.assertEqual(get_cpu_microcode_packages(), ['intel-ucode'])
 
-    @patch('libcalamares.utils.target_env_call')
-    @patch('libcalamares.globalstorage.value', return_value='AuthenticAMD')
-    def test_remove_cpu_microcode_package_amd(self, mock_globalstorage, mock_target_env_call):
-        remove_cpu_microcode_package()
-        mock_target_env_call.assert_called_once_with(['pacman', '-Rns', '--noconfirm', 'intel-ucode'])
+    def test_get_cpu_microcode_packages_unknown(self):
+        libcalamares.globalstorage.insert("cpu_vendor", "unknown")
+        self.assertEqual(get_cpu_microcode_packages(), [])
+        libcalamares.globalstorage.remove("cpu_vendor")
+        self.assertEqual(get_cpu_microcode_packages(), [])
+        self.assertEqual(len(libcalamares.utils.warning_log), 1)
 
-    @patch('libcalamares.utils.target_env_call')
-    @patch('libcalamares.globalstorage.value', return_value='unknown')
-    def test_remove_cpu_microcode_package_unknown(self, mock_globalstorage, mock_target_env_call):
-        remove_cpu_microcode_package()
-        mock_target_env_call.assert_not_called()
+    def test_get_firmware_packages_bios(self):
+        libcalamares.globalstorage.insert("firmwareType", "bios")
+        self.assertEqual(get_firmware_packages(), ['efibootmgr', 'refind-efi'])
 
-    @patch('libcalamares.utils.target_env_call')
-    @patch('libcalamares.globalstorage.value', return_value='bios')
-    def test_remove_fw_packages_bios(self, mock_globalstorage, mock_target_env_call):
-        remove_fw_packages()
-        mock_target_env_call.assert_called_once_with(['pacman', '-Rns', '--noconfirm', 'efibootmgr', 'refind-efi'])
+    def test_get_firmware_packages_efi(self):
+        libcalamares.globalstorage.insert("firmwareType", "efi")
+        self.assertEqual(get_firmware_packages(), [])
 
-    @patch('libcalamares.utils.target_env_call')
-    @patch('libcalamares.globalstorage.value', return_value='efi')
-    def test_remove_fw_packages_efi(self, mock_globalstorage, mock_target_env_call):
-        remove_fw_packages()
-        mock_target_env_call.assert_not_called()
+    def test_get_nvidia_packages_nonfree(self):
+        libcalamares.globalstorage.insert("kernel_boot_mode", "nonfree")
+        libcalamares.globalstorage.insert("gpu_devices", [{"slot": "0000:01:00.0", "vendor": "10de", "device": "1c03"}])
+        # The other families only go once the GTX 1060's driver is installed
+        self.assertEqual(get_nvidia_packages(), [])
 
-    @patch('libcalamares.globalstorage.value', return_value='NVIDIA Corporation Device [1234:5678]')
-    @patch('libcalamares.utils.target_env_call')
-    def test_remove_nvidia_packages_rtx(self, mock_target_env_call, mock_globalstorage):
-        remove_nvidia_packages()
-        # Assuming the NVIDIA RTX GPU is supported
-        mock_target_env_call.assert_called_once_with(['pacman', '-S', '--noconfirm', 'nvidia-open'])
+    def test_get_nvidia_packages_free(self):
+        libcalamares.globalstorage.insert("kernel_boot_mode", "free")
+        self.assertIn('nvidia', get_nvidia_packages())
 
-    @patch('libcalamares.globalstorage.value', return_value='NVIDIA Corporation Device [1234:5678]')
-    @patch('libcalamares.utils.target_env_call')
-    def test_remove_nvidia_packages_gtx(self, mock_target_env_call, mock_globalstorage):
-        # Changing the mock return value to simulate a GTX GPU
-        mock_globalstorage.return_value = 'GeForce GTX 1060'
-        remove_nvidia_packages()
-        mock_target_env_call.assert_called_once_with(['pacman', '-S', '--noconfirm', 'nvidia'])
+    def test_get_nvidia_packages_no_boot_mode(self):
+        self.assertEqual(get_nvidia_packages(), [])
+
+
+class TestRemovalPlanner(unittest.TestCase):
+
+    def setUp(self):
+        libcalamares.reset()
+
+    @patch('libcalamares.globalstorage.value')
+    def test_plan_removals_single_set(self, mock_globalstorage):
+        mock_globalstorage.side_effect = {
+            "cpu_vendor": "GenuineIntel",
+            "firmwareType": "bios",
+            "kernel_boot_mode": "free",
+        }.get
+        local_db = {name: {"required_by": []} for name in
+                    ['amd-ucode', 'intel-ucode', 'efibootmgr', 'nvidia', 'nvidia-utils', 'calamares']}
+        packages = plan_removals(local_db)
+        self.assertEqual(packages, ['amd-ucode', 'efibootmgr', 'nvidia', 'nvidia-utils', 'calamares'])
+
+    @patch('libcalamares.utils.target_env_process_output', return_value=0)
+    def test_remove_packages_one_transaction(self, mock_process_output):
+        failed = remove_packages(['a', 'b', 'c'])
+        self.assertEqual(failed, [])
+        self.assertEqual(mock_process_output.call_count, 1)
+        self.assertEqual(mock_process_output.call_args[0][0], ['pacman', '-Rns', '--noconfirm', 'a', 'b', 'c'])
+
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_remove_packages_bisects_on_failure(self, mock_process_output):
+        def pacman(cmd, callback, *args):
+            if 'c' in cmd:
+                callback("error: failed to commit transaction (transaction aborted)")
+                raise subprocess.CalledProcessError(1, cmd)
+            return 0
+        mock_process_output.side_effect = pacman
+        failed = remove_packages(['a', 'b', 'c', 'd'])
+        self.assertEqual(failed, ['c'])
+        commands = [c.args[0] for c in mock_process_output.call_args_list]
+        self.assertIn(['pacman', '-Rns', '--noconfirm', 'a', 'b'], commands)
+        self.assertIn(['pacman', '-Rns', '--noconfirm', 'd'], commands)
+        self.assertEqual(len(commands), 5)
+
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_remove_packages_drops_blamed_packages(self, mock_process_output):
+        def pacman(cmd, callback, *args):
+            if 'kpmcore' in cmd:
+                callback("error: failed to prepare transaction (could not satisfy dependencies)")
+                callback(":: removing kpmcore breaks dependency 'kpmcore' required by partitionmanager")
+                raise subprocess.CalledProcessError(1, cmd)
+            return 0
+        mock_process_output.side_effect = pacman
+        failed = remove_packages(['calamares', 'kpmcore', 'boost', 'solid'])
+        self.assertEqual(failed, ['kpmcore'])
+        self.assertEqual(mock_process_output.call_count, 2)
+        self.assertEqual(mock_process_output.call_args[0][0],
+                         ['pacman', '-Rns', '--noconfirm', 'calamares', 'boost', 'solid'])
+
+    def test_remove_packages_hung_pacman(self):
+        libcalamares.chroot.latency["pacman"] = 1
+        packages = [f"pkg{index}" for index in range(8)]
+        with patch('libcalamares.job.configuration', {"pacmanTimeout": 0.01}):
+            self.assertEqual(remove_packages(packages), packages)
+        self.assertEqual(libcalamares.chroot.count("pacman"), 1)
+
+    def test_remove_packages_no_error_output(self):
+        libcalamares.chroot.on("pacman", lambda args: (1, []))
+        self.assertEqual(remove_packages(['a', 'b', 'c', 'd']), ['a', 'b', 'c', 'd'])
+        self.assertEqual(libcalamares.chroot.count("pacman"), 1)
+
+    @patch('modules.packages_remover.main.wait_for_db_lock', return_value=False)
+    def test_remove_packages_locked_database(self, mock_wait):
+        with tempfile.TemporaryDirectory() as root:
+            libcalamares.globalstorage.insert("rootMountPoint", root)
+            self.assertEqual(remove_packages(['a', 'b', 'c', 'd']), ['a', 'b', 'c', 'd'])
+        mock_wait.assert_called_once_with(root)
+        self.assertEqual(libcalamares.chroot.count("pacman"), 0)
+
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_remove_packages_empty(self, mock_process_output):
+        self.assertEqual(remove_packages([]), [])
+        mock_process_output.assert_not_called()
+
+
+class TestLocalDatabase(unittest.TestCase):
+
+    def _write_desc(self, root, name, body):
+        path = os.path.join(root, "var/lib/pacman/local", f"{name}-1.0-1")
+        os.makedirs(path)
+        with open(os.path.join(path, "desc"), "w") as f:
+            f.write(body)
+
+    def test_read_local_db(self):
+        with tempfile.TemporaryDirectory() as root:
+            self._write_desc(root, "calamares",
+                             "%NAME%\ncalamares\n\n%VERSION%\n3.3.9-1\n\n%SIZE%\n1024\n\n"
+                             "%DEPENDS%\nkpmcore>=24.01\nsh\n\n")
+            self._write_desc(root, "kpmcore", "%NAME%\nkpmcore\n\n%SIZE%\n512\n\n")
+            self._write_desc(root, "bash", "%NAME%\nbash\n\n%PROVIDES%\nsh=5.2\n\n")
+            local_db = read_local_db(root)
+
+        self.assertEqual(local_db["calamares"]["version"], "3.3.9-1")
+        self.assertEqual(local_db["calamares"]["size"], 1024)
+        self.assertEqual(local_db["calamares"]["depends"], ["kpmcore", "sh"])
+        self.assertEqual(local_db["kpmcore"]["required_by"], ["calamares"])
+        self.assertEqual(local_db["bash"]["required_by"], ["calamares"])
 
-    @patch('libcalamares.globalstorage.value', return_value='Some Other GPU')
+    def test_filter_removable_keeps_required_packages(self):
+        local_db = {
+            "kpmcore": {"required_by": ["calamares", "partitionmanager"]},
+            "calamares": {"required_by": []},
+            "partitionmanager": {"required_by": []},
+        }
+        self.assertEqual(filter_removable(["calamares", "kpmcore", "linux-atm"], local_db), ["calamares"])
+        self.assertEqual(filter_removable(["calamares", "kpmcore", "partitionmanager"], local_db),
+                         ["calamares", "kpmcore", "partitionmanager"])
+
+
+class TestTransactionPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.local_db = {
+            "amd-ucode": {"size": 100, "explicit": True, "depends": [], "required_by": []},
+            "calamares": {"size": 1000, "explicit": True, "depends": ["qt6-base"], "required_by": []},
+            "qt6-base": {"size": 500, "explicit": False, "depends": [], "required_by": ["calamares"]},
+        }
+
+    def test_estimate_freed_bytes_includes_orphans(self):
+        self.assertEqual(estimate_freed_bytes(["calamares"], self.local_db), 1500)
+        self.assertEqual(estimate_freed_bytes(["amd-ucode"], self.local_db), 100)
+
+    @patch('libcalamares.job.configuration', {"offlineCacheDirs": []})
     @patch('libcalamares.utils.target_env_call')
-    def test_remove_nvidia_packages_none(self, mock_target_env_call, mock_globalstorage):
-        remove_nvidia_packages()
+    @patch('libcalamares.globalstorage.value')
+    def test_build_plan(self, mock_globalstorage, mock_target_env_call):
+        mock_globalstorage.side_effect = {
+            "cpu_vendor": "GenuineIntel",
+            "firmwareType": "efi",
+            "kernel_boot_mode": "nonfree",
+            "packagechooser_packages": ["firefox", "calamares"],
+        }.get
+        plan = build_plan(self.local_db)
+
+        self.assertEqual([step["action"] for step in plan["steps"]], ["blacklist", "remove", "install"])
+        self.assertEqual(plan["steps"][1]["packages"], ["amd-ucode", "calamares"])
+        self.assertEqual(plan["steps"][1]["sources"]["microcode"], ["amd-ucode"])
+        self.assertEqual(plan["steps"][2]["packages"], ["firefox"])
+        self.assertEqual(plan["steps"][2]["network"], ["firefox"])
+        self.assertEqual(plan["bytesFreed"], 1600)
+        self.assertEqual(plan["pacmanInvocations"], 2)
         mock_target_env_call.assert_not_called()
 
 
+class TestOptimizedRepositories(unittest.TestCase):
+
+    REPOSITORIES = [
+        {"name": "alg-core-v3", "level": 3, "include": "/etc/pacman.d/alg-mirrorlist-v3"},
+        {"name": "alg-core-v4", "level": 4, "server": "https://mirror.example/v4/$repo"},
+        {"name": "alg-core-v2", "level": 2, "include": "/etc/pacman.d/alg-mirrorlist-v2"},
+    ]
+
+    @patch('libcalamares.globalstorage.value')
+    def test_get_optimized_repositories_by_level(self, mock_globalstorage):
+        mock_globalstorage.side_effect = {"cpu_info": {"x86_64_level": 3}}.get
+        with patch('libcalamares.job.configuration', {"optimizedRepositories": self.REPOSITORIES}):
+            self.assertEqual([repo["name"] for repo in get_optimized_repositories()],
+                             ["alg-core-v3", "alg-core-v2"])
+
+        mock_globalstorage.side_effect = {}.get
+        with patch('libcalamares.job.configuration', {"optimizedRepositories": self.REPOSITORIES}):
+            self.assertEqual(get_optimized_repositories(), [])
+
+    def test_add_optimized_repositories(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "etc"))
+            conf_path = os.path.join(root, "etc/pacman.conf")
+            with open(conf_path, "w") as f:
+                f.write("[options]\nArchitecture = auto\n\n[core]\nInclude = /etc/pacman.d/mirrorlist\n")
+
+            repositories = self.REPOSITORIES[:1]
+            self.assertTrue(add_optimized_repositories(root, repositories))
+            self.assertTrue(add_optimized_repositories(root, repositories))
+            with open(conf_path) as f:
+                conf = f.read()
+
+        self.assertEqual(conf, "[options]\nArchitecture = auto x86_64_v3\n\n"
+                               "[alg-core-v3]\nInclude = /etc/pacman.d/alg-mirrorlist-v3\n\n"
+                               "[core]\nInclude = /etc/pacman.d/mirrorlist\n")
+
+
+class TestOfflineInstall(unittest.TestCase):
+
+    def test_find_cached_packages(self):
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            for cache_dir, filename in [
+                (first, "firefox-130.0-1-x86_64.pkg.tar.zst"),
+                (first, "firefox-130.0-1-x86_64.pkg.tar.zst.sig"),
+                (second, "firefox-129.0-1-x86_64.pkg.tar.zst"),
+                (second, "linux-firmware-20240909-1-any.pkg.tar.zst"),
+            ]:
+                open(os.path.join(cache_dir, filename), "w").close()
+
+            found = find_cached_packages(["firefox", "linux-firmware", "vlc"], [first, second])
+
+        self.assertEqual(found, {
+            "firefox": (first, "firefox-130.0-1-x86_64.pkg.tar.zst"),
+            "linux-firmware": (second, "linux-firmware-20240909-1-any.pkg.tar.zst"),
+        })
+
+    @patch('subprocess.run')
+    @patch('libcalamares.utils.mount', return_value=0)
+    @patch('libcalamares.utils.target_env_process_output', return_value=0)
+    def test_install_packages_offline_first(self, mock_process_output, mock_mount, mock_run):
+        mock_run.return_value.returncode = 0
+        with tempfile.TemporaryDirectory() as root:
+            install_packages(root, {"firefox": ["/cache", "firefox-130.0-1-x86_64.pkg.tar.zst"]}, ["vlc"])
+            self.assertEqual(mock_run.call_args.args[0], ("umount", os.path.join(root, "var/cache/pacman/alg-offline-0")))
+
+        mock_mount.assert_called_once_with("/cache", os.path.join(root, "var/cache/pacman/alg-offline-0"), "", "bind,ro")
+        commands = [c.args[0] for c in mock_process_output.call_args_list]
+        self.assertEqual(commands, [
+            ['pacman', '-U', '--needed', '--noconfirm',
+             '/var/cache/pacman/alg-offline-0/firefox-130.0-1-x86_64.pkg.tar.zst'],
+            ['pacman', '-S', '--needed', '--noconfirm', 'vlc'],
+        ])
+
+
+class TestDeferredHooks(unittest.TestCase):
+
+    HOOKS = {
+        "90-mkinitcpio-install.hook": "[Trigger]\nType = Path\nOperation = Install\nOperation = Upgrade\n"
+                                      "Target = usr/lib/modules/*/vmlinuz\nTarget = usr/lib/initcpio/*\n\n"
+                                      "[Action]\nWhen = PostTransaction\nExec = /usr/share/libalpm/scripts/mkinitcpio\n",
+        "60-depmod.hook": "[Trigger]\nType = Path\nOperation = Install\nOperation = Upgrade\nOperation = Remove\n"
+                          "Target = usr/lib/modules/*/\nTarget = !usr/lib/modules/*/?*\n"
+                          "Target = usr/lib/modules/*/extramodules/*\n",
+        "fontconfig.hook": "[Trigger]\nType = Path\nOperation = Install\nOperation = Upgrade\nOperation = Remove\n"
+                           "Target = usr/share/fonts/*\n",
+        "gtk-update-icon-cache.hook": "[Trigger]\nType = Path\nOperation = Install\nOperation = Upgrade\n"
+                                      "Operation = Remove\nTarget = usr/share/icons/*/\n",
+    }
+
+    def setUp(self):
+        libcalamares.reset()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        hooks = os.path.join(self.root, "usr/share/libalpm/hooks")
+        os.makedirs(hooks)
+        for hook, content in self.HOOKS.items():
+            with open(os.path.join(hooks, hook), "w") as f:
+                f.write(content)
+        for theme in ("Qogir", "hicolor"):
+            os.makedirs(os.path.join(self.root, "usr/share/icons", theme))
+            open(os.path.join(self.root, "usr/share/icons", theme, "index.theme"), "w").close()
+        os.makedirs(os.path.join(self.root, "usr/lib/modules/6.10.0-alg/kernel"))
+        self.install("amd-ucode", ["boot/", "boot/amd-ucode.img"])
+        self.install("nvidia", ["usr/", "usr/lib/", "usr/lib/modules/", "usr/lib/modules/6.10.0-alg/",
+                                "usr/lib/modules/6.10.0-alg/extramodules/",
+                                "usr/lib/modules/6.10.0-alg/extramodules/nvidia.ko.zst"])
+
+    def install(self, name, files):
+        path = os.path.join(self.root, "var/lib/pacman/local", f"{name}-1.0-1")
+        os.makedirs(path)
+        with open(os.path.join(path, "desc"), "w") as f:
+            f.write(f"%NAME%\n{name}\n\n")
+        with open(os.path.join(path, "files"), "w") as f:
+            f.write("%FILES%\n" + "\n".join(files) + "\n\n%BACKUP%\nusr/share/fonts/fake\t0\n\n")
+
+    def uninstall(self, name):
+        shutil.rmtree(os.path.join(self.root, "var/lib/pacman/local", f"{name}-1.0-1"))
+
+    @patch('libcalamares.job.configuration', {})
+    def test_held_hooks_run_once(self):
+        override = os.path.join(self.root, "etc/pacman.d/hooks/90-mkinitcpio-install.hook")
+        with held_hooks(self.root):
+            self.assertEqual(os.readlink(override), "/dev/null")
+            self.uninstall("nvidia")
+            self.install("ttf-hack", ["usr/share/fonts/TTF/Hack-Regular.ttf"])
+            self.install("qogir-icon-theme", ["usr/share/icons/", "usr/share/icons/Qogir/",
+                                              "usr/share/icons/Qogir/index.theme"])
+        self.assertFalse(os.path.lexists(override))
+
+        self.assertEqual(libcalamares.globalstorage.value("deferred_hooks"), ["depmod", "fontconfig", "icon-cache"])
+        self.assertEqual(libcalamares.chroot.calls, [
+            ["depmod", "6.10.0-alg"],
+            ["fc-cache", "-s"],
+            ["gtk-update-icon-cache", "-q", "-t", "-f", "/usr/share/icons/Qogir"],
+        ])
+
+    @patch('libcalamares.job.configuration', {})
+    def test_untriggered_hooks_do_not_run(self):
+        with held_hooks(self.root):
+            self.uninstall("amd-ucode")
+
+        self.assertEqual(libcalamares.globalstorage.value("deferred_hooks"), [])
+        self.assertEqual(libcalamares.chroot.calls, [])
+
+
+class TestPacmanLock(unittest.TestCase):
+
+    def _make_lock(self, root):
+        os.makedirs(os.path.join(root, "var/lib/pacman"))
+        lock = os.path.join(root, "var/lib/pacman/db.lck")
+        open(lock, "w").close()
+        return lock
+
+    @patch('modules.packages_remover.main.find_lock_holders', return_value=[])
+    def test_stale_lock_is_removed(self, mock_holders):
+        with tempfile.TemporaryDirectory() as root:
+            lock = self._make_lock(root)
+            self.assertTrue(wait_for_db_lock(root, timeout=1))
+            self.assertFalse(os.path.exists(lock))
+
+    @patch('modules.packages_remover.main.time.sleep')
+    @patch('modules.packages_remover.main.find_lock_holders', return_value=[4242])
+    def test_held_lock_is_kept(self, mock_holders, mock_sleep):
+        with tempfile.TemporaryDirectory() as root:
+            lock = self._make_lock(root)
+            self.assertFalse(wait_for_db_lock(root, timeout=0))
+            self.assertTrue(os.path.exists(lock))
+
+    @patch('libcalamares.globalstorage.value')
+    def test_queued_removals_are_merged(self, mock_globalstorage):
+        mock_globalstorage.side_effect = {
+            "cpu_vendor": "AuthenticAMD",
+            "kernel_boot_mode": "nonfree",
+            "pacman_queue": [
+                {"action": "remove", "packages": ["qogir-icon-theme"], "source": "edition_chooser"},
+                {"action": "install", "packages": ["firefox"], "source": "edition_chooser"},
+            ],
+        }.get
+        sources = get_removal_sources()
+        self.assertEqual(sources["microcode"], ["intel-ucode"])
+        self.assertEqual(sources["edition_chooser"], ["qogir-icon-theme"])
+
+
+class TestTimingSpans(unittest.TestCase):
+
+    @patch('libcalamares.job.setprogress')
+    @patch('libcalamares.globalstorage.value', return_value=None)
+    @patch('libcalamares.utils.target_env_process_output', return_value=0)
+    def test_execute_plan_records_spans(self, mock_process_output, mock_globalstorage, mock_setprogress):
+        plan = {"steps": [
+            {"action": "remove", "packages": ["calamares"]},
+            {"action": "install", "packages": ["firefox"], "offline": {}, "network": ["firefox"]},
+        ]}
+        spans = []
+        execute_plan(plan, "/fake/path", spans)
+
+        self.assertEqual([span["step"] for span in spans], ["remove", "install"])
+        self.assertEqual(spans[0]["commands"][0]["command"], ['pacman', '-Rns', '--noconfirm', 'calamares'])
+        self.assertEqual(spans[1]["commands"][0]["exit"], 0)
+        self.assertEqual([c.args[0] for c in mock_setprogress.call_args_list], [0.45, 0.9])
+
+    @patch('libcalamares.utils.debug')
+    @patch('libcalamares.globalstorage.insert')
+    def test_report_timings(self, mock_insert, mock_debug):
+        spans = [{"step": "remove", "seconds": 1.5,
+                  "commands": [{"command": ['pacman', '-Rns', 'a'], "exit": 0, "seconds": 1.4}]}]
+        report_timings(spans)
+        mock_insert.assert_called_once_with("packages_remover_timings", spans)
+        mock_debug.assert_called_once_with("packages_remover: remove took 1.5s [pacman -Rns exit 0 in 1.4s]")
+
+
+class TestPacmanOutput(unittest.TestCase):
+
+    @patch('libcalamares.job.setprogress')
+    @patch('libcalamares.globalstorage.value', return_value=None)
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_run_pacman_streams_progress(self, mock_process_output, mock_globalstorage, mock_setprogress):
+        def pacman(cmd, callback, *args):
+            for line in ["checking dependencies...",
+                         "Packages (2) calamares-3.3.9-1  kpmcore-24.08.1-1",
+                         ":: Processing package changes...",
+                         "removing calamares...",
+                         "removing kpmcore...",
+                         ":: Running post-transaction hooks...",
+                         "(1/2) Arming ConditionNeedsUpdate...",
+                         "(2/2) Updating the desktop file MIME type cache..."]:
+                callback(line)
+            return 0
+        mock_process_output.side_effect = pacman
+
+        result = run_pacman(['-Rns', '--noconfirm', 'calamares', 'kpmcore'])
+
+        self.assertEqual(result["exit"], 0)
+        self.assertEqual(result["done"], 2)
+        self.assertEqual(result["hooks"], ["Arming ConditionNeedsUpdate...",
+                                           "Updating the desktop file MIME type cache..."])
+        self.assertEqual([c.args[0] for c in mock_setprogress.call_args_list], [0.5, 1.0])
+
+    @patch('libcalamares.job.setprogress')
+    @patch('libcalamares.globalstorage.value', return_value=None)
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_run_pacman_after_pre_transaction_hooks(self, mock_process_output, mock_globalstorage, mock_setprogress):
+        def pacman(cmd, callback, *args):
+            for line in ["Packages (2) nvidia-dkms-560.35.03-1  nvidia-utils-560.35.03-1",
+                         ":: Running pre-transaction hooks...",
+                         "(1/1) Remove DKMS modules",
+                         "==> dkms remove --no-depmod nvidia/560.35.03 -k 6.10.0-alg",
+                         ":: Processing package changes...",
+                         "(1/2) removing nvidia-dkms",
+                         "(2/2) removing nvidia-utils",
+                         "error: could not remove /usr/lib/nvidia: Directory not empty",
+                         ":: Running post-transaction hooks...",
+                         "(1/1) Arming ConditionNeedsUpdate..."]:
+                callback(line)
+            raise subprocess.CalledProcessError(1, cmd)
+        mock_process_output.side_effect = pacman
+
+        result = run_pacman(['-Rns', '--noconfirm', 'nvidia-dkms', 'nvidia-utils'])
+
+        self.assertEqual(result["done"], 2)
+        self.assertEqual(result["hooks"], ["Remove DKMS modules", "Arming ConditionNeedsUpdate..."])
+        self.assertEqual(result["errors"], ["could not remove /usr/lib/nvidia: Directory not empty"])
+        self.assertEqual([c.args[0] for c in mock_setprogress.call_args_list], [0.5, 1.0])
+
+    @patch('libcalamares.utils.warning')
+    @patch('libcalamares.globalstorage.value', return_value=None)
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_run_pacman_structured_errors(self, mock_process_output, mock_globalstorage, mock_warning):
+        def pacman(cmd, callback, *args):
+            callback("error: target not found: refind-efi")
+            raise subprocess.CalledProcessError(1, cmd)
+        mock_process_output.side_effect = pacman
+
+        result = run_pacman(['-Rns', '--noconfirm', 'refind-efi'])
+
+        self.assertEqual(result["exit"], 1)
+        self.assertEqual(result["not_found"], ["refind-efi"])
+        mock_warning.assert_called_once_with("pacman -Rns failed: target not found: refind-efi")
+
+
+class TestNvidiaDriverTable(unittest.TestCase):
+
+    def test_driver_family_by_device_id(self):
+        self.assertEqual(get_nvidia_driver_family("2484"), "open")         # RTX 3070
+        self.assertEqual(get_nvidia_driver_family("1f91"), "open")         # GTX 1650 Mobile
+        self.assertEqual(get_nvidia_driver_family("1c03"), "proprietary")  # GTX 1060
+        self.assertEqual(get_nvidia_driver_family("13c2"), "proprietary")  # GTX 970
+        self.assertEqual(get_nvidia_driver_family("1187"), "legacy470")    # GTX 760
+        self.assertEqual(get_nvidia_driver_family("1201"), "legacy390")    # GTX 560
+        self.assertEqual(get_nvidia_driver_family("1080"), "legacy390")    # GTX 580
+        self.assertEqual(get_nvidia_driver_family("0f00"), "legacy390")    # GT 630 (GF108)
+        self.assertEqual(get_nvidia_driver_family("10c3"), "nouveau")      # 8400 GS (GT218)
+        self.assertEqual(get_nvidia_driver_family("10d8"), "nouveau")      # NVS 300 (GT218)
+        self.assertEqual(get_nvidia_driver_family("0640"), "nouveau")      # 9500 GT
+        self.assertEqual(get_nvidia_driver_family("3100"), "open")         # newer than the table
+        self.assertEqual(get_nvidia_driver_family(None), "nouveau")
+
+    def _plan(self, kernel_boot_mode, gpu_devices):
+        values = {"kernel_boot_mode": kernel_boot_mode, "gpu_devices": gpu_devices}
+        with patch('libcalamares.globalstorage.value', side_effect=values.get):
+            return plan_nvidia_driver()
+
+    def test_hybrid_laptop(self):
+        plan = self._plan("nonfree", [
+            {"slot": "0000:00:02.0", "vendor": "8086", "device": "3e9b"},
+            {"slot": "0000:02:00.0", "vendor": "10de", "device": "1f91"},
+        ])
+        self.assertEqual(plan["family"], "open")
+        self.assertEqual(plan["install"], ["nvidia-open", "nvidia-utils", "nvidia-settings", "nvidia-prime"])
+        self.assertEqual(plan["remove"], [])
+        self.assertIn("nvidia", plan["replace"])
+        self.assertNotIn("nvidia-utils", plan["replace"])
+        self.assertTrue(plan["blacklist"])
+
+    def test_multiple_gpus_use_the_oldest_family(self):
+        plan = self._plan("nonfree", [
+            {"slot": "0000:01:00.0", "vendor": "10de", "device": "2484"},
+            {"slot": "0000:02:00.0", "vendor": "10de", "device": "1187"},
+        ])
+        self.assertEqual(plan["family"], "legacy470")
+        self.assertNotIn("nvidia-prime", plan["install"])
+
+    def test_free_mode_removes_every_driver(self):
+        plan = self._plan("free", [{"slot": "0000:01:00.0", "vendor": "10de", "device": "2484"}])
+        self.assertEqual(plan["install"], [])
+        self.assertIn("nvidia-open", plan["remove"])
+        self.assertEqual(plan["replace"], [])
+        self.assertFalse(plan["blacklist"])
+
+    def test_no_device_information_keeps_iso_driver(self):
+        plan = self._plan("nonfree", None)
+        self.assertEqual(plan["remove"], [])
+        self.assertTrue(plan["blacklist"])
+
+
+class TestNvidiaDriverReplacement(unittest.TestCase):
+    """The ISO's proprietary driver on a GTX 760, which needs the 470xx branch."""
+
+    ISO_DRIVER = {"nvidia": ["nvidia-utils"], "nvidia-utils": [], "nvidia-settings": ["nvidia-utils"]}
+    CONFLICTS = {"nvidia-470xx-dkms": "nvidia", "nvidia-470xx-utils": "nvidia-utils",
+                 "nvidia-470xx-settings": "nvidia-settings"}
+    BLACKLIST = "etc/modprobe.d/alg-blacklist-nouveau.conf"
+
+    def setUp(self):
+        libcalamares.reset()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        for name, depends in self.ISO_DRIVER.items():
+            self.install(name, depends)
+        for key, value in {"kernel_boot_mode": "nonfree", "firmwareType": "efi", "cpu_vendor": "GenuineIntel",
+                           "gpu_devices": [{"slot": "0000:01:00.0", "vendor": "10de", "device": "1187"}]}.items():
+            libcalamares.globalstorage.insert(key, value)
+        libcalamares.chroot.on("pacman", self.pacman)
+        self.available = set(self.CONFLICTS)
+
+    def install(self, name, depends=()):
+        path = os.path.join(self.root, "var/lib/pacman/local", f"{name}-1.0-1")
+        os.makedirs(path)
+        with open(os.path.join(path, "desc"), "w") as f:
+            f.write(f"%NAME%\n{name}\n\n%DEPENDS%\n" + "\n".join(depends) + "\n\n")
+
+    def uninstall(self, name):
+        shutil.rmtree(os.path.join(self.root, "var/lib/pacman/local", f"{name}-1.0-1"))
+
+    def pacman(self, args):
+        targets = [arg for arg in args[1:] if not arg.startswith("-") and arg != "4"]
+        if args[0] == "-Rns":
+            for name in targets:
+                self.uninstall(name)
+            return 0, []
+        missing = [name for name in targets if name not in self.available]
+        if missing:
+            return 1, [f"error: target not found: {name}" for name in missing]
+        installed = read_local_db(self.root)
+        conflicts = [self.CONFLICTS[name] for name in targets if self.CONFLICTS.get(name) in installed]
+        if conflicts and "--ask" not in args:
+            return 1, ["error: unresolvable package conflicts detected"]
+        for name in conflicts:
+            self.uninstall(name)
+        for name in targets:
+            self.install(name)
+        return 0, []
+
+    def execute(self):
+        with patch('libcalamares.job.configuration', {"offlineCacheDirs": []}):
+            plan = build_plan(read_local_db(self.root))
+            execute_plan(plan, self.root)
+        return plan
+
+    def test_new_family_replaces_the_iso_driver(self):
+        plan = self.execute()
+
+        self.assertEqual([step["action"] for step in plan["steps"]], ["blacklist", "install", "replace-driver"])
+        self.assertEqual(sorted(read_local_db(self.root)), sorted(self.CONFLICTS))
+        self.assertEqual([call[1] for call in libcalamares.chroot.calls], ["-S"])
+        self.assertIn("--ask", libcalamares.chroot.calls[0])
+        with open(os.path.join(self.root, self.BLACKLIST)) as f:
+            self.assertEqual(f.read(), "blacklist nouveau\n")
+
+    def test_gtx_760_falls_back_to_nouveau_when_the_new_family_is_missing(self):
+        # No local repository carries the 470xx packages, and the ISO's
+        # driver no longer supports Kepler
+        self.available = set()
+        self.execute()
+
+        self.assertEqual(read_local_db(self.root), {})
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.BLACKLIST)))
+        self.assertEqual([call[1] for call in libcalamares.chroot.calls], ["-S", "-Rns"])
+
+    def test_iso_driver_is_kept_when_it_supports_the_gpu(self):
+        # A GTX 1650 wants the open modules, the ISO's proprietary driver also drives it
+        libcalamares.globalstorage.insert("gpu_devices", [{"slot": "0000:01:00.0", "vendor": "10de", "device": "1f91"}])
+        self.available = set()
+        self.execute()
+
+        self.assertEqual(sorted(read_local_db(self.root)), sorted(self.ISO_DRIVER))
+        self.assertTrue(os.path.exists(os.path.join(self.root, self.BLACKLIST)))
+        self.assertNotIn("-Rns", [call[1] for call in libcalamares.chroot.calls])
+        self.assertTrue(any("keeping the proprietary driver" in message for message in libcalamares.utils.warning_log))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from unittest.mock import patch
+import libcalamares
+import subprocess
+import sys
+import alg_runner
+
+
+class TestRunner(unittest.TestCase):
+
+    def setUp(self):
+        libcalamares.reset()
+        alg_runner.reset()
+
+    def test_get_config(self):
+        self.assertEqual(alg_runner.get_config("pacmanTimeout", 3600), 3600)
+        libcalamares.job.configuration = {"pacmanTimeout": 60}
+        self.assertEqual(alg_runner.get_config("pacmanTimeout", 3600), 60)
+        libcalamares.job.configuration = None
+        self.assertIsNone(alg_runner.get_config("pacmanTimeout"))
+
+    def test_run_captures_output(self):
+        result = alg_runner.run([sys.executable, "-c", "print('hello')"])
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, "hello\n")
+        self.assertEqual(alg_runner.summary()["programs"][sys.executable]["spawns"], 1)
+
+    def test_shell_strings_are_rejected(self):
+        with self.assertRaises(TypeError):
+            alg_runner.run("lspci | grep VGA")
+        with self.assertRaises(TypeError):
+            alg_runner.run_target([])
+
+    def test_run_timeout(self):
+        result = alg_runner.run([sys.executable, "-c", "import time; time.sleep(5)"], timeout=0.1)
+        self.assertEqual(result.returncode, alg_runner.TIMED_OUT)
+        self.assertEqual(alg_runner.summary()["timeouts"], 1)
+        self.assertEqual(len(libcalamares.utils.warning_log), 1)
+
+    def test_run_missing_program(self):
+        result = alg_runner.run(["/nonexistent/gsettings", "get", "org.gnome.desktop.interface", "gtk-theme"])
+        self.assertEqual(result.returncode, alg_runner.FAILED_TO_START)
+
+    @patch('subprocess.run')
+    def test_probe_runs_once(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess([], 0, "'Orchis-Dark'\n", "")
+        command = ["gsettings", "get", "org.gnome.shell.extensions.user-theme", "name"]
+        first = alg_runner.probe(command)
+        second = alg_runner.probe(command)
+
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(second.stdout, first.stdout)
+        self.assertTrue(second.cached)
+        stats = alg_runner.summary()
+        self.assertEqual((stats["spawns"], stats["cached"]), (1, 1))
+
+    @patch('subprocess.run')
+    def test_probe_timeouts_are_retried(self, mock_run):
+        mock_run.side_effect = subprocess.TimeoutExpired("xfconf-query", 10)
+        alg_runner.probe(["xfconf-query", "-c", "xsettings", "-p", "/Net/ThemeName"])
+        alg_runner.probe(["xfconf-query", "-c", "xsettings", "-p", "/Net/ThemeName"])
+        self.assertEqual(mock_run.call_count, 2)
+
+    def test_target_calls(self):
+        libcalamares.chroot.on("depmod", lambda args: (1, []))
+        libcalamares.chroot.on("pacman", lambda args: (0, ["Packages (1) vlc", "(1/1) installing vlc"]))
+        lines = []
+
+        self.assertFalse(alg_runner.run_target(["depmod", "6.10.0-alg"], 600).ok)
+        self.assertTrue(alg_runner.stream_target(["pacman", "-S", "vlc"], lines.append, 3600).ok)
+        self.assertEqual(lines, ["Packages (1) vlc", "(1/1) installing vlc"])
+
+        alg_runner.publish("packages_remover")
+        stats = libcalamares.globalstorage.value("process_stats")
+        self.assertEqual(stats["spawns"], 2)
+        self.assertEqual(set(stats["programs"]), {"depmod", "pacman"})
+
+    def test_target_timeout(self):
+        libcalamares.chroot.latency["mkinitcpio"] = 0.5
+        result = alg_runner.run_target(["mkinitcpio", "-P"], 0.05)
+        self.assertEqual(result.returncode, alg_runner.TIMED_OUT)
+        self.assertLess(result.seconds, 0.5)
+
+    @patch('libcalamares.utils.target_env_process_output')
+    def test_stream_target_failure(self, mock_process_output):
+        mock_process_output.side_effect = subprocess.CalledProcessError(1, ["pacman"])
+        self.assertEqual(alg_runner.stream_target(["pacman", "-Rns", "foo"], print).returncode, 1)
+        self.assertEqual(mock_process_output.call_args.args[2:], ("", alg_runner.DEFAULT_TIMEOUT))
+
+
+if __name__ == '__main__':
+    unittest.main()
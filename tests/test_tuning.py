@@ -0,0 +1,285 @@
+import unittest
+from unittest.mock import patch
+import libcalamares
+import os
+import tempfile
+from modules.system_tuning.main import (
+    get_parent_disk,
+    get_target_mounts,
+    write_scheduler_rules,
+    enable_fstrim_timer,
+    tune_mount_options,
+    tune_fstab,
+    plan_swap,
+    write_zram_config,
+    create_swapfile,
+    configure_swap,
+    plan_parallelism,
+    get_initramfs_compression,
+    get_compression_options,
+    apply_config_edits,
+    SWAPFILE_TIMEOUT,
+)
+
+NVME = {"name": "nvme0n1", "rotational": False, "removable": False, "size_bytes": 512110190592,
+        "kind": "nvme", "discard": True, "queue_depth": 1023}
+HDD = {"name": "sda", "rotational": True, "removable": False, "size_bytes": 2000398934016,
+       "kind": "hdd", "discard": False, "queue_depth": 32}
+
+FSTAB = """# /etc/fstab: static file system information.
+UUID=1111 /boot/efi      vfat    umask=0077 0 2
+UUID=2222 /              ext4    defaults,relatime 0 1
+UUID=3333 /home          btrfs   subvol=@home 0 0
+UUID=4444 /data          ext4    defaults 0 2
+"""
+
+
+class TestStorageTuning(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def make_sysfs(self):
+        """Creates /sys/class/block style links for a disk with partitions."""
+        sysfs = os.path.join(self.root.name, "sys")
+        devices = os.path.join(self.root.name, "devices")
+        for disk, partitions in [("nvme0n1", ["nvme0n1p1", "nvme0n1p2"]), ("sda", ["sda1"])]:
+            os.makedirs(os.path.join(devices, disk))
+            for partition in partitions:
+                os.makedirs(os.path.join(devices, disk, partition))
+                open(os.path.join(devices, disk, partition, "partition"), "w").close()
+        os.makedirs(sysfs)
+        for disk, partition in [("nvme0n1", ""), ("nvme0n1", "nvme0n1p1"),
+                                ("nvme0n1", "nvme0n1p2"), ("sda", ""), ("sda", "sda1")]:
+            target = os.path.join(devices, disk, partition)
+            os.symlink(target, os.path.join(sysfs, partition or disk))
+        return sysfs
+
+    def test_get_parent_disk(self):
+        sysfs = self.make_sysfs()
+        self.assertEqual(get_parent_disk("/dev/nvme0n1p2", sysfs), "nvme0n1")
+        self.assertEqual(get_parent_disk("/dev/sda", sysfs), "sda")
+        self.assertIsNone(get_parent_disk("/dev/mapper/luks-2222", sysfs))
+
+    @patch('libcalamares.globalstorage.value')
+    def test_get_target_mounts(self, mock_globalstorage):
+        sysfs = self.make_sysfs()
+        mock_globalstorage.side_effect = {"partitions": [
+            {"device": "/dev/nvme0n1p1", "mountPoint": "/boot/efi"},
+            {"device": "/dev/nvme0n1p2", "mountPoint": "/"},
+            {"device": "/dev/sda1", "mountPoint": "/data"},
+            {"device": "/dev/sda2", "mountPoint": ""},
+        ]}.get
+        mounts = get_target_mounts({"nvme0n1": NVME, "sda": HDD}, sysfs)
+        self.assertEqual(mounts, {"/boot/efi": NVME, "/": NVME, "/data": HDD})
+
+    @patch('libcalamares.job.configuration', {"ioSchedulers": {"hdd": "mq-deadline"}})
+    def test_write_scheduler_rules(self):
+        kinds = write_scheduler_rules(self.root.name, {"nvme0n1": NVME, "sda": HDD})
+        with open(os.path.join(self.root.name, "etc/udev/rules.d/60-ioschedulers.rules")) as f:
+            rules = f.read().splitlines()
+
+        self.assertEqual(kinds, ["hdd", "nvme"])
+        self.assertEqual(len(rules), 3)
+        self.assertIn('ATTR{queue/rotational}=="1", ATTR{queue/scheduler}="mq-deadline"', rules[1])
+        self.assertIn('KERNEL=="nvme[0-9]*n[0-9]*", ATTR{queue/scheduler}="none"', rules[2])
+
+    def test_enable_fstrim_timer(self):
+        self.assertFalse(enable_fstrim_timer(self.root.name))
+
+        os.makedirs(os.path.join(self.root.name, "usr/lib/systemd/system"))
+        open(os.path.join(self.root.name, "usr/lib/systemd/system/fstrim.timer"), "w").close()
+        self.assertTrue(enable_fstrim_timer(self.root.name))
+        self.assertTrue(enable_fstrim_timer(self.root.name))
+        link = os.path.join(self.root.name, "etc/systemd/system/timers.target.wants/fstrim.timer")
+        self.assertEqual(os.readlink(link), "/usr/lib/systemd/system/fstrim.timer")
+
+    def test_tune_mount_options(self):
+        self.assertEqual(tune_mount_options("defaults", ["noatime"]), "noatime")
+        self.assertEqual(tune_mount_options("rw,relatime,compress=zstd", ["noatime"]), "rw,compress=zstd,noatime")
+        self.assertEqual(tune_mount_options("noatime", ["noatime"]), "noatime")
+        self.assertEqual(tune_mount_options("defaults", []), "defaults")
+
+    @patch('libcalamares.job.configuration', {"mountOptions": {"nvme": ["noatime"]}})
+    def test_tune_fstab(self):
+        os.makedirs(os.path.join(self.root.name, "etc"))
+        fstab_path = os.path.join(self.root.name, "etc/fstab")
+        with open(fstab_path, "w") as f:
+            f.write(FSTAB)
+
+        mounts = {"/boot/efi": NVME, "/": NVME, "/home": NVME, "/data": HDD}
+        changed = tune_fstab(self.root.name, mounts, "discard")
+        with open(fstab_path) as f:
+            fstab = f.read().splitlines()
+
+        self.assertEqual(changed, ["/", "/home"])
+        self.assertEqual(fstab[1], "UUID=1111 /boot/efi      vfat    umask=0077 0 2")
+        self.assertEqual(fstab[2], "UUID=2222 /              ext4    noatime,discard 0 1")
+        self.assertEqual(fstab[3], "UUID=3333 /home          btrfs   subvol=@home,noatime,discard 0 0")
+        self.assertEqual(fstab[4], "UUID=4444 /data          ext4    defaults 0 2")
+
+
+class TestSwapTuning(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        os.makedirs(os.path.join(self.root.name, "etc"))
+
+    def test_plan_swap_zram_sizes(self):
+        gib = 1024 * 1024
+        self.assertEqual(plan_swap(2 * gib, 2, False, True),
+                         {"type": "zram", "size_mib": 2048, "algorithm": "lz4", "swappiness": 180})
+        self.assertEqual(plan_swap(6 * gib, 8, False, True)["size_mib"], 4096)
+        self.assertEqual(plan_swap(16 * gib, 8, False, True)["size_mib"], 8192)
+        self.assertEqual(plan_swap(64 * gib, 16, False, True)["size_mib"], 16384)
+        self.assertEqual(plan_swap(64 * gib, 16, False, True)["algorithm"], "zstd")
+
+    def test_plan_swap_fallbacks(self):
+        gib = 1024 * 1024
+        self.assertEqual(plan_swap(2 * gib, 4, False, False),
+                         {"type": "swapfile", "size_mib": 4096, "algorithm": None, "swappiness": 60})
+        self.assertEqual(plan_swap(32 * gib, 4, False, False)["size_mib"], 8192)
+        self.assertIsNone(plan_swap(8 * gib, 4, True, False)["type"])
+        self.assertIsNone(plan_swap(8 * gib, 4, False, True, "none")["type"])
+        self.assertEqual(plan_swap(8 * gib, 4, False, True, "swapfile")["type"], "swapfile")
+
+    def test_write_zram_config(self):
+        self.assertTrue(write_zram_config(self.root.name, {"size_mib": 4096, "algorithm": "zstd"}))
+        with open(os.path.join(self.root.name, "etc/systemd/zram-generator.conf")) as f:
+            self.assertEqual(f.read(), "[zram0]\nzram-size = 4096\n"
+                                       "compression-algorithm = zstd\nswap-priority = 100\n")
+
+    @patch('libcalamares.utils.target_env_call', return_value=0)
+    def test_create_swapfile(self, mock_target_env_call):
+        self.assertTrue(create_swapfile(self.root.name, {"size_mib": 2}, "ext4"))
+
+        mock_target_env_call.assert_called_once_with(["mkswap", "/swapfile"], "", SWAPFILE_TIMEOUT)
+        swapfile = os.path.join(self.root.name, "swapfile")
+        self.assertEqual(os.path.getsize(swapfile), 2 * 1024 * 1024)
+        self.assertEqual(os.stat(swapfile).st_mode & 0o777, 0o600)
+        with open(os.path.join(self.root.name, "etc/fstab")) as f:
+            self.assertEqual(f.read(), "/swapfile none swap defaults 0 0\n")
+        self.assertFalse(create_swapfile(self.root.name, {"size_mib": 2}, "ext4"))
+
+    @patch('libcalamares.utils.target_env_call', return_value=1)
+    def test_create_swapfile_btrfs_failure(self, mock_target_env_call):
+        self.assertFalse(create_swapfile(self.root.name, {"size_mib": 2}, "btrfs"))
+        mock_target_env_call.assert_called_once_with(
+            ["btrfs", "filesystem", "mkswapfile", "--size", "2m", "/swapfile"], "", SWAPFILE_TIMEOUT)
+        self.assertFalse(os.path.exists(os.path.join(self.root.name, "etc/fstab")))
+
+    @patch('libcalamares.globalstorage.insert')
+    @patch('libcalamares.globalstorage.value')
+    def test_configure_swap_zram(self, mock_globalstorage, mock_insert):
+        mock_globalstorage.side_effect = {
+            "memory_total_kib": 8 * 1024 * 1024,
+            "cpu_info": {"threads": 8},
+            "partitions": [{"mountPoint": "/", "fs": "ext4"}],
+        }.get
+        generator = os.path.join(self.root.name, "usr/lib/systemd/system-generators")
+        os.makedirs(generator)
+        open(os.path.join(generator, "zram-generator"), "w").close()
+
+        with patch('libcalamares.job.configuration', {}):
+            plan = configure_swap(self.root.name)
+
+        self.assertEqual(plan["type"], "zram")
+        mock_insert.assert_called_once_with("swap_plan", plan)
+        with open(os.path.join(self.root.name, "etc/sysctl.d/99-swap.conf")) as f:
+            self.assertEqual(f.read(), "vm.swappiness = 180\nvm.page-cluster = 0\n")
+
+
+
+class TestParallelismTuning(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        os.makedirs(os.path.join(self.root.name, "etc"))
+
+    def write(self, relative_path, content):
+        with open(os.path.join(self.root.name, relative_path), "w") as f:
+            f.write(content)
+
+    def read(self, relative_path):
+        with open(os.path.join(self.root.name, relative_path)) as f:
+            return f.read()
+
+    @patch('libcalamares.job.configuration', {})
+    def test_plan_parallelism(self):
+        self.assertEqual(plan_parallelism(1), {
+            "etc/pacman.conf": [("ParallelDownloads", "ParallelDownloads = 5", "options")],
+        })
+        self.assertEqual(plan_parallelism(16)["etc/makepkg.conf"],
+                         [("MAKEFLAGS", 'MAKEFLAGS="-j16"', None)])
+        with patch('libcalamares.job.configuration', {"makeflags": False, "parallelDownloads": 0}):
+            self.assertEqual(list(plan_parallelism(16)), ["etc/mkinitcpio.conf"])
+
+    @patch('libcalamares.job.configuration', {})
+    def test_apply_config_edits(self):
+        self.write("etc/mkinitcpio.conf", 'HOOKS=(base udev)\n#COMPRESSION="zstd"\n#COMPRESSION_OPTIONS=()\n')
+        self.write("etc/makepkg.conf", '#-- Make Flags\n#MAKEFLAGS="-j2"\n')
+        self.write("etc/pacman.conf", "[options]\nHoldPkg = pacman\n\n[core]\n"
+                                      "Include = /etc/pacman.d/mirrorlist\n")
+
+        changed = apply_config_edits(self.root.name, plan_parallelism(16))
+
+        self.assertEqual(changed, ["etc/mkinitcpio.conf", "etc/makepkg.conf", "etc/pacman.conf"])
+        self.assertEqual(self.read("etc/mkinitcpio.conf"),
+                         'HOOKS=(base udev)\n#COMPRESSION="zstd"\nCOMPRESSION_OPTIONS=(-T0)\n')
+        self.assertEqual(self.read("etc/makepkg.conf"), '#-- Make Flags\nMAKEFLAGS="-j16"\n')
+        self.assertEqual(self.read("etc/pacman.conf"), "[options]\nHoldPkg = pacman\n"
+                                                       "ParallelDownloads = 5\n\n[core]\n"
+                                                       "Include = /etc/pacman.d/mirrorlist\n")
+        self.assertEqual(apply_config_edits(self.root.name, plan_parallelism(16)), [])
+
+    @patch('libcalamares.job.configuration', {})
+    def test_compression_options_only_for_threaded_compressors(self):
+        for conf, compression, threaded in [
+            ('HOOKS=(base udev)\n#COMPRESSION="zstd"\n', "zstd", True),
+            ('#COMPRESSION="gzip"\nCOMPRESSION="xz"\n', "xz", True),
+            ('COMPRESSION="gzip"\n', "gzip", False),
+            ("COMPRESSION='lzop' # smaller\n", "lzop", False),
+            ('COMPRESSION="zstd"\nCOMPRESSION="lz4"\n', "lz4", False),
+        ]:
+            with self.subTest(compression=compression):
+                self.write("etc/mkinitcpio.conf", conf)
+                self.assertEqual(get_initramfs_compression(self.root.name), compression)
+                self.assertEqual("etc/mkinitcpio.conf" in plan_parallelism(16, compression), threaded)
+                apply_config_edits(self.root.name, plan_parallelism(16, compression))
+                self.assertEqual("COMPRESSION_OPTIONS=(-T0)" in self.read("etc/mkinitcpio.conf"), threaded)
+        os.remove(os.path.join(self.root.name, "etc/mkinitcpio.conf"))
+        self.assertIsNone(get_initramfs_compression(self.root.name))
+        self.assertNotIn("etc/mkinitcpio.conf", plan_parallelism(16, None))
+
+    @patch('libcalamares.job.configuration', {})
+    def test_existing_compression_options_are_kept(self):
+        for conf, expected in [
+            ("#COMPRESSION_OPTIONS=(-9)\nCOMPRESSION_OPTIONS=(-19 --long)\n",
+             "#COMPRESSION_OPTIONS=(-9)\nCOMPRESSION_OPTIONS=(-19 --long -T0)\n"),
+            ("COMPRESSION_OPTIONS=('-19' \"--long\") # smaller images\n",
+             "COMPRESSION_OPTIONS=(-19 --long -T0)\n"),
+            ("COMPRESSION_OPTIONS=(-19 -T2)\n", "COMPRESSION_OPTIONS=(-19 -T2)\n"),
+            ("COMPRESSION_OPTIONS=(--threads=4)\n", "COMPRESSION_OPTIONS=(--threads=4)\n"),
+            ("COMPRESSION_OPTIONS=()\n", "COMPRESSION_OPTIONS=(-T0)\n"),
+        ]:
+            with self.subTest(conf=conf):
+                self.write("etc/mkinitcpio.conf", conf)
+                options = get_compression_options(self.root.name)
+                apply_config_edits(self.root.name, plan_parallelism(16, "zstd", options))
+                self.assertEqual(self.read("etc/mkinitcpio.conf"), expected)
+        os.remove(os.path.join(self.root.name, "etc/mkinitcpio.conf"))
+        self.assertEqual(get_compression_options(self.root.name), [])
+
+    @patch('libcalamares.job.configuration', {})
+    def test_apply_config_edits_prefers_live_setting(self):
+        self.write("etc/pacman.conf", "[options]\n#ParallelDownloads = 5\nParallelDownloads = 2\n")
+        apply_config_edits(self.root.name, plan_parallelism(1))
+        self.assertEqual(self.read("etc/pacman.conf"),
+                         "[options]\n#ParallelDownloads = 5\nParallelDownloads = 5\n")
+
+
+if __name__ == '__main__':
+    unittest.main()